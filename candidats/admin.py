@@ -1,11 +1,9 @@
-from collections import OrderedDict
-
 from django.contrib import admin
 from django.db.models import BooleanField
 from django.urls import reverse
 from django.utils.html import format_html
 
-from stages.views.export import OpenXMLExport
+from stages.views.export import Column, ExportDefinition, choice_display, yes_or_empty
 from .forms import CandidateForm
 from .models import (
     Candidate, Interview, GENDER_CHOICES, DIPLOMA_CHOICES, DIPLOMA_STATUS_CHOICES,
@@ -13,48 +11,51 @@ from .models import (
 )
 
 
+CHOICE_FIELDS = {
+    'gender': GENDER_CHOICES,
+    'section': SECTION_CHOICES,
+    'option': OPTION_CHOICES,
+    'diploma': DIPLOMA_CHOICES,
+    'diploma_status': DIPLOMA_STATUS_CHOICES,
+    'aes_accords': AES_ACCORDS_CHOICES,
+    'residence_permits': RESIDENCE_PERMITS_CHOICES,
+}
+
+
+def candidate_column(field):
+    if isinstance(field, BooleanField):
+        convert = yes_or_empty
+    elif field.name in CHOICE_FIELDS:
+        convert = choice_display(CHOICE_FIELDS[field.name])
+    else:
+        convert = None
+    return Column(getattr(field, 'verbose_name', field.name), field.name, convert)
+
+
+CANDIDATES_EXPORT = ExportDefinition(
+    'candidats', "Candidats", Candidate, [
+        candidate_column(f) for f in Candidate._meta.get_fields() if f.name not in ('ID', 'interview')
+    ] + [
+        Column('Employeur', 'corporation__name'),
+        Column('Employeur_canton', 'corporation__district'),
+        Column('FEE/FPP_civilité', 'instructor__civility'),
+        Column('FEE/FPP_Nom', 'instructor__last_name'),
+        Column('FEE/FPP_Prénom', 'instructor__first_name'),
+        Column('FEE/FPP_email', 'instructor__email'),
+        Column('Prof. entretien', 'interview__teacher_int__abrev'),
+        Column('Correct. examen', 'examination_teacher__abrev'),
+        Column('Prof. dossier', 'interview__teacher_file__abrev'),
+        Column('Date entretien', 'interview__date'),
+        Column('Salle entretien', 'interview__room'),
+    ],
+)
+
+
 def export_candidates(modeladmin, request, queryset):
     """
     Export all candidates fields.
     """
-    export_fields = OrderedDict([
-        (getattr(f, 'verbose_name', f.name), f.name)
-        for f in Candidate._meta.get_fields() if f.name not in ('ID', 'interview')
-    ])
-    export_fields['Employeur'] = 'corporation__name'
-    export_fields['Employeur_canton'] = 'corporation__district'
-    export_fields['FEE/FPP_civilité'] = 'instructor__civility'
-    export_fields['FEE/FPP_Nom'] = 'instructor__last_name'
-    export_fields['FEE/FPP_Prénom'] = 'instructor__first_name'
-    export_fields['FEE/FPP_email'] = 'instructor__email'
-    export_fields['Prof. entretien'] = 'interview__teacher_int__abrev'
-    export_fields['Correct. examen'] = 'examination_teacher__abrev'
-    export_fields['Prof. dossier'] = 'interview__teacher_file__abrev'
-    export_fields['Date entretien'] = 'interview__date'
-    export_fields['Salle entretien'] = 'interview__room'
-    boolean_fields = [f.name for f in Candidate._meta.get_fields() if isinstance(f, BooleanField)]
-    choice_fields = {
-        'gender': dict(GENDER_CHOICES),
-        'section':  dict(SECTION_CHOICES),
-        'option': dict(OPTION_CHOICES),
-        'diploma': dict(DIPLOMA_CHOICES),
-        'diploma_status': dict(DIPLOMA_STATUS_CHOICES),
-        'aes_accords': dict(AES_ACCORDS_CHOICES),
-        'residence_permits': dict(RESIDENCE_PERMITS_CHOICES),
-    }
-
-    export = OpenXMLExport('Exportation')
-    export.write_line(export_fields.keys(), bold=True)
-    for cand in queryset.values_list(*export_fields.values()):
-        values = []
-        for value, field_name in zip(cand, export_fields.values()):
-            if value != '' and value is not None and field_name in choice_fields:
-                value = choice_fields[field_name][value]
-            if field_name in boolean_fields:
-                value = 'Oui' if value else ''
-            values.append(value)
-        export.write_line(values)
-    return export.get_http_response('candidats_export')
+    return CANDIDATES_EXPORT.response(request, queryset=queryset, filename_base='candidats_export')
 
 export_candidates.short_description = "Exporter les candidats sélectionnés"
 
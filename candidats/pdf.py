@@ -16,12 +16,24 @@ class InscriptionSummaryPDF(EpcBaseDocTemplate):
     """
     PDF for summary of inscription
     """
+    data_fields = (
+        'last_name', 'first_name', 'birth_date', 'district', 'mobile', 'section', 'option',
+        'diploma', 'diploma_detail', 'diploma_status', 'work_certificate', 'certif_of_800_childhood',
+        'certif_of_800_general', 'contract', 'promise', 'activity_rate', 'registration_form',
+        'certificate_of_payement', 'police_record', 'cv', 'has_photo', 'reflexive_text',
+        'marks_certificate', 'handicap', 'aes_accords', 'residence_permits', 'comment',
+    )
+
     def __init__(self, out, **kwargs):
         super().__init__(out, **kwargs)
         self.addPageTemplates([
             PageTemplate(id='FirstPage', frames=[self.page_frame], onPage=self.header)
         ])
 
+    @classmethod
+    def cache_data(cls, candidate):
+        return {field: getattr(candidate, field) for field in cls.data_fields}
+
     def header(self, canvas, doc):
         section = "Filière EDE"
         title = "Dossier d’inscription"
@@ -1,16 +1,26 @@
+import shutil
+import tempfile
 from datetime import date, datetime
 from unittest import mock
 
 from django.contrib.auth.models import User
 from django.core import mail
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from stages.views.export import openxml_contenttype
 from stages.models import Section, Teacher
 from .models import Candidate, Interview
 
+# PDF documents are cached under MEDIA_ROOT: use a temporary one, emptied after each test.
+TEMP_MEDIA_ROOT = tempfile.mkdtemp()
 
+
+def tearDownModule():
+    shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class CandidateTests(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -18,6 +28,9 @@ class CandidateTests(TestCase):
             'me', 'me@example.org', 'mepassword', first_name='Hans', last_name='Schmid',
         )
 
+    def setUp(self):
+        self.addCleanup(shutil.rmtree, TEMP_MEDIA_ROOT, ignore_errors=True)
+
     def test_total_result(self):
         ede = Section.objects.create(name='EDE')
         cand = Candidate(
@@ -1,16 +1,14 @@
-import io
 import os
 
 from django.conf import settings
 from django.contrib import messages
-from django.http import FileResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.template import loader
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.utils.text import slugify
 
-from stages.views.base import EmailConfirmationBaseView
+from stages.views.base import EmailConfirmationBaseView, cached_pdf_response
 from candidats.models import Candidate, Interview
 from .pdf import InscriptionSummaryPDF
 
@@ -173,9 +171,7 @@ def inscription_summary(request, pk):
     Print a PDF summary of inscription
     """
     candidat = get_object_or_404(Candidate, pk=pk)
-    buff = io.BytesIO()
-    pdf = InscriptionSummaryPDF(buff)
-    pdf.produce(candidat)
     filename = slugify('{0}_{1}'.format(candidat.last_name, candidat.first_name)) + '.pdf'
-    buff.seek(0)
-    return FileResponse(buff, as_attachment=True, filename=filename)
+    return cached_pdf_response(
+        InscriptionSummaryPDF, candidat, filename, lambda out: InscriptionSummaryPDF(out).produce(candidat)
+    )
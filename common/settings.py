@@ -101,6 +101,39 @@ INSTALLED_APPS = (
 
 FILE_UPLOAD_HANDLERS = ["django.core.files.uploadhandler.TemporaryFileUploadHandler"]
 
+# The cache is shared between web and import worker processes (import progress).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(PROJECT_PATH, 'cache'),
+    }
+}
+
+# When True, uploaded files are imported by the `run_import_jobs` command
+# instead of inside the upload request. That command must then run permanently
+# as a service on the server (e.g. `python manage.py run_import_jobs` under systemd).
+IMPORT_JOBS_IN_BACKGROUND = False
+
+# Running import jobs older than this number of seconds are considered as interrupted.
+IMPORT_JOB_TIMEOUT = 30 * 60
+
+# Maximum total size (in bytes) of generated exports kept in MEDIA_ROOT/export_cache.
+EXPORT_CACHE_MAX_SIZE = 100 * 1024 * 1024
+
+# Maximum total size (in bytes) of generated PDF documents kept in MEDIA_ROOT/pdf_cache.
+PDF_CACHE_MAX_SIZE = 50 * 1024 * 1024
+
+# Maximum duration (in seconds) of a held (long polling) request of the attribution screen change feed.
+# Each open attribution screen holds a web worker for up to this duration, then
+# waits as long before its next request: keep it short unless the WSGI server
+# runs enough worker threads (e.g. gunicorn --threads). 0 to never hold requests.
+TRAINING_CHANGES_WAIT = 5
+
+# Number of worker processes rendering batch PDF prints (1 to render in the request process).
+# Workers are started on the first batch print and kept by each web process, so
+# only raise it with a few web processes (e.g. min(4, os.cpu_count() or 1)).
+PDF_RENDER_PROCESSES = 1
+
 STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
 
 ALLOWED_HOSTS = ['localhost', 'stages.pierre-coullery.ch']
@@ -148,5 +181,6 @@ RESP_FILIERE_EDS = ("Brahim Ali Hemma", 'M')
 if 'TRAVIS' in os.environ:
     SECRET_KEY = 'secretkeyfortravistests'
     STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
 else:
     from .local_settings import *
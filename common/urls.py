@@ -18,6 +18,8 @@ urlpatterns = [
     path('import_students_ester/', views.imports.StudentEsterImportView.as_view(), name='import-students-ester'),
     path('import_hp/', views.HPImportView.as_view(), name='import-hp'),
     path('import_hp_contacts/', views.HPContactsImportView.as_view(), name='import-hp-contacts'),
+    path('import_job/<int:pk>/', views.ImportJobView.as_view(), name='import-job'),
+    path('import_job/<int:pk>/progress/', views.import_job_progress, name='import-job-progress'),
 
     path('attribution/', views.AttributionView.as_view(), name='attribution'),
     re_path(r'^stages/export/(?P<scope>all)?/?$', views.export.stages_export, name='stages_export'),
@@ -46,6 +48,8 @@ urlpatterns = [
         name='print-mentor-compens-form'),
     path('exam/<int:pk>/indemn/<slug:typ>/', views.PrintCompensationForm.as_view(),
         name='print-compens-form'),
+    path('exam/sessions/indemn/', views.PrintSessionCompensationForms.as_view(),
+        name='print-session-compens-forms'),
 
     # Qualification EDE
     path('student_ede/<int:pk>/send_convocation/', views.StudentConvocationExaminationView.as_view(),
@@ -72,12 +76,13 @@ urlpatterns = [
     # AJAX/JSON urls
     path('section/<int:pk>/periods/', views.section_periods, name='section_periods'),
     path('section/<int:pk>/classes/', views.section_classes, name='section_classes'),
-    path('period/<int:pk>/students/', views.period_students, name='period_students'),
-    path('period/<int:pk>/corporations/', views.period_availabilities, name='period_availabilities'),
+    path('period/<int:pk>/snapshot/', views.period_snapshot, name='period_snapshot'),
+    path('period/<int:pk>/changes/', views.period_changes, name='period_changes'),
+    path('period/<int:pk>/assignment/', views.period_assignment, name='period_assignment'),
     # Training params in POST:
     path('training/new/', views.new_training, name="new_training"),
     path('training/del/', views.del_training, name="del_training"),
-    path('training/by_period/<int:pk>/', views.TrainingsByPeriodView.as_view()),
+    path('training/batch/', views.batch_trainings, name="batch_trainings"),
 
     path('student/<int:pk>/summary/', views.StudentSummaryView.as_view()),
     path('student/<int:pk>/send_reports/sem/<int:semestre>/', views.SendStudentReportsView.as_view(),
@@ -0,0 +1,64 @@
+"""
+Benchmark of the assignment solver of the attribution screen (period_assignment view).
+
+Synthetic periods (students with previous trainings, availabilities in a few
+domains and corporations, a part of them being priority ones) are built as
+cost matrices as in propose_assignment, then solved by linear_assignment.
+
+Usage: python scripts/bench_assignment.py [number of students] [number of availabilities]
+"""
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'common.settings')
+
+import django
+django.setup()
+
+import numpy as np
+
+from stages.assignment import (
+    CORPORATION_REPEAT_COST, DOMAIN_REPEAT_COST, NON_PRIORITY_COST, linear_assignment,
+)
+
+
+def synthetic_cost(rng, num_students, num_avails, num_domains=6, num_corps=120):
+    avail_domains = rng.integers(0, num_domains, num_avails)
+    avail_corps = rng.integers(0, num_corps, num_avails)
+    non_priority = rng.random(num_avails) > 0.2
+    domain_counts = np.zeros((num_students, num_domains))
+    corp_counts = np.zeros((num_students, num_corps))
+    for student in range(num_students):
+        # Two or three previous trainings per student
+        for _ in range(rng.integers(2, 4)):
+            domain_counts[student, rng.integers(0, num_domains)] += 1
+            corp_counts[student, rng.integers(0, num_corps)] += 1
+    return (
+        CORPORATION_REPEAT_COST * corp_counts[:, avail_corps] +
+        DOMAIN_REPEAT_COST * domain_counts[:, avail_domains] +
+        NON_PRIORITY_COST * non_priority
+    )
+
+
+def main(num_students, num_avails, repeat=5):
+    rng = np.random.default_rng(0)
+    linear_assignment(synthetic_cost(rng, 10, 12))  # Warm up
+    durations = []
+    for _ in range(repeat):
+        cost = synthetic_cost(rng, num_students, num_avails)
+        start = time.perf_counter()
+        rows, cols = linear_assignment(cost)
+        durations.append(time.perf_counter() - start)
+    print('%d students × %d availabilities: %.3f s (best), %.3f s (worst), total cost %d' % (
+        num_students, num_avails, min(durations), max(durations), cost[rows, cols].sum()
+    ))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 300,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 400,
+    )
@@ -0,0 +1,63 @@
+"""
+Benchmark of the bulletins PDF splitting done by ImportReportsView.
+
+The bundled 1ASEFEa.pdf file is repeated to build a large synthetic
+multi-class PDF, then page texts are extracted:
+  * with one pdftotext process per separated page (previous method),
+  * with a single pdftotext call for the whole document (current method).
+
+Usage: python scripts/bench_import_reports.py [number of copies]
+Needs the poppler-utils package (pdftotext, pdfseparate, pdfunite).
+"""
+import os
+import sys
+import tempfile
+import time
+from subprocess import PIPE, run
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'common.settings')
+
+import django
+django.setup()
+
+from stages.views.imports import pdf_pages_text
+
+SOURCE_PDF = os.path.join(ROOT_DIR, 'stages', 'test_files', '1ASEFEa.pdf')
+
+
+def build_synthetic_pdf(dest, copies):
+    run(['pdfunite'] + [SOURCE_PDF] * copies + [dest], check=True)
+
+
+def per_page_extraction(pdf_path, temp_dir):
+    run(['pdfseparate', pdf_path, os.path.join(temp_dir, 'page_%d.pdf')], check=True)
+    return [
+        run(['pdftotext', os.path.join(temp_dir, filename), '-'], stdout=PIPE, check=True).stdout
+        for filename in os.listdir(temp_dir)
+    ]
+
+
+def single_pass_extraction(pdf_path, temp_dir):
+    pages = pdf_pages_text(pdf_path)
+    run(['pdfseparate', pdf_path, os.path.join(temp_dir, 'page_%d.pdf')], check=True)
+    return pages
+
+
+def main(copies):
+    with tempfile.TemporaryDirectory() as work_dir:
+        pdf_path = os.path.join(work_dir, 'synthetic.pdf')
+        build_synthetic_pdf(pdf_path, copies)
+        for func in (per_page_extraction, single_pass_extraction):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                start = time.perf_counter()
+                num_pages = len(func(pdf_path, temp_dir))
+                duration = time.perf_counter() - start
+            print('%-25s %5d pages in %6.2f s (%7.1f pages/s)' % (
+                func.__name__, num_pages, duration, num_pages / duration
+            ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
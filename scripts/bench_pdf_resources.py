@@ -0,0 +1,124 @@
+"""
+Benchmark of batch PDF prints (class lists, data update forms and compensation
+forms of an exam session), reporting rendered pages per second and bytes per
+page.
+
+Synthetic classes (plain data, as passed by the views to the PDF renderers)
+are rendered serially in the current process. Compensation forms are rendered
+one document per form (as PrintCompensationForm) and in one document for the
+session (as PrintSessionCompensationForms).
+
+Usage: python scripts/bench_pdf_resources.py [number of classes] [students per class]
+"""
+import os
+import re
+import sys
+import time
+from datetime import date
+from io import BytesIO
+from types import SimpleNamespace
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'common.settings')
+
+import django
+django.setup()
+
+from stages.pdf import (
+    EntretienProfCompensationPdfForm, SoutenanceCompensationPdfForm, render_klass_list,
+    render_overlay, render_update_form,
+)
+
+PAGE_RE = re.compile(rb'/Type /Page\b(?!s)')
+
+
+def synthetic_klass(idx, num_students):
+    return {
+        'name': '2ASEFE%d' % idx,
+        'students': [{
+            'civility': 'Madame',
+            'full_name': 'Prénom%d Nom%d' % (num, num),
+            'last_name': 'Nom%d' % num,
+            'first_name': 'Prénom%d' % num,
+            'street': 'Rue des champs %d' % num,
+            'pcode_city': '2300 La Chaux-de-Fonds',
+            'mobile': '079 123 45 67',
+            'corporation': {
+                'name': 'Centre pédagogique XY', 'street': 'Rue du parc 1', 'pcode_city': '2000 Neuchâtel',
+            },
+            'instructor': {
+                'last_name': 'Formateur%d' % num, 'first_name': 'Jean', 'tel': '032 000 00 00',
+                'email': 'jean@example.org',
+            },
+        } for num in range(num_students)],
+    }
+
+
+def synthetic_exams(num_exams):
+    klass = SimpleNamespace(name='3EDEpe', is_Ede_pe=lambda: True, is_Ede_ps=lambda: False)
+    return [SimpleNamespace(
+        date_exam=date(2018, 6, 28),
+        student=SimpleNamespace(civility='Madame', full_name='Prénom%d Nom%d' % (num, num), klass=klass),
+        external_expert=SimpleNamespace(
+            last_name='Expert%d' % num, first_name='Jean', street='Rue du parc 1', pcode='2000',
+            pcode_city='2000 Neuchâtel', birth_date=date(1970, 1, 1), nation='CH', tel='032 000 00 00',
+            avs='756.1234.5678.90', corporation=SimpleNamespace(name='Centre pédagogique XY'),
+            iban='CH00 0000 0000 0000 0000 0', bank='',
+        ),
+    ) for num in range(num_exams)]
+
+
+def render_compensation_form(exam):
+    buff = BytesIO()
+    form_class = SoutenanceCompensationPdfForm if exam.type_exam == 'exam' else EntretienProfCompensationPdfForm
+    form_class(buff, exam).produce()
+    return buff.getvalue()
+
+
+def render_session_forms(exams):
+    buff = BytesIO()
+    render_overlay(buff, [
+        (SoutenanceCompensationPdfForm if exam.type_exam == 'exam' else EntretienProfCompensationPdfForm)(
+            buff, exam
+        ).layout_page()
+        for exam in exams
+    ])
+    return buff.getvalue()
+
+
+def report(label, documents, duration):
+    num_pages = sum(len(PAGE_RE.findall(doc)) for doc in documents)
+    num_bytes = sum(len(doc) for doc in documents)
+    print('%-22s %5d pages in %6.2f s (%7.1f pages/s, %8.0f bytes/page)' % (
+        label, num_pages, duration, num_pages / duration, num_bytes / num_pages
+    ))
+
+
+def main(num_classes, num_students):
+    klasses = [synthetic_klass(idx, num_students) for idx in range(num_classes)]
+    return_date = date(2018, 9, 14)
+    for label, func, args in (
+            ('klass lists', render_klass_list, ()),
+            ('update forms', render_update_form, (return_date,))):
+        func(klasses[0], *args)  # Warm up
+        start = time.perf_counter()
+        documents = [func(klass, *args) for klass in klasses]
+        report(label, documents, time.perf_counter() - start)
+
+    exams = synthetic_exams(num_classes * 2)
+    for num, exam in enumerate(exams):
+        exam.type_exam = ('entr', 'exam')[num % 2]
+    render_session_forms(exams[:2])  # Warm up
+    start = time.perf_counter()
+    documents = [render_compensation_form(exam) for exam in exams]
+    report('compensation forms', documents, time.perf_counter() - start)
+    start = time.perf_counter()
+    report('session forms', [render_session_forms(exams)], time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    )
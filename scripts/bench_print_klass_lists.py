@@ -0,0 +1,62 @@
+"""
+Benchmark of the batch class lists printing done by PrintKlassList.
+
+Synthetic classes (plain data, as passed by the view to the PDF renderers)
+are rendered:
+  * serially in the current process (PDF_RENDER_PROCESSES = 1),
+  * by the pool of worker processes (PDF_RENDER_PROCESSES = number of processes).
+The pool is started before timing, as it is kept alive between requests.
+
+Usage: python scripts/bench_print_klass_lists.py [number of classes] [number of processes]
+"""
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'common.settings')
+
+import django
+django.setup()
+
+from django.conf import settings
+
+from stages.pdf import render_documents, render_klass_list
+
+
+def synthetic_klass(idx, num_students=24):
+    return {
+        'name': '1ASE%d' % idx,
+        'students': [{
+            'last_name': 'Nom%d' % num,
+            'first_name': 'Prénom%d' % num,
+            'street': 'Rue des champs %d' % num,
+            'pcode_city': '2300 La Chaux-de-Fonds',
+            'mobile': '079 123 45 67',
+            'instructor': 'Formateur%d Jean, Centre pédagogique XY' % num,
+        } for num in range(num_students)],
+    }
+
+
+def main(num_classes, processes):
+    tasks = [(render_klass_list, (synthetic_klass(idx),)) for idx in range(num_classes)]
+    settings.PDF_RENDER_PROCESSES = processes
+    list(render_documents(tasks[:processes * 2]))  # Start (warm) the worker pool
+    for label, num_processes in (('serial', 1), ('parallel (%d processes)' % processes, processes)):
+        settings.PDF_RENDER_PROCESSES = num_processes
+        start = time.perf_counter()
+        first = None
+        for num_docs, _ in enumerate(render_documents(tasks), start=1):
+            first = first or time.perf_counter() - start
+        duration = time.perf_counter() - start
+        print('%-25s %5d documents in %6.2f s (%7.1f documents/s, first after %.2f s)' % (
+            label, num_docs, duration, num_docs / duration, first
+        ))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+        int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1,
+    )
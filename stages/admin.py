@@ -1,4 +1,3 @@
-from collections import OrderedDict
 from copy import deepcopy
 
 from django import forms
@@ -15,9 +14,10 @@ from django.utils.safestring import mark_safe
 from .models import (
     Teacher, Option, Student, StudentFile, Section, Level, Klass, Corporation,
     CorpContact, Domain, Period, Availability, Training, Course,
-    LogBookReason, LogBook, ExamEDESession, Examination, SupervisionBill
+    LogBookReason, LogBook, ExamEDESession, Examination, SupervisionBill, ImportJob,
+    TeacherChargeSnapshot, ExportColumnSet,
 )
-from .views.export import OpenXMLExport
+from .views.export import CORPORATIONS_EXPORT, EXPORT_DEFINITIONS
 
 
 def print_charge_sheet(modeladmin, request, queryset):
@@ -29,6 +29,21 @@ def print_charge_sheet(modeladmin, request, queryset):
 print_charge_sheet.short_description = "Imprimer les feuilles de charge"
 
 
+def refresh_charges(modeladmin, request, queryset):
+    num = TeacherChargeSnapshot.objects.refresh()
+    modeladmin.message_user(request, "Les charges de %d enseignant-e-s ont été recalculées." % num)
+refresh_charges.short_description = "Recalculer les charges de l'année (tous les enseignants)"
+
+
+def print_compensation_forms(modeladmin, request, queryset):
+    return HttpResponseRedirect(
+        reverse('print-session-compens-forms') + '?ids=%s' % ",".join(
+            request.POST.getlist(ACTION_CHECKBOX_NAME)
+        )
+    )
+print_compensation_forms.short_description = "Imprimer les formulaires d’indemnisation des experts"
+
+
 class ArchivedListFilter(admin.BooleanFieldListFilter):
     """
     Default filter that shows by default unarchived elements.
@@ -95,9 +110,14 @@ class TeacherAdmin(admin.ModelAdmin):
               ('previous_report', 'next_report', 'total_logbook'),
               ('user'))
     readonly_fields = ('total_logbook',)
-    actions = [print_charge_sheet]
+    actions = [print_charge_sheet, refresh_charges]
     inlines = [LogBookInline]
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if {'rate', 'previous_report'} & set(form.changed_data):
+            TeacherChargeSnapshot.objects.refresh()
+
 
 class SupervisionBillInline(admin.TabularInline):
     model = SupervisionBill
@@ -157,6 +177,10 @@ class ExaminationInline(admin.StackedInline):
     examination_actions.short_description = 'Actions pour la procédure'
 
 
+class ExamEDESessionAdmin(admin.ModelAdmin):
+    actions = [print_compensation_forms]
+
+
 class StudentAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'pcode', 'city', 'klass', 'archived')
     ordering = ('last_name', 'first_name')
@@ -303,23 +327,7 @@ class CorporationAdmin(admin.ModelAdmin):
         """
         Export all Corporations in Excel file.
         """
-        export_fields = OrderedDict([
-            (getattr(f, 'verbose_name', f.name), f.name)
-            for f in Corporation._meta.get_fields() if f.name in (
-                'name', 'short_name', 'sector', 'typ', 'street', 'pcode',
-                'city', 'district', 'tel', 'email', 'web', 'ext_id', 'archived'
-            )
-        ])
-        export = OpenXMLExport('Exportation')
-        export.write_line(export_fields.keys(), bold=True)
-        for corp in queryset.values_list(*export_fields.values()):
-            values = []
-            for value, field_name in zip(corp, export_fields.values()):
-                if field_name == 'archived':
-                    value = 'Oui' if value else ''
-                values.append(value)
-            export.write_line(values)
-        return export.get_http_response('corporations_export')
+        return CORPORATIONS_EXPORT.response(request, queryset=queryset, filename_base='corporations_export')
     export_corporations.short_description = 'Exportation Excel'
 
 
@@ -415,6 +423,99 @@ class CourseAdmin(admin.ModelAdmin):
     list_filter = ('imputation', )
     search_fields = ('teacher__last_name', 'public', 'subject')
 
+    # Charges of all teachers depend on courses (through imputation ratios)
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        TeacherChargeSnapshot.objects.refresh()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        TeacherChargeSnapshot.objects.refresh()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        TeacherChargeSnapshot.objects.refresh()
+
+
+class TeacherChargeSnapshotAdmin(admin.ModelAdmin):
+    list_display = (
+        'teacher', 'year', 'tot_mandats', 'tot_ens', 'tot_formation', 'tot_trav', 'tot_paye',
+        'next_report', 'computed',
+    )
+    list_filter = ('year',)
+    search_fields = ('teacher__last_name', 'teacher__first_name')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'status', 'user', 'created', 'duree', 'rows_processed', 'progress_link')
+    list_filter = ('kind', 'status')
+    readonly_fields = (
+        'kind', 'upload', 'content_type', 'options', 'user', 'status', 'created',
+        'started', 'finished', 'rows_processed', 'stats', 'error',
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def duree(self, obj):
+        duration = obj.duration
+        return '' if duration is None else '%.1f s' % duration.total_seconds()
+    duree.short_description = 'Durée'
+
+    def progress_link(self, obj):
+        return format_html('<a href="{}">Détails</a>', reverse('import-job', args=[obj.pk]))
+    progress_link.short_description = ''
+
+
+
+class ExportColumnSetForm(forms.ModelForm):
+    export = forms.ChoiceField(label="Exportation")
+
+    class Meta:
+        model = ExportColumnSet
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['export'].choices = [
+            (name, definition.title) for name, definition in EXPORT_DEFINITIONS.items()
+        ]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        definition = EXPORT_DEFINITIONS.get(cleaned_data.get('export'))
+        if definition and cleaned_data.get('columns'):
+            headers = ExportColumnSet(columns=cleaned_data['columns']).headers()
+            unknown = set(headers) - set(definition.headers())
+            if unknown:
+                self.add_error('columns', "Colonnes inconnues : %s" % ", ".join(sorted(unknown)))
+        return cleaned_data
+
+
+class ExportColumnSetAdmin(admin.ModelAdmin):
+    form = ExportColumnSetForm
+    list_display = ('name', 'export', 'download_link')
+    list_filter = ('export',)
+    readonly_fields = ('available_columns',)
+
+    def available_columns(self, obj):
+        definition = EXPORT_DEFINITIONS.get(obj.export)
+        return format_html_join(mark_safe('<br>'), '{}', ((h,) for h in definition.headers())) if definition else ''
+    available_columns.short_description = 'Colonnes disponibles'
+
+    def download_link(self, obj):
+        definition = EXPORT_DEFINITIONS.get(obj.export)
+        if not definition or not definition.url_name:
+            return ''
+        url = reverse(definition.url_name) + '?columns=%d' % obj.pk
+        return format_html('<a href="{}">XLSX</a> | <a href="{}&format=csv">CSV</a>', url, url)
+    download_link.short_description = 'Télécharger'
 
 
 class GroupAdmin(AuthGroupAdmin):
@@ -435,6 +536,9 @@ admin.site.register(Student, StudentAdmin)
 admin.site.register(StudentFile)
 admin.site.register(Teacher, TeacherAdmin)
 admin.site.register(Course, CourseAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(TeacherChargeSnapshot, TeacherChargeSnapshotAdmin)
+admin.site.register(ExportColumnSet, ExportColumnSetAdmin)
 admin.site.register(Corporation, CorporationAdmin)
 admin.site.register(CorpContact, CorpContactAdmin)
 admin.site.register(Domain)
@@ -443,7 +547,7 @@ admin.site.register(Availability, AvailabilityAdmin)
 admin.site.register(Training, TrainingAdmin)
 admin.site.register(LogBookReason)
 admin.site.register(LogBook)
-admin.site.register(ExamEDESession)
+admin.site.register(ExamEDESession, ExamEDESessionAdmin)
 admin.site.register(Examination)
 
 admin.site.unregister(Group)
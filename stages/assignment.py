@@ -0,0 +1,124 @@
+"""
+Automatic assignment of the free availabilities of a period to its students
+without training, as a linear assignment problem on a cost matrix
+(students × availabilities).
+"""
+import numpy as np
+
+from .models import Student, Training
+
+# Costs of an assignment, by order of importance: the student has already been
+# at the corporation, has already had a training in the domain, the
+# availability is not a priority one.
+CORPORATION_REPEAT_COST = 100
+DOMAIN_REPEAT_COST = 10
+NON_PRIORITY_COST = 1
+
+
+def linear_assignment(cost):
+    """
+    Solve the rectangular linear assignment problem of the `cost` matrix
+    (shortest augmenting paths, vectorized by row).
+    Return the (rows, columns) arrays of the minimal cost matching, of
+    min(number of rows, number of columns) pairs.
+    """
+    cost = np.asarray(cost, dtype=float)
+    if cost.shape[0] > cost.shape[1]:
+        cols, rows = linear_assignment(cost.T)
+        order = np.argsort(rows)
+        return rows[order], cols[order]
+    num_rows, num_cols = cost.shape
+    u = np.zeros(num_rows)
+    v = np.zeros(num_cols)
+    col4row = np.full(num_rows, -1)
+    row4col = np.full(num_cols, -1)
+    for cur_row in range(num_rows):
+        shortest = np.full(num_cols, np.inf)
+        path = np.full(num_cols, -1)
+        remaining = np.ones(num_cols, dtype=bool)
+        scanned_rows = np.zeros(num_rows, dtype=bool)
+        min_val = 0
+        row = cur_row
+        sink = -1
+        while sink < 0:
+            scanned_rows[row] = True
+            reduced = min_val + cost[row] - u[row] - v
+            shorter = remaining & (reduced < shortest)
+            path[shorter] = row
+            shortest[shorter] = reduced[shorter]
+            candidates = np.where(remaining, shortest, np.inf)
+            min_val = candidates.min()
+            # Among the closest columns, prefer a free one (ends the path)
+            closest = np.flatnonzero(candidates == min_val)
+            free = closest[row4col[closest] < 0]
+            col = free[0] if len(free) else closest[0]
+            remaining[col] = False
+            if row4col[col] < 0:
+                sink = col
+            else:
+                row = row4col[col]
+        # Update the dual variables
+        u[cur_row] += min_val
+        others = scanned_rows.copy()
+        others[cur_row] = False
+        u[others] += min_val - shortest[col4row[others]]
+        v[~remaining] -= min_val - shortest[~remaining]
+        # Augment the matching along the path
+        col = sink
+        while True:
+            row = path[col]
+            row4col[col] = row
+            col4row[row], col = col, col4row[row]
+            if row == cur_row:
+                break
+    return np.arange(num_rows), col4row
+
+
+def propose_assignment(period):
+    """
+    Propose an assignment of the free availabilities of `period` to the
+    students targeted by the period (section and relative level) without
+    training in it, favouring new corporations and domains for each student,
+    then priority availabilities.
+    Return a list of (student, availability, number of previous trainings in
+    the availability domain, at the availability corporation) tuples, sorted
+    by student name.
+    """
+    students = list(Student.objects.filter(
+        archived=False, klass__section=period.section_id, klass__level=period.relative_level
+    ).exclude(training__availability__period=period).select_related('klass').order_by('last_name', 'first_name'))
+    avails = list(period.availability_set.filter(training__isnull=True).select_related('corporation', 'domain'))
+    if not students or not avails:
+        return []
+
+    student_index = {student.pk: idx for idx, student in enumerate(students)}
+    domain_index = {}
+    corp_index = {}
+    for avail in avails:
+        domain_index.setdefault(avail.domain_id, len(domain_index))
+        corp_index.setdefault(avail.corporation_id, len(corp_index))
+    # Previous trainings by student and domain/corporation of the free availabilities
+    domain_counts = np.zeros((len(students), len(domain_index)))
+    corp_counts = np.zeros((len(students), len(corp_index)))
+    previous = Training.objects.filter(student__in=students).values_list(
+        'student_id', 'availability__domain_id', 'availability__corporation_id'
+    )
+    for student_id, domain_id, corp_id in previous:
+        if domain_id in domain_index:
+            domain_counts[student_index[student_id], domain_index[domain_id]] += 1
+        if corp_id in corp_index:
+            corp_counts[student_index[student_id], corp_index[corp_id]] += 1
+
+    avail_domains = np.array([domain_index[avail.domain_id] for avail in avails])
+    avail_corps = np.array([corp_index[avail.corporation_id] for avail in avails])
+    non_priority = np.array([not avail.priority for avail in avails])
+    cost = (
+        CORPORATION_REPEAT_COST * corp_counts[:, avail_corps] +
+        DOMAIN_REPEAT_COST * domain_counts[:, avail_domains] +
+        NON_PRIORITY_COST * non_priority
+    )
+    rows, cols = linear_assignment(cost)
+    return [(
+        students[row], avails[col],
+        int(domain_counts[row, avail_domains[col]]), int(corp_counts[row, avail_corps[col]]),
+    ) for row, col in zip(rows, cols)]
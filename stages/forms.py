@@ -6,34 +6,49 @@ from django.forms import inlineformset_factory
 from django.urls import reverse
 
 from django_summernote.widgets import SummernoteWidget
-from tabimport import FileFactory, UnsupportedFileFormat
+from tabimport import UnsupportedFileFormat
 
 from .models import Corporation, Period, Section, Student, StudentFile
+from .utils import TabularReader
 
 
-class StudentImportForm(forms.Form):
+class TabularUploadForm(forms.Form):
+    """
+    Upload of a tabular file. The file is parsed once: the reader used to
+    validate the headers is then available as `self.reader` for the import.
+    """
     upload = forms.FileField()
+    mandatory_headers = ()
 
-    def __init__(self, file_label='Fichier', mandatory_headers=None, **kwargs):
-        super().__init__(**kwargs)
-        self.fields['upload'].label = file_label
-        self.mandatory_headers = mandatory_headers
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reader = None
 
     def clean_upload(self):
         f = self.cleaned_data['upload']
         try:
-            imp_file = FileFactory(f)
+            reader = TabularReader(
+                f.temporary_file_path(), name=f.name, content_type=f.content_type
+            )
         except UnsupportedFileFormat as e:
             raise forms.ValidationError("Erreur: %s" % e)
         # Check needed headers are present
-        headers = imp_file.get_headers()
-        missing = set(self.mandatory_headers) - set(headers)
+        missing = set(self.mandatory_headers) - set(reader.headers)
         if missing:
+            reader.close()
             raise forms.ValidationError("Erreur: il manque les colonnes %s" % (
                 ", ".join(missing)))
+        self.reader = reader
         return f
 
 
+class StudentImportForm(TabularUploadForm):
+    def __init__(self, file_label='Fichier', mandatory_headers=None, **kwargs):
+        super().__init__(**kwargs)
+        self.fields['upload'].label = file_label
+        self.mandatory_headers = mandatory_headers or ()
+
+
 class PeriodForm(forms.Form):
     section = forms.ModelChoiceField(queryset=Section.objects.all())
     period = forms.ModelChoiceField(queryset=None)
@@ -42,10 +57,17 @@ class PeriodForm(forms.Form):
         pass
 
 
-class UploadHPFileForm(forms.Form):
+class UploadHPFileForm(TabularUploadForm):
     upload = forms.FileField(label='Fichier HyperPlanning')
 
 
+class UploadHPCoursesForm(UploadHPFileForm):
+    diff_mode = forms.BooleanField(
+        label='Ne mettre à jour que les cours modifiés', required=False,
+        help_text="Sinon, tous les cours existants sont remplacés par ceux du fichier."
+    )
+
+
 class UploadReportForm(forms.Form):
     semester = forms.ChoiceField(label='Semestre', choices=(('1', '1'), ('2', '2')), required=True)
     upload = forms.FileField(label='Bulletins CLOEE (pdf)')
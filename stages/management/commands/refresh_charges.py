@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from stages.models import TeacherChargeSnapshot
+
+
+class Command(BaseCommand):
+    help = "Recompute and store the charges of all teachers for the current school year."
+
+    def handle(self, *args, **options):
+        num = TeacherChargeSnapshot.objects.refresh()
+        self.stdout.write("Charges of %d teachers refreshed." % num)
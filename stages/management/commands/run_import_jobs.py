@@ -0,0 +1,36 @@
+import signal
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from stages.models import ImportJob
+from stages.views.imports import run_import_job
+
+
+class Command(BaseCommand):
+    help = "Run the pending background file imports (ImportJob)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Run the currently pending jobs, then exit.",
+        )
+        parser.add_argument(
+            '--interval', type=float, default=5,
+            help="Seconds between two polls of the job queue (default: 5).",
+        )
+
+    def handle(self, *args, **options):
+        # Let run_import_job mark the current job as failed when the worker is stopped.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        while True:
+            job = ImportJob.objects.claim_next()
+            if job is not None:
+                self.stdout.write("Running %s…" % job)
+                run_import_job(job)
+                self.stdout.write("%s: %s" % (job, job.get_status_display()))
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stages', '0034_add_instructor2'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('students', 'Étudiants EPC'), ('students_ester', 'Étudiants ESTER'), ('hp', 'Cours HyperPlanning'), ('hp_contacts', 'Formateurs HyperPlanning')], max_length=20, verbose_name='Type')),
+                ('upload', models.FileField(upload_to='imports', verbose_name='Fichier')),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('options', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('running', 'En cours'), ('done', 'Terminée'), ('failed', 'Échouée')], default='pending', max_length=10, verbose_name='Statut')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Création')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='Début')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Fin')),
+                ('rows_processed', models.PositiveIntegerField(default=0, verbose_name='Lignes traitées')),
+                ('stats', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True, verbose_name='Erreur')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Utilisateur')),
+            ],
+            options={
+                'verbose_name': 'Importation',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
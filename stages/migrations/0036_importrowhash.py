@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0035_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportRowHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('students', 'Étudiants EPC'), ('students_ester', 'Étudiants ESTER'), ('hp', 'Cours HyperPlanning'), ('hp_contacts', 'Formateurs HyperPlanning')], max_length=20)),
+                ('ext_id', models.IntegerField()),
+                ('digest', models.CharField(max_length=40)),
+            ],
+            options={
+                'unique_together': {('kind', 'ext_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0036_importrowhash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeacherChargeSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(verbose_name='Année scolaire (début)')),
+                ('tot_mandats', models.IntegerField(default=0, verbose_name='Mandats')),
+                ('tot_ens', models.IntegerField(default=0, verbose_name='Enseignement')),
+                ('tot_formation', models.IntegerField(default=0, verbose_name='Formation')),
+                ('tot_trav', models.IntegerField(default=0, verbose_name='Total travaillé')),
+                ('tot_paye', models.IntegerField(default=0, verbose_name='Total payé')),
+                ('next_report', models.IntegerField(default=0, verbose_name='Report suivant')),
+                ('imputations', models.TextField(blank=True)),
+                ('computed', models.DateTimeField(blank=True, null=True, verbose_name='Calculé le')),
+                ('teacher', models.ForeignKey(on_delete=models.deletion.CASCADE, to='stages.teacher', verbose_name='Enseignant')),
+            ],
+            options={
+                'verbose_name': 'Charge annuelle',
+                'verbose_name_plural': 'Charges annuelles',
+                'ordering': ('-year', 'teacher'),
+                'unique_together': {('teacher', 'year')},
+            },
+        ),
+    ]
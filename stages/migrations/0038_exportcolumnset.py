@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0037_teacherchargesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportColumnSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('export', models.CharField(max_length=30, verbose_name='Exportation')),
+                ('name', models.CharField(max_length=100, verbose_name='Nom')),
+                ('columns', models.TextField(help_text='Un en-tête de colonne par ligne, dans l’ordre souhaité.', verbose_name='Colonnes')),
+            ],
+            options={
+                'verbose_name': 'Jeu de colonnes d’exportation',
+                'verbose_name_plural': 'Jeux de colonnes d’exportation',
+                'ordering': ('export', 'name'),
+            },
+        ),
+    ]
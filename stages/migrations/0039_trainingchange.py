@@ -0,0 +1,24 @@
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0038_exportcolumnset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrainingChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('training_id', models.IntegerField()),
+                ('student_id', models.IntegerField()),
+                ('availability_id', models.IntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('period', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stages.period')),
+            ],
+        ),
+    ]
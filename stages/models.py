@@ -1,11 +1,16 @@
 import json
-from collections import OrderedDict
+import uuid
+from collections import OrderedDict, defaultdict
 from contextlib import suppress
 from datetime import date, timedelta
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Case, Count, When
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Case, Count, Value, When
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.utils import timezone
+from django.utils.dateformat import format as django_format
 
 from . import utils
 
@@ -134,7 +139,8 @@ class Teacher(models.Model):
     def calc_activity(self):
         """
         Return a dictionary of calculations relative to teacher courses.
-        Store plus/minus periods to self.next_report.
+        Set plus/minus periods to self.next_report (the teacher is not saved,
+        see TeacherChargeSnapshot for stored charges).
         """
         mandats = self.course_set.filter(subject__startswith='#')
         ens = self.course_set.exclude(subject__startswith='#')
@@ -154,7 +160,6 @@ class Teacher(models.Model):
         if (self.rate == 100 and tot_paye < max_periods) or (tot_paye > max_periods):
             tot_paye = max_periods
             self.next_report = tot_trav - tot_paye
-        self.save()
 
         return {
             'mandats': mandats,
@@ -524,6 +529,126 @@ class CorpContact(models.Model):
         return 'e' if self.civility == 'Madame' else ''
 
 
+class ContactIndex:
+    """
+    Default contact and always-cc contacts of corporations, by section.
+    The data of each corporation is cached until a contact, section or
+    corporation changes (see invalidate_contact_index).
+    """
+    VERSION_KEY = 'contact-index-version'
+
+    def __init__(self, corporation_ids):
+        version = self.cache_version()
+        keys = {corp_id: 'contact-index-%s-%s' % (version, corp_id) for corp_id in corporation_ids}
+        cached = cache.get_many(keys.values())
+        self.corporations = {
+            corp_id: cached[key] for corp_id, key in keys.items() if key in cached
+        }
+        missing = [corp_id for corp_id in keys if corp_id not in self.corporations]
+        if missing:
+            computed = self.compute(missing)
+            cache.set_many({keys[corp_id]: entry for corp_id, entry in computed.items()})
+            self.corporations.update(computed)
+
+    @classmethod
+    def cache_version(cls):
+        version = cache.get(cls.VERSION_KEY)
+        if version is None:
+            cache.add(cls.VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(cls.VERSION_KEY)
+        return version
+
+    @staticmethod
+    def compute(corporation_ids):
+        """
+        Return {corp_id: (main contact, {section_id: contact}, {section_id: [always cc contacts]})}.
+        For a section, a main contact of that section is preferred, then the
+        first other contact of that section, then the first main contact.
+        """
+        result = {corp_id: (None, {}, {}) for corp_id in corporation_ids}
+        contacts = CorpContact.objects.filter(
+            corporation_id__in=corporation_ids
+        ).prefetch_related('sections').order_by('corporation_id', '-is_main', 'pk')
+        for contact in contacts:
+            main, by_section, always_ccs = result[contact.corporation_id]
+            if contact.is_main and main is None:
+                result[contact.corporation_id] = (contact, by_section, always_ccs)
+            for section in contact.sections.all():
+                by_section.setdefault(section.pk, contact)
+                if contact.always_cc:
+                    always_ccs.setdefault(section.pk, []).append(contact)
+        return result
+
+    def contact(self, corporation_id, section_id):
+        main, by_section, _ = self.corporations.get(corporation_id, (None, {}, {}))
+        return by_section.get(section_id, main)
+
+    def always_ccs(self, corporation_id, section_id):
+        return self.corporations.get(corporation_id, (None, {}, {}))[2].get(section_id, [])
+
+
+def invalidate_contact_index(**kwargs):
+    def new_version():
+        cache.set(ContactIndex.VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    new_version()
+    # The index may be computed by another process from the previous data
+    # until the current transaction is committed.
+    transaction.on_commit(new_version)
+
+
+post_save.connect(invalidate_contact_index, sender=CorpContact)
+post_delete.connect(invalidate_contact_index, sender=CorpContact)
+m2m_changed.connect(invalidate_contact_index, sender=CorpContact.sections.through)
+post_delete.connect(invalidate_contact_index, sender=Corporation)
+post_delete.connect(invalidate_contact_index, sender=Section)
+
+
+def data_version_key(model):
+    return 'data-version-%s' % model._meta.label_lower
+
+
+def data_versions(*models):
+    """
+    Return the current data version tokens of `models`. A token changes each
+    time an object of its model is saved or deleted (see bump_data_version).
+    """
+    keys = [data_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_data_version(*models):
+    """
+    Renew the data version tokens of `models`. Automatically called when
+    objects of this app are saved or deleted, must be called explicitly
+    after bulk operations.
+    """
+    def new_versions():
+        cache.set_many({data_version_key(model): uuid.uuid4().hex for model in models}, timeout=None)
+    new_versions()
+    # Data derived from the previous state may be computed by another process
+    # until the current transaction is committed.
+    transaction.on_commit(new_versions)
+
+
+def bump_data_version_on_change(sender, **kwargs):
+    if sender._meta.app_label == 'stages':
+        if 'instance' in kwargs and kwargs.get('model'):
+            # m2m_changed: both sides of the relation are modified
+            bump_data_version(type(kwargs['instance']), kwargs['model'])
+        else:
+            bump_data_version(sender)
+
+
+post_save.connect(bump_data_version_on_change, dispatch_uid='stages_data_version_save')
+post_delete.connect(bump_data_version_on_change, dispatch_uid='stages_data_version_delete')
+m2m_changed.connect(bump_data_version_on_change, dispatch_uid='stages_data_version_m2m')
+
+
 class Domain(models.Model):
     name = models.CharField(max_length=50, verbose_name='Nom')
 
@@ -632,6 +757,49 @@ class Training(models.Model):
         }
 
 
+class TrainingChange(models.Model):
+    """
+    Journal des modifications des stages d'une période. L'id (croissant) d'une
+    modification est la version du flux de modifications de l'écran
+    d'attribution (voir la vue period_changes).
+    """
+    period = models.ForeignKey(Period, on_delete=models.CASCADE)
+    training_id = models.IntegerField()
+    student_id = models.IntegerField()
+    availability_id = models.IntegerField()
+    deleted = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '{0} {1} ({2})'.format('Suppression' if self.deleted else 'Modification', self.training_id, self.pk)
+
+
+def record_training_changes(trainings, deleted=False):
+    """
+    Journal the changes of `trainings` (with their availability). Automatically
+    called when a training is saved or deleted, must be called explicitly
+    after bulk operations.
+    """
+    TrainingChange.objects.bulk_create([
+        TrainingChange(
+            period_id=training.availability.period_id, training_id=training.pk,
+            student_id=training.student_id, availability_id=training.availability_id, deleted=deleted,
+        ) for training in trainings
+    ])
+    bump_data_version(TrainingChange)
+
+
+def record_training_change(sender, instance, **kwargs):
+    origin = kwargs.get('origin')
+    if isinstance(origin, Period) or getattr(origin, 'model', None) is Period:
+        # The change feed of the period is deleted too.
+        return
+    record_training_changes([instance], deleted='created' not in kwargs)
+
+
+post_save.connect(record_training_change, sender=Training)
+post_delete.connect(record_training_change, sender=Training)
+
+
 IMPUTATION_CHOICES = (
     ('ASAFE', 'ASAFE'),
     ('ASEFE', 'ASEFE'),
@@ -672,6 +840,233 @@ class Course(models.Model):
             self.teacher, self.public, self.subject, self.period
         )
 
+
+class ChargeCalculator:
+    """
+    Compute the same results as Teacher.calc_activity/calc_imputations for many
+    teachers at once, from a single grouped query over Course (teacher ×
+    imputation × mandat or not).
+    """
+    imputation_keys = (
+        'ASAFE', 'ASSCFE', 'ASEFE', 'MPTS', 'MPS', 'EDEpe', 'EDEps', 'EDS', 'CAS_FPP',
+    )
+
+    def __init__(self, teachers=None, with_mandats=False):
+        """
+        `teachers`: limit the computations to those teachers (all courses are
+        read otherwise, which also provides the imputation ratios).
+        `with_mandats`: also fetch the mandat courses (for charge sheets).
+        """
+        courses = Course.objects.all()
+        if teachers is not None:
+            courses = courses.filter(teacher__in=teachers)
+        self.filtered = teachers is not None
+        # {teacher_id: {(imputation, is_mandat): periods}}
+        self.totals = defaultdict(lambda: defaultdict(int))
+        for line in courses.annotate(
+                is_mandat=Case(
+                    When(subject__startswith='#', then=Value(True)),
+                    default=Value(False), output_field=models.BooleanField()
+                )
+                ).values('teacher_id', 'imputation', 'is_mandat').annotate(
+                    total=models.Sum('period')
+                ).order_by():
+            self.totals[line['teacher_id']][(line['imputation'], line['is_mandat'])] += line['total'] or 0
+        self.mandats = defaultdict(list)
+        if with_mandats:
+            for course in courses.filter(subject__startswith='#').order_by('pk'):
+                self.mandats[course.teacher_id].append(course)
+
+    def ratios(self):
+        """Ratios used to split EDE, ASE and ASSC imputations."""
+        if self.filtered:
+            by_imputation = {
+                line['imputation']: line['total'] or 0
+                for line in Course.objects.values('imputation').annotate(
+                    total=models.Sum('period')).order_by()
+            }
+        else:
+            by_imputation = defaultdict(int)
+            for totals in self.totals.values():
+                for (imputation, _), total in totals.items():
+                    by_imputation[imputation] += total
+
+        def ratio(part, other):
+            part, other = by_imputation.get(part, 0), by_imputation.get(other, 0)
+            return 1 if part + other == 0 else part / (part + other)
+
+        return {
+            'edepe': ratio('EDEpe', 'EDEps'),
+            'asefe': ratio('ASEFE', 'MPTS'),
+            'asscfe': ratio('ASSCFE', 'MPS'),
+        }
+
+    def activity(self, teacher):
+        """
+        Same result as teacher.calc_activity(), also setting teacher.next_report,
+        but without saving the teacher.
+        """
+        totals = self.totals.get(teacher.pk, {})
+        tot_mandats = sum(total for (_, is_mandat), total in totals.items() if is_mandat)
+        tot_ens = sum(total for (_, is_mandat), total in totals.items() if not is_mandat)
+        # formation periods calculated at pro-rata of total charge
+        tot_formation = int(round(
+            (tot_mandats + tot_ens) / settings.MAX_ENS_PERIODS * settings.MAX_ENS_FORMATION
+        ))
+        tot_trav = teacher.previous_report + tot_mandats + tot_ens + tot_formation
+        tot_paye = tot_trav
+        max_periods = settings.MAX_ENS_PERIODS + settings.MAX_ENS_FORMATION
+        teacher.next_report = 0
+        if (teacher.rate == 100 and tot_paye < max_periods) or (tot_paye > max_periods):
+            tot_paye = max_periods
+            teacher.next_report = tot_trav - tot_paye
+        return {
+            'mandats': self.mandats.get(teacher.pk, []),
+            'tot_mandats': tot_mandats,
+            'tot_ens': tot_ens,
+            'tot_formation': tot_formation,
+            'tot_trav': tot_trav,
+            'tot_paye': tot_paye,
+            'report': teacher.next_report,
+        }
+
+    def imputations(self, teacher, ratios):
+        """Same result as teacher.calc_imputations(ratios), without saving the teacher."""
+        activities = self.activity(teacher)
+        by_imputation = defaultdict(int)
+        for (imputation, _), total in self.totals.get(teacher.pk, {}).items():
+            by_imputation[imputation] += total
+        imputations = OrderedDict(
+            (key, sum(total for imp, total in by_imputation.items() if key in imp))
+            for key in self.imputation_keys
+        )
+
+        # Spliting imputations for EDE, ASE and ASSC
+        for imp, ratio_key, part_key, other_key in (
+                ('EDE', 'edepe', 'EDEpe', 'EDEps'),
+                ('ASE', 'asefe', 'ASEFE', 'MPTS'),
+                ('ASSC', 'asscfe', 'ASSCFE', 'MPS')):
+            total = by_imputation.get(imp, 0)
+            if total > 0:
+                part = int(round(total * ratios[ratio_key], 0))
+                imputations[part_key] += part
+                imputations[other_key] += total - part
+
+        # Split formation periods in proportions
+        tot = sum(imputations.values())
+        if tot > 0:
+            for key in imputations:
+                imputations[key] += round(imputations[key] / tot * activities['tot_formation'], 0)
+
+        return (activities, imputations)
+
+
+class TeacherChargeSnapshotManager(models.Manager):
+    def refresh(self):
+        """
+        Compute the charges of all teachers for the current school year and
+        store them in bulk, as well as Teacher.next_report.
+        To be called each time courses are modified.
+        """
+        year = utils.school_year_start().year
+        charges = ChargeCalculator()
+        ratios = charges.ratios()
+        teachers = list(Teacher.objects.all())
+        snapshots = {snap.teacher_id: snap for snap in self.filter(year=year)}
+        to_create = []
+        now = timezone.now()
+        for teacher in teachers:
+            snapshot = snapshots.get(teacher.pk)
+            if snapshot is None:
+                snapshot = TeacherChargeSnapshot(teacher=teacher, year=year)
+                to_create.append(snapshot)
+            snapshot.set_charges(*charges.imputations(teacher, ratios))
+            snapshot.computed = now
+        with transaction.atomic():
+            self.bulk_update(
+                list(snapshots.values()),
+                TeacherChargeSnapshot.charge_fields + ['imputations', 'computed'], batch_size=500
+            )
+            self.bulk_create(to_create, batch_size=500)
+            Teacher.objects.bulk_update(teachers, ['next_report'], batch_size=500)
+        bump_data_version(TeacherChargeSnapshot, Teacher)
+        return len(teachers)
+
+    def charges(self, teachers, with_mandats=False):
+        """
+        Return {teacher_id: (activities, imputations)} for `teachers` and the
+        current school year, as returned by Teacher.calc_imputations.
+        Stored snapshots are read; charges of teachers without snapshot are
+        computed, but not stored.
+        """
+        teachers = list(teachers)
+        year = utils.school_year_start().year
+        result = {
+            snap.teacher_id: snap.get_charges()
+            for snap in self.filter(year=year, teacher__in=teachers)
+        }
+        missing = [teacher for teacher in teachers if teacher.pk not in result]
+        if missing:
+            charges = ChargeCalculator()
+            ratios = charges.ratios()
+            for teacher in missing:
+                result[teacher.pk] = charges.imputations(teacher, ratios)
+        if with_mandats:
+            mandats = defaultdict(list)
+            for course in Course.objects.filter(
+                    teacher__in=teachers, subject__startswith='#').order_by('pk'):
+                mandats[course.teacher_id].append(course)
+            for teacher_id, (activities, _) in result.items():
+                activities['mandats'] = mandats[teacher_id]
+        return result
+
+
+class TeacherChargeSnapshot(models.Model):
+    """Charge calculée d'un enseignant pour une année scolaire"""
+    charge_fields = [
+        'tot_mandats', 'tot_ens', 'tot_formation', 'tot_trav', 'tot_paye', 'next_report',
+    ]
+
+    teacher = models.ForeignKey(Teacher, on_delete=models.CASCADE, verbose_name='Enseignant')
+    year = models.PositiveSmallIntegerField("Année scolaire (début)")
+    tot_mandats = models.IntegerField("Mandats", default=0)
+    tot_ens = models.IntegerField("Enseignement", default=0)
+    tot_formation = models.IntegerField("Formation", default=0)
+    tot_trav = models.IntegerField("Total travaillé", default=0)
+    tot_paye = models.IntegerField("Total payé", default=0)
+    next_report = models.IntegerField("Report suivant", default=0)
+    imputations = models.TextField(blank=True)  # JSON-serialized imputations
+    computed = models.DateTimeField("Calculé le", null=True, blank=True)
+
+    objects = TeacherChargeSnapshotManager()
+
+    class Meta:
+        verbose_name = "Charge annuelle"
+        verbose_name_plural = "Charges annuelles"
+        unique_together = (('teacher', 'year'),)
+        ordering = ('-year', 'teacher')
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.teacher, self.school_year)
+
+    @property
+    def school_year(self):
+        return '%d — %d' % (self.year, self.year + 1)
+
+    def set_charges(self, activities, imputations):
+        for field in self.charge_fields:
+            setattr(self, field, activities['report' if field == 'next_report' else field])
+        self.imputations = json.dumps(imputations)
+
+    def get_charges(self):
+        activities = {
+            'report' if field == 'next_report' else field: getattr(self, field)
+            for field in self.charge_fields
+        }
+        activities['mandats'] = []
+        return activities, OrderedDict(json.loads(self.imputations or '{}'))
+
+
 class SupervisionBill(models.Model):
     student = models.ForeignKey(Student, verbose_name='étudiant', on_delete=models.CASCADE)
     supervisor = models.ForeignKey(CorpContact, verbose_name='superviseur', on_delete=models.CASCADE)
@@ -685,3 +1080,161 @@ class SupervisionBill(models.Model):
 
     def __str__(self):
         return '{0} : {1}'.format(self.student.full_name, self.supervisor.full_name)
+
+
+class ImportJobManager(models.Manager):
+    def claim(self, job):
+        """
+        Mark `job` as running, unless another job of the same kind is already
+        running, so that imports of the same kind never overlap. Jobs running
+        for more than IMPORT_JOB_TIMEOUT seconds (their worker was killed) are
+        marked as failed first.
+        Return True if the job was claimed.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            # With PostgreSQL, locking all jobs of that kind serializes concurrent claims.
+            # select_for_update() does nothing with SQLite: the claim relies on the
+            # conditional UPDATE below, as SQLite holds its database write lock
+            # during a whole statement.
+            list(self.select_for_update().filter(kind=job.kind).values_list('pk'))
+            self.filter(
+                kind=job.kind, status=ImportJob.RUNNING,
+                started__lt=now - timedelta(seconds=settings.IMPORT_JOB_TIMEOUT),
+            ).update(status=ImportJob.FAILED, finished=now, error="L'importation a été interrompue.")
+            claimed = self.filter(pk=job.pk, status=ImportJob.PENDING).exclude(
+                models.Exists(self.filter(kind=job.kind, status=ImportJob.RUNNING))
+            ).update(status=ImportJob.RUNNING, started=now)
+        if claimed:
+            job.status = ImportJob.RUNNING
+            job.started = now
+        return bool(claimed)
+
+    def claim_next(self):
+        """Claim and return the oldest claimable pending job, if any."""
+        for job in self.filter(status=ImportJob.PENDING).order_by('created'):
+            if self.claim(job):
+                return job
+        return None
+
+
+class ImportJob(models.Model):
+    """Importation de fichier exécutée en arrière-plan"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'En attente'),
+        (RUNNING, 'En cours'),
+        (DONE, 'Terminée'),
+        (FAILED, 'Échouée'),
+    )
+    KIND_CHOICES = (
+        ('students', 'Étudiants EPC'),
+        ('students_ester', 'Étudiants ESTER'),
+        ('hp', 'Cours HyperPlanning'),
+        ('hp_contacts', 'Formateurs HyperPlanning'),
+    )
+
+    kind = models.CharField("Type", max_length=20, choices=KIND_CHOICES)
+    upload = models.FileField("Fichier", upload_to='imports')
+    content_type = models.CharField(max_length=100, blank=True)
+    options = models.TextField(blank=True)  # JSON-serialized import options
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+        verbose_name='Utilisateur'
+    )
+    status = models.CharField("Statut", max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    created = models.DateTimeField("Création", auto_now_add=True)
+    started = models.DateTimeField("Début", null=True, blank=True)
+    finished = models.DateTimeField("Fin", null=True, blank=True)
+    rows_processed = models.PositiveIntegerField("Lignes traitées", default=0)
+    stats = models.TextField(blank=True)  # JSON-serialized import statistics
+    error = models.TextField("Erreur", blank=True)
+
+    objects = ImportJobManager()
+
+    class Meta:
+        verbose_name = "Importation"
+        ordering = ('-created',)
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.get_kind_display(), django_format(self.created, 'd.m.Y H:i'))
+
+    @property
+    def duration(self):
+        """Duration of the import, as a timedelta."""
+        if self.started is None:
+            return None
+        return (self.finished or timezone.now()) - self.started
+
+    @property
+    def progress_key(self):
+        return 'import-job-progress-%d' % self.pk
+
+    def get_options(self):
+        return json.loads(self.options) if self.options else {}
+
+    def get_stats(self):
+        return json.loads(self.stats) if self.stats else {}
+
+    def as_dict(self):
+        stats = self.get_stats()
+        rows = self.rows_processed
+        if self.status == self.RUNNING:
+            # Progress of a running job is published in the cache
+            rows = cache.get(self.progress_key, rows)
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'rows_processed': rows,
+            'created': stats.get('created'),
+            'modified': stats.get('modified'),
+            'archived': stats.get('archived'),
+            'deleted': stats.get('deleted'),
+            'unchanged': stats.get('unchanged'),
+            'errors': stats.get('errors', []) + ([self.error] if self.error else []),
+            'duration': self.duration.total_seconds() if self.duration is not None else None,
+        }
+
+
+class ImportRowHash(models.Model):
+    """
+    Empreinte du contenu de la dernière ligne importée pour un étudiant, qui
+    permet de sauter les lignes inchangées lors des importations suivantes.
+    """
+    kind = models.CharField(max_length=20, choices=ImportJob.KIND_CHOICES)
+    ext_id = models.IntegerField()
+    digest = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = (('kind', 'ext_id'),)
+
+    def __str__(self):
+        return '{0} {1}'.format(self.kind, self.ext_id)
+
+
+class ExportColumnSet(models.Model):
+    """
+    Jeu de colonnes personnalisé d'une exportation (voir EXPORT_DEFINITIONS
+    dans views/export.py), utilisable avec le paramètre ?columns=<id>.
+    """
+    export = models.CharField("Exportation", max_length=30)
+    name = models.CharField("Nom", max_length=100)
+    columns = models.TextField(
+        "Colonnes", help_text="Un en-tête de colonne par ligne, dans l’ordre souhaité."
+    )
+
+    class Meta:
+        verbose_name = "Jeu de colonnes d’exportation"
+        verbose_name_plural = "Jeux de colonnes d’exportation"
+        ordering = ('export', 'name')
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.name, self.export)
+
+    def headers(self):
+        return [line.strip() for line in self.columns.splitlines() if line.strip()]
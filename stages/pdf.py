@@ -1,19 +1,40 @@
+import copy
+import hashlib
+import inspect
+import io
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import date
+from functools import lru_cache, partial
+from itertools import islice
+from math import ceil
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
 
 from django.conf import settings
 from django.contrib.staticfiles.finders import find
 from django.utils.dateformat import format as django_format
 
+from PIL import Image as PILImage
+
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
 from reportlab.lib import colors
 from reportlab.lib.styles import ParagraphStyle as PS
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfdoc import PDFImageXObject
+from reportlab.pdfgen.canvas import Canvas, _digester
 from reportlab.platypus import (
-    Flowable, Frame, Image, NextPageTemplate, PageBreak, PageTemplate, Paragraph,
+    ActionFlowable, Flowable, Frame, NextPageTemplate, PageBreak, PageTemplate, Paragraph,
     SimpleDocTemplate, Spacer, Table, TableStyle, Preformatted
 )
 
+from .pdf_worker import init_render_worker
+
 style_normal = PS(name='CORPS', fontName='Helvetica', fontSize=8, alignment=TA_LEFT)
 style_normal_center = PS(name='CORPS', fontName='Helvetica', fontSize=8, alignment=TA_CENTER)
 style_bold = PS(name='CORPS', fontName='Helvetica-Bold', fontSize=8, spaceBefore=0.3 * cm, alignment=TA_LEFT)
@@ -22,6 +43,8 @@ style_adress = PS(name='CORPS', fontName='Helvetica', fontSize=8, alignment=TA_L
 style_normal_right = PS(name='CORPS', fontName='Helvetica', fontSize=8, alignment=TA_RIGHT)
 style_bold_center = PS(name="CORPS", fontName="Helvetica-Bold", fontSize=9, alignment=TA_CENTER)
 style_footer = PS(name='CORPS', fontName='Helvetica', fontSize=7, alignment=TA_CENTER)
+# Default font of table cells
+style_cell = PS(name='CELL', fontName='Helvetica', fontSize=10, leading=12, alignment=TA_LEFT)
 style_bold_title = PS(name="CORPS", fontName="Helvetica-Bold", fontSize=12, alignment=TA_LEFT)
 style_smallx = PS(name='CORPS', fontName="Helvetica-BoldOblique", fontSize=6, alignment=TA_LEFT)
 
@@ -33,6 +56,80 @@ LOGO_CPLN = find('img/logo_CPLN.jpg')
 LOGO_CPMB = find('img/logo_CPMB.png')
 
 
+class PDFResources:
+    """
+    Process-wide cache of the resources shared by generated documents.
+    Logos are decoded once, downsampled to the resolution of the box where they
+    are drawn, and embedded once per document; the footer paragraph is wrapped
+    once.
+    """
+    DPI = 300
+
+    def __init__(self):
+        self._images = {}
+        self._footers = {}
+
+    def _image(self, path, width, height):
+        key = (path, round(width), round(height))
+        if key not in self._images:
+            image = PILImage.open(path).convert('RGB')
+            image.thumbnail(
+                (ceil(width / 72 * self.DPI), ceil(height / 72 * self.DPI)), PILImage.LANCZOS
+            )
+            # drawImage() finds an already registered XObject by this name and
+            # does not try to read it as a file.
+            name = '%s@%dx%d' % key
+            digest = _digester(('%s%s' % (name, None)).encode('utf-8'))
+            self._images[key] = (name, digest, PDFImageXObject(digest, ImageReader(image)))
+        return self._images[key]
+
+    def draw_image(self, canvas, path, x, y, width, height, preserveAspectRatio=False):
+        name, digest, xobject = self._image(path, width, height)
+        doc = canvas._doc
+        reg_name = doc.getXObjectName(digest)
+        if reg_name not in doc.idToObject:
+            xobject = copy.copy(xobject)
+            canvas._setXObjects(xobject)
+            doc.Reference(xobject, reg_name)
+            doc.addForm(digest, xobject)
+        canvas.drawImage(name, x, y, width, height, preserveAspectRatio=preserveAspectRatio)
+
+    def draw_footer(self, canvas, x, width, height):
+        """Draw the footer paragraph, wrapped in width/height, at x."""
+        key = (settings.PDF_FOOTER_TEXT, width, height)
+        if key not in self._footers:
+            footer = Paragraph(settings.PDF_FOOTER_TEXT, style_footer)
+            _, h = footer.wrap(width, height)
+            self._footers[key] = (footer, h)
+        footer, h = self._footers[key]
+        with shared_flowables_lock:
+            footer.drawOn(canvas, x, h)
+
+
+# Flowables shared between documents keep a reference to the canvas while
+# they are drawn.
+shared_flowables_lock = threading.Lock()
+
+resources = PDFResources()
+
+
+class Logo(Flowable):
+    """Image flowable drawing a logo from the resources cache."""
+
+    def __init__(self, path, width, height):
+        Flowable.__init__(self)
+        self.path = path
+        self.width = width
+        self.height = height
+        self.hAlign = 'CENTER'
+
+    def __repr__(self):
+        return "Logo(%s)" % self.path
+
+    def draw(self):
+        resources.draw_image(self.canv, self.path, 0, 0, self.width, self.height)
+
+
 class HorLine(Flowable):
     """Line flowable --- draws a line in a flowable"""
 
@@ -47,6 +144,123 @@ class HorLine(Flowable):
         self.canv.line(0, 0, self.width, 0)
 
 
+class FieldBox(Flowable):
+    """
+    Placeholder of a variable field in the layout of an overlay form: it draws
+    nothing, but records where it is placed on the page.
+    """
+
+    def __init__(self, name, fields, style=style_cell, lines=1):
+        Flowable.__init__(self)
+        self.name = name
+        self.fields = fields
+        self.configure(style, lines)
+        self.recorded = False
+
+    def __repr__(self):
+        return "FieldBox(%s)" % self.name
+
+    def configure(self, style, lines=1):
+        self.style = style
+        self.lines = lines
+        return self
+
+    def wrap(self, availWidth, availHeight):
+        self.width = availWidth
+        self.height = self.lines * self.style.leading
+        return self.width, self.height
+
+    def draw(self):
+        if not self.recorded:
+            x, y = self.canv.absolutePosition(0, 0)
+            self.fields.setdefault(self.name, []).append((x, y, self.width, self.height, self.style))
+            self.recorded = True
+
+
+class FieldPlaceholders:
+    """Field values of an overlay form layout: a new FieldBox for each use of a field."""
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __getitem__(self, name):
+        return FieldBox(name, self.fields)
+
+
+def text_field(value, style, lines=1):
+    """Paragraph of a variable text, or its placeholder when laying out an overlay form."""
+    if isinstance(value, FieldBox):
+        return value.configure(style, lines)
+    return Paragraph(value, style)
+
+
+class _Positioned(Flowable):
+    """Wrapper recording where a static flowable is drawn on the page."""
+
+    def __init__(self, flowable, records):
+        Flowable.__init__(self)
+        self.flowable = flowable
+        self.records = records
+        self.hAlign = getattr(flowable, 'hAlign', 'LEFT')
+
+    def getSpaceBefore(self):
+        return self.flowable.getSpaceBefore()
+
+    def getSpaceAfter(self):
+        return self.flowable.getSpaceAfter()
+
+    def wrap(self, availWidth, availHeight):
+        self.width, self.height = self.flowable.wrapOn(self.canv, availWidth, availHeight)
+        return self.width, self.height
+
+    def draw(self):
+        x, y = self.canv.absolutePosition(0, 0)
+        self.records.append((self.flowable, x, y))
+        self.flowable.drawOn(self.canv, 0, 0)
+
+
+class OverlayLayout:
+    """
+    Layout of a one-page form, computed once by building the story returned by
+    `build_story(values)` with placeholders (FieldBox) as field values.
+    The static flowables are kept with their position on the page, as are the
+    variable fields, so that documents draw the static parts once per document
+    as a background form (see render_overlay), and only the field values on
+    each page.
+    """
+
+    def __init__(self, name, doc, build_story, on_page=None):
+        self.name = name
+        self.doc = doc
+        self.on_page = on_page
+        self.fields = {}
+        self.flowables = []
+        doc.build([
+            flowable if isinstance(flowable, (ActionFlowable, Spacer))
+            else _Positioned(flowable, self.flowables)
+            for flowable in build_story(FieldPlaceholders(self.fields))
+        ])
+        if doc.page > 1:
+            raise ValueError("The layout of %s does not fit on one page" % name)
+
+    def draw_background(self, canvas):
+        with shared_flowables_lock:
+            if self.on_page:
+                self.on_page(canvas, self.doc)
+            for flowable, x, y in self.flowables:
+                flowable.drawOn(canvas, x, y)
+
+    def draw_fields(self, canvas, values):
+        for name, positions in self.fields.items():
+            if not values.get(name):
+                continue
+            text = escape(str(values[name]))
+            for x, y, width, height, style in positions:
+                para = Paragraph(text, style)
+                _, h = para.wrap(width, height)
+                para.drawOn(canvas, x, y + height - h)
+
+
 class EpcBaseDocTemplate(SimpleDocTemplate):
     points = '.' * 93
 
@@ -63,34 +277,41 @@ class EpcBaseDocTemplate(SimpleDocTemplate):
         self.story = []
         self.title = title
 
+    @classmethod
+    def cache_data(cls, obj):
+        """
+        Data read by the document produced for `obj`. The document is served
+        from the PDF cache as long as these data and its code are unchanged.
+        """
+        raise NotImplementedError
+
     def header(self, canvas, doc):
         canvas.saveState()
-        canvas.drawImage(
-            LOGO_EPC, doc.leftMargin, doc.height - 1.5 * cm, 5 * cm, 3 * cm, preserveAspectRatio=True
+        resources.draw_image(
+            canvas, LOGO_EPC, doc.leftMargin, doc.height - 1.5 * cm, 5 * cm, 3 * cm, preserveAspectRatio=True
         )
-        canvas.drawImage(
-            LOGO_ESNE, doc.width - 2.5 * cm, doc.height - 1.2 * cm, 5 * cm, 3.3 * cm, preserveAspectRatio=True
+        resources.draw_image(
+            canvas, LOGO_ESNE, doc.width - 2.5 * cm, doc.height - 1.2 * cm, 5 * cm, 3.3 * cm,
+            preserveAspectRatio=True
         )
 
         # Footer
         canvas.line(doc.leftMargin, 1 * cm, doc.width + doc.leftMargin, 1 * cm)
-        footer = Paragraph(settings.PDF_FOOTER_TEXT, style_footer)
-        w, h = footer.wrap(doc.width, doc.bottomMargin)
-        footer.drawOn(canvas, doc.leftMargin, h)
+        resources.draw_footer(canvas, doc.leftMargin, doc.width, doc.bottomMargin)
         canvas.restoreState()
 
     def header_cifom(self, canvas, doc):
         canvas.saveState()
         top = doc.height - 1.5 * cm
         logo_height = 1.5 * cm
-        canvas.drawImage(
-            LOGO_CIFOM, doc.leftMargin, top, 1.7 * cm, logo_height, preserveAspectRatio=True
+        resources.draw_image(
+            canvas, LOGO_CIFOM, doc.leftMargin, top, 1.7 * cm, logo_height, preserveAspectRatio=True
         )
-        canvas.drawImage(
-            LOGO_CPLN, doc.leftMargin + 2.4 * cm, top, 1.5 * cm, logo_height, preserveAspectRatio=True
+        resources.draw_image(
+            canvas, LOGO_CPLN, doc.leftMargin + 2.4 * cm, top, 1.5 * cm, logo_height, preserveAspectRatio=True
         )
-        canvas.drawImage(
-            LOGO_CPMB, doc.leftMargin + 4.6 * cm, top, 3.6 * cm, logo_height, preserveAspectRatio=True
+        resources.draw_image(
+            canvas, LOGO_CPMB, doc.leftMargin + 4.6 * cm, top, 3.6 * cm, logo_height, preserveAspectRatio=True
         )
         canvas.restoreState()
 
@@ -98,6 +319,9 @@ class EpcBaseDocTemplate(SimpleDocTemplate):
         return Preformatted(text, style, maxLineLength=maxLineLength)
 
     def add_address(self, person):
+        # person is a model instance, or a dict of its data
+        if isinstance(person, dict):
+            person = SimpleNamespace(**person)
         self.story.append(Spacer(0, 2 * cm))
         self.story.append(Paragraph(person.civility, style_adress))
         self.story.append(Paragraph(person.full_name, style_adress))
@@ -111,6 +335,7 @@ class EpcBaseDocTemplate(SimpleDocTemplate):
 class ChargeSheetPDF(EpcBaseDocTemplate):
     """
     Génération des feuilles de charges en pdf.
+    `teacher` and `activities` are plain dicts (see PrintChargeSheet).
     """
     def __init__(self, out, teacher):
         self.teacher = teacher
@@ -126,12 +351,12 @@ class ChargeSheetPDF(EpcBaseDocTemplate):
         self.story.append(HorLine(450))
         self.story.append((Paragraph('Total HyperPlanning: {} pér.'.format(tot_hyperplanning), style_smallx)))
         data = [
-            ["Report de l'année précédente", '{0:3d} pér.'.format(self.teacher.previous_report)],
+            ["Report de l'année précédente", '{0:3d} pér.'.format(self.teacher['previous_report'])],
             ['Mandats', '{0:3d} pér.'.format(activities['tot_mandats'])],
         ]
 
         for act in activities['mandats']:
-            data.append(['    * {0} ({1} pér.)'.format(act.subject, act.period)])
+            data.append(['    * {0} ({1} pér.)'.format(act['subject'], act['period'])])
 
         data.extend([
             ['Enseignement (coef.2)',
@@ -178,9 +403,13 @@ class ChargeSheetPDF(EpcBaseDocTemplate):
 class UpdateDataFormPDF(EpcBaseDocTemplate):
     """
     Génération des formulaires PDF de mise à jour des données.
+    `klass` is a plain dict (see PrintUpdateForm). The static parts of the form
+    are laid out once (see update_form_layout), only the values of the fields
+    are drawn for each student.
     """
     def __init__(self, out, return_date):
         super().__init__(out)
+        self.return_date = return_date
         self.text = (
             "Afin de mettre à jour nos bases de données, nous vous serions reconnaissant "
             "de contrôler les données ci-dessous qui vous concernent selon votre filière "
@@ -191,90 +420,100 @@ class UpdateDataFormPDF(EpcBaseDocTemplate):
         ) % django_format(return_date, 'l j F')
         self.underline = '__________________________________'
 
-    def produce(self, klass):
-        self.story = []
-        header = open(LOGO_EPC_LONG, 'rb')
-        for student in klass.student_set.filter(archived=False):
-            self.story.append(Image(header, width=520, height=75))
-            self.story.append(Spacer(0, 2 *cm))
-            destinataire = '{0}<br/>{1}<br/>{2}'.format(student.civility, student.full_name, student.klass)
-            self.story.append(Paragraph(destinataire, style_adress))
-            self.story.append(Spacer(0, 2*cm))
-            self.story.append(Paragraph('{0},<br/>'.format(student.civility), style_normal))
-            self.story.append(Paragraph(self.text, style_normal))
-            self.story.append(Spacer(0, 2*cm))
-
-            data = [['Données enregistrées', 'Données corrigées et/ou complétées']]
-            t = Table(data, colWidths=[8*cm, 8*cm])
-            t.setStyle(TableStyle([
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold'),
-            ]))
-            t.hAlign = TA_CENTER
-            self.story.append(t)
+    def form_story(self, corp_required, instr_required, values):
+        story = [
+            Logo(LOGO_EPC_LONG, width=520, height=75),
+            Spacer(0, 2 * cm),
+            text_field(values['civility'], style_adress),
+            text_field(values['full_name'], style_adress),
+            text_field(values['klass'], style_adress),
+            Spacer(0, 2 * cm),
+            text_field(values['salutation'], style_normal),
+            Paragraph(self.text, style_normal),
+            Spacer(0, 2 * cm),
+        ]
 
-            # Personal data
-            data = [
-                ['NOM', student.last_name, self.underline],
-                ['PRENOM', student.first_name, self.underline],
-                ['ADRESSE', student.street, self.underline],
-                ['LOCALITE', student.pcode_city, self.underline],
-                ['MOBILE', student.mobile, self.underline],
-                ['CLASSE', student.klass, self.underline],
-                ['', '', ''],
-            ]
+        data = [['Données enregistrées', 'Données corrigées et/ou complétées']]
+        t = Table(data, colWidths=[8*cm, 8*cm])
+        t.setStyle(TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold'),
+        ]))
+        t.hAlign = TA_CENTER
+        story.append(t)
 
-            # Corporation data
-            if self.is_corp_required(student.klass.name):
-                if student.corporation is None:
-                    data.extend([
-                        ["Données de l'Employeur", '', ''],
-                        ['NOM', '', self.underline],
-                        ['ADRESSE', '', self.underline],
-                        ['LOCALITE', '', self.underline],
-                        ['', '', '']
-                    ])
-                else:
-                    data.extend([
-                        ["Données de l'Employeur", '', ''],
-                        ['NOM', student.corporation.name, self.underline],
-                        ['ADRESSE', student.corporation.street, self.underline],
-                        ['LOCALITE', student.corporation.pcode_city, self.underline],
-                        ['', '', '']
-                    ])
-
-            # Instructor data
-            if self.is_instr_required(student.klass.name):
-                if student.instructor is None:
-                    data.extend([
-                        ['Données du FEE/FPP (personne de contact pour les informations)', '', ''],
-                        ['NOM', '', self.underline],
-                        ['PRENOM', '', self.underline],
-                        ['TELEPHONE', '', self.underline],
-                        ['E-MAIL', '', self.underline],
-                    ])
-                else:
-                    data.extend([
-                        ['Données du FEE/FPP (personne de contact pour les informations)', '', ''],
-                        ['NOM', student.instructor.last_name, self.underline],
-                        ['PRENOM', student.instructor.first_name, self.underline],
-                        ['TELEPHONE', student.instructor.tel, self.underline],
-                        ['E-MAIL', student.instructor.email, self.underline],
-                    ])
-
-            t = Table(data, colWidths=[3*cm, 5*cm, 8*cm])
-            t.setStyle(TableStyle([
-                ('ALIGN', (1, 0), (-1, -1), 'LEFT'),
-                ('FONT', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ]))
-            t.hAlign = TA_CENTER
-            self.story.append(t)
-            self.story.append(PageBreak())
-        if len(self.story) == 0:
-            self.story.append(Paragraph("Pas d'élèves dans cette classe", style_normal))
+        # Personal data
+        data = [
+            ['NOM', values['last_name'], self.underline],
+            ['PRENOM', values['first_name'], self.underline],
+            ['ADRESSE', values['street'], self.underline],
+            ['LOCALITE', values['pcode_city'], self.underline],
+            ['MOBILE', values['mobile'], self.underline],
+            ['CLASSE', values['klass'], self.underline],
+            ['', '', ''],
+        ]
 
-        self.build(self.story)
-        header.close()
+        # Corporation data
+        if corp_required:
+            data.extend([
+                ["Données de l'Employeur", '', ''],
+                ['NOM', values['corp_name'], self.underline],
+                ['ADRESSE', values['corp_street'], self.underline],
+                ['LOCALITE', values['corp_pcode_city'], self.underline],
+                ['', '', '']
+            ])
+
+        # Instructor data
+        if instr_required:
+            data.extend([
+                ['Données du FEE/FPP (personne de contact pour les informations)', '', ''],
+                ['NOM', values['instr_last_name'], self.underline],
+                ['PRENOM', values['instr_first_name'], self.underline],
+                ['TELEPHONE', values['instr_tel'], self.underline],
+                ['E-MAIL', values['instr_email'], self.underline],
+            ])
+
+        t = Table(data, colWidths=[3*cm, 5*cm, 8*cm])
+        t.setStyle(TableStyle([
+            ('ALIGN', (1, 0), (-1, -1), 'LEFT'),
+            ('FONT', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ]))
+        t.hAlign = TA_CENTER
+        story.append(t)
+        return story
+
+    def field_values(self, student, klass_name):
+        corporation = student['corporation'] or {}
+        instructor = student['instructor'] or {}
+        return {
+            'civility': student['civility'],
+            'full_name': student['full_name'],
+            'klass': klass_name,
+            'salutation': '{0},'.format(student['civility']),
+            'last_name': student['last_name'],
+            'first_name': student['first_name'],
+            'street': student['street'],
+            'pcode_city': student['pcode_city'],
+            'mobile': student['mobile'],
+            'corp_name': corporation.get('name'),
+            'corp_street': corporation.get('street'),
+            'corp_pcode_city': corporation.get('pcode_city'),
+            'instr_last_name': instructor.get('last_name'),
+            'instr_first_name': instructor.get('first_name'),
+            'instr_tel': instructor.get('tel'),
+            'instr_email': instructor.get('email'),
+        }
+
+    def produce(self, klass):
+        if not klass['students']:
+            self.build([Paragraph("Pas d'élèves dans cette classe", style_normal)])
+            return
+        layout = update_form_layout(
+            self.is_corp_required(klass['name']), self.is_instr_required(klass['name']), self.return_date
+        )
+        render_overlay(self.filename, [
+            (layout, self.field_values(student, klass['name'])) for student in klass['students']
+        ])
 
     def is_corp_required(self, klass_name):
         return any(el in klass_name for el in ['FE', 'EDS', 'EDEpe'])
@@ -293,7 +532,30 @@ class CompensationForm:
     OTP_EDE_PS_OTP = "CIFO01.03.02.07.02.01"
     OTP_EDE_PE_OTP = "CIFO01.03.02.07.01.01"
 
-    def add_private_data(self, person):
+    def private_values(self, person):
+        """Values of the private data fields of `person` (see add_private_data)."""
+        return {
+            'last_name': person.last_name or self.points,
+            'first_name': person.first_name or self.points,
+            'street': person.street,
+            'pcode_city': person.pcode_city if person.pcode else '',
+            'birth_date': django_format(person.birth_date, 'j F Y') if person.birth_date else '',
+            'nation': person.nation or '',
+            'tel': person.tel or '',
+            'avs': person.avs or '',
+            'employer': person.corporation.name if person.corporation else '',
+            'iban': person.iban or '',
+            'bank': person.bank or '',
+        }
+
+    def otp(self, student):
+        if student.klass.is_Ede_pe():
+            return self.OTP_EDE_PE_OTP
+        elif student.klass.is_Ede_ps():
+            return self.OTP_EDE_PS_OTP
+        return ''
+
+    def add_private_data(self, values):
         self.story.append(Spacer(0, 0.5 * cm))
         style = PS(name='Title1', fontName='Helvetica', fontSize=12, alignment=TA_CENTER)
         self.story.append(Paragraph('INDEMNISATION D’EXPERTS', style))
@@ -301,27 +563,26 @@ class CompensationForm:
         data = [
             [self.formating('ECOLE :', style=style_bold), 'École Santé-social Pierre-Coullery', '', ''],
             [Paragraph('<u>COORDONNÉES DE L’EXPERT</u>', style=style_bold), '', '', ''],
-            [self.formating('NOM : '), person.last_name or self.points, '', ''],
-            [self.formating('Prénom :'), person.first_name or self.points, '', ''],
-            [self.formating('Adresse complète :'), person.street, '', ''],
-            ['', person.pcode_city if person.pcode else '', '', ''],
+            [self.formating('NOM : '), values['last_name'], '', ''],
+            [self.formating('Prénom :'), values['first_name'], '', ''],
+            [self.formating('Adresse complète :'), values['street'], '', ''],
+            ['', values['pcode_city'], '', ''],
             ['', '', '', ''],
             [
-                self.formating('Date de naissance :'),
-                django_format(person.birth_date, 'j F Y') if person.birth_date else '',
-                self.formating('Nationalité :'), person.nation or '',
+                self.formating('Date de naissance :'), values['birth_date'],
+                self.formating('Nationalité :'), values['nation'],
             ],
             [
-                self.formating('N° de téléphone :'), person.tel or '',
+                self.formating('N° de téléphone :'), values['tel'],
                 self.formating('Si étranger, joindre copie permis de séjour', style=style_bold, maxLineLength=None), ''
             ],
             [
-                self.formating('N° AVS :'), person.avs or '',
-                self.formating('Employeur :'), Paragraph(person.corporation.name if person.corporation else '', style=style_normal),
+                self.formating('N° AVS :'), values['avs'],
+                self.formating('Employeur :'), text_field(values['employer'], style_normal, lines=2),
             ],
             [Paragraph('<u>COORDONNÉES DE PAIEMENT</u>', style=style_bold), '', '', ''],
-            [Paragraph('N° de ccp ou compte bancaire (<b>IBAN</b>) :', style_normal), person.iban or '', '', ''],
-            [Paragraph('Si banque, nom et adresse de celle-ci :', style_normal), person.bank or '', '', ''],
+            [Paragraph('N° de ccp ou compte bancaire (<b>IBAN</b>) :', style_normal), values['iban'], '', ''],
+            [Paragraph('Si banque, nom et adresse de celle-ci :', style_normal), values['bank'], '', ''],
         ]
 
         t = Table(data, colWidths=[4 * cm, 4 * cm, 2 * cm, 6 * cm], hAlign=TA_LEFT)
@@ -344,19 +605,7 @@ class CompensationForm:
         self.story.append(t)
         self.story.append(Spacer(0, 0.5 * cm))
 
-    def add_accounting_stamp(self, student, mandat=None):
-        account = otp = ''
-        total = self.AMOUNT
-        if mandat == self.EXPERT_MANDAT:
-            account = self.EXPERT_ACCOUNT
-        elif mandat == self.MENTOR_MANDAT:
-            account = self.MENTOR_ACCOUNT
-
-        if student.klass.is_Ede_pe():
-            otp = self.OTP_EDE_PE_OTP
-        elif student.klass.is_Ede_ps():
-            otp = self.OTP_EDE_PS_OTP
-
+    def add_accounting_stamp(self, otp, mandat=None):
         self.story.append(Spacer(0, 0.5 * cm))
         if mandat == self.EXPERT_MANDAT:
             data = [
@@ -382,10 +631,20 @@ class CompensationForm:
             self.story.append(Spacer(0, 2 * cm))
 
         self.story.append(Spacer(0, 1.5 * cm))
-        self.story.append(Paragraph(
-            f'Veuillez indiquer l’OTP (champ obligatoire): {otp}',
-            style_normal
-        ))
+        t = Table(
+            [[
+                Paragraph('Veuillez indiquer l’OTP (champ obligatoire):', style_normal),
+                text_field(otp, style_normal),
+            ]],
+            colWidths=[5.5 * cm, 10 * cm], hAlign='LEFT'
+        )
+        t.setStyle(TableStyle([
+            ('LEFTPADDING', (0, 0), (-1, -1), 0),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+            ('TOPPADDING', (0, 0), (-1, -1), 0),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 0),
+        ]))
+        self.story.append(t)
         self.story.append(Spacer(0, 1.5 * cm))
         self.story.append(Paragraph(
             'Date et signature de la direction de l’établissement ou du/de la responsable',
@@ -425,6 +684,24 @@ class ExpertEdeLetterPdf(CompensationForm, EpcBaseDocTemplate):
             PageTemplate(id='ISOPage', frames=[self.page_frame], onPage=self.header_cifom),
         ])
 
+    @classmethod
+    def cache_data(cls, exam):
+        letter = cls(None, exam)
+        expert, internal_expert, student = exam.external_expert, exam.internal_expert, exam.student
+        return {
+            'date': date.today(),
+            'resp_filiere': [cls.resp_filiere, cls.resp_genre],
+            'expert': [
+                expert.civility, expert.full_name, expert.street, expert.pcode_city, expert.adjective_ending,
+            ],
+            'private_data': letter.private_values(expert),
+            'internal_expert': [internal_expert.civility, internal_expert.full_name, internal_expert.role],
+            'student': [student.civility, student.full_name, str(student.klass)],
+            'otp': letter.otp(student),
+            'date_exam': exam.date_exam,
+            'room': exam.room,
+        }
+
     def exam_data(self):
         return {
             'expert': self.exam.external_expert,
@@ -487,7 +764,7 @@ class ExpertEdeLetterPdf(CompensationForm, EpcBaseDocTemplate):
         self.story.append(NextPageTemplate('ISOPage'))
         self.story.append(PageBreak())
 
-        self.add_private_data(exam_data['expert'])
+        self.add_private_data(self.private_values(exam_data['expert']))
 
         self.story.append(Paragraph(
             "Mandat: Soutenance de {0} {1}, classe {2}".format(
@@ -499,7 +776,7 @@ class ExpertEdeLetterPdf(CompensationForm, EpcBaseDocTemplate):
         ))
         self.story.append(Spacer(0, 2 * cm))
 
-        self.add_accounting_stamp(self.exam.student, self.EXPERT_MANDAT)
+        self.add_accounting_stamp(self.otp(self.exam.student), self.EXPERT_MANDAT)
 
         self.build(self.story)
 
@@ -520,35 +797,57 @@ class ExpertEdsLetterPdf(ExpertEdeLetterPdf):
 
 
 class CompensationPDFForm(CompensationForm, EpcBaseDocTemplate):
+    """
+    Formulaire d’indemnisation. The static parts of the form are laid out once
+    (see compensation_layout), only the values of the fields are drawn for each
+    person.
+    """
     def __init__(self, out, *args, **kwargs):
         super().__init__(out, *args, **kwargs)
         self.addPageTemplates([
             PageTemplate(id='FirstPage', frames=[self.page_frame], onPage=self.header_cifom)
         ])
 
-    def produce(self):
-        self.add_private_data(self.expert)
-
-        data = {
-            'student_civility': self.student.civility,
-            'student_fullname': self.student.full_name,
-            'klass': self.student.klass,
-            'date_exam': django_format(self.exam.date_exam, 'j F Y') if self.exam else ''
-        }
+    def form_story(self, values):
+        self.story = []
+        self.add_private_data(values)
         self.story.append(Paragraph('<b>Mandat ou autre type d’indemnité</b> (préciser) :', style_normal))
-        self.story.append(Paragraph(self.mandat_template.format(**data), style_normal))
+        self.story.append(text_field(values['mandat'], style_normal))
         self.story.append(Spacer(0, 0.2 * cm))
         self.story.append(Paragraph(
             '<b>Examen</b>, type d’épreuve et date-s (rédaction, surveillance, correction, travail diplôme, nombre, etc) :',
             style_normal
         ))
-        self.story.append(Paragraph(self.examen_template.format(**data), style_normal))
+        self.story.append(text_field(values['examen'], style_normal, lines=2))
 
         self.story.append(Spacer(0, 0.2 * cm))
 
-        self.add_accounting_stamp(self.student, self.mandat_type)
+        self.add_accounting_stamp(values['otp'], self.mandat_type)
+        return self.story
 
-        self.build(self.story)
+    def compensation_values(self, expert, student, exam=None):
+        data = {
+            'student_civility': student.civility,
+            'student_fullname': student.full_name,
+            'klass': student.klass,
+            'date_exam': django_format(exam.date_exam, 'j F Y') if exam else ''
+        }
+        return {
+            **self.private_values(expert),
+            'mandat': self.mandat_template.format(**data),
+            'examen': self.examen_template.format(**data),
+            'otp': self.otp(student),
+        }
+
+    @classmethod
+    def cache_data(cls, obj):
+        return cls(None, obj).field_values()
+
+    def layout_page(self):
+        return compensation_layout(self.__class__), self.field_values()
+
+    def produce(self):
+        render_overlay(self.filename, [self.layout_page()])
 
 
 class MentorCompensationPdfForm(CompensationPDFForm):
@@ -557,12 +856,13 @@ class MentorCompensationPdfForm(CompensationPDFForm):
     examen_template = ""
     AMOUNT = ''
 
-    def __init__(self, out, student):
+    def __init__(self, out, student=None):
         self.student = student
-        self.expert = student.mentor
-        self.exam = None
         super().__init__(out)
 
+    def field_values(self):
+        return self.compensation_values(self.student.mentor, self.student)
+
 
 class EntretienProfCompensationPdfForm(CompensationPDFForm):
     mandat_type = CompensationPDFForm.EXPERT_MANDAT
@@ -573,12 +873,13 @@ class EntretienProfCompensationPdfForm(CompensationPDFForm):
     )
     AMOUNT = ''
 
-    def __init__(self, out, exam):
-        self.student = exam.student
-        self.expert = exam.external_expert
+    def __init__(self, out, exam=None):
         self.exam = exam
         super().__init__(out)
 
+    def field_values(self):
+        return self.compensation_values(self.exam.external_expert, self.exam.student, self.exam)
+
 
 class SoutenanceCompensationPdfForm(EntretienProfCompensationPdfForm):
     mandat_template = "Expert·e aux examens finaux"
@@ -592,6 +893,7 @@ class SoutenanceCompensationPdfForm(EntretienProfCompensationPdfForm):
 class KlassListPDF(EpcBaseDocTemplate):
     """
     Génération des rôles de classes en pdf.
+    `klass` is a plain dict (see PrintKlassList).
     """
     def __init__(self, out, klass):
         self.klass = klass
@@ -604,7 +906,7 @@ class KlassListPDF(EpcBaseDocTemplate):
     def produce(self, klass):
 
         data = [
-            ['Rôle de classe : {0}'.format(klass.name),
+            ['Rôle de classe : {0}'.format(klass['name']),
              'La Chaux-de-Fonds, le {0}'.format(django_format(date.today(), 'j F Y'))
              ]
         ]
@@ -625,14 +927,14 @@ class KlassListPDF(EpcBaseDocTemplate):
         self.story.append(t)
 
         data = []
-        for index, student in enumerate(klass.student_set.all().filter(archived=False).order_by('last_name', 'first_name')):
+        for index, student in enumerate(klass['students']):
 
             data.append(['{0}.'.format(index + 1),
-                         '{0} {1}'.format(student.last_name, student.first_name),
-                         student.street,
-                         student.pcode_city,
-                         student.mobile])
-            data.append(['', '         Form./Employeur:', student.instructor or ''])
+                         '{0} {1}'.format(student['last_name'], student['first_name']),
+                         student['street'],
+                         student['pcode_city'],
+                         student['mobile']])
+            data.append(['', '         Form./Employeur:', student['instructor']])
             data.append([''])
             data.append([''])
 
@@ -650,7 +952,7 @@ class KlassListPDF(EpcBaseDocTemplate):
         self.story.append(t)
         if len(data) > 52:
             self.story.append(PageBreak())
-            self.story.append(Paragraph("Rôle de classe {0}".format(klass.name), style_bold_title))
+            self.story.append(Paragraph("Rôle de classe {0}".format(klass['name']), style_bold_title))
             self.story.append(Spacer(0, 2 * cm))
 
             t = Table(
@@ -666,3 +968,144 @@ class KlassListPDF(EpcBaseDocTemplate):
             ))
             self.story.append(t)
         self.build(self.story)
+
+
+@lru_cache(maxsize=None)
+def code_version(pdf_class):
+    """Hash of the source of the project modules defining `pdf_class` and its bases."""
+    digest = hashlib.sha1()
+    paths = {
+        inspect.getsourcefile(klass) for klass in pdf_class.__mro__
+        if klass.__module__.split('.')[0] in ('stages', 'candidats')
+    }
+    for path in sorted(paths):
+        with open(path, 'rb') as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def compensation_layout(form_class):
+    doc = form_class(io.BytesIO())
+    return OverlayLayout(form_class.__name__, doc, doc.form_story, on_page=doc.header_cifom)
+
+
+@lru_cache(maxsize=16)
+def update_form_layout(corp_required, instr_required, return_date):
+    doc = UpdateDataFormPDF(io.BytesIO(), return_date)
+    return OverlayLayout(
+        'UpdateDataForm', doc, partial(doc.form_story, corp_required, instr_required)
+    )
+
+
+def render_overlay(out, pages):
+    """
+    Render `pages`, a list of (OverlayLayout, field values) tuples, one page
+    each, into `out`. The background of each layout is drawn once per document
+    as a form XObject, shown on each of its pages.
+    """
+    canvas = Canvas(out, pagesize=A4)
+    for layout, values in pages:
+        if not canvas.hasForm(layout.name):
+            canvas.beginForm(layout.name)
+            layout.draw_background(canvas)
+            canvas.endForm()
+        canvas.doForm(layout.name)
+        layout.draw_fields(canvas, values)
+        canvas.showPage()
+    canvas.save()
+
+
+def render_klass_list(klass):
+    buff = io.BytesIO()
+    KlassListPDF(buff, klass).produce(klass)
+    return buff.getvalue()
+
+
+def render_update_form(klass, return_date):
+    buff = io.BytesIO()
+    UpdateDataFormPDF(buff, return_date).produce(klass)
+    return buff.getvalue()
+
+
+def render_charge_sheet(teacher, activities):
+    buff = io.BytesIO()
+    ChargeSheetPDF(buff, teacher).produce(activities)
+    return buff.getvalue()
+
+
+def warm_up():
+    """Load the ReportLab modules, fonts and logos used by the batch printed documents."""
+    render_klass_list({'name': '', 'students': []})
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def render_pool(processes):
+    """
+    Return the pool of worker processes kept between requests, creating it if
+    needed. Workers are started from a fresh interpreter (spawn), so that they
+    inherit neither the threads and locks nor the database connections of the
+    web process, then set Django up and warm the rendering resources.
+    """
+    global _render_pool
+
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_render_worker,
+            )
+        return _render_pool
+
+
+def discard_render_pool(pool):
+    global _render_pool
+
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+
+def render_documents(tasks):
+    """
+    Generator rendering `tasks`, a list of (render function, args) tuples, where
+    render functions are module-level functions returning the PDF content from
+    plain data. Results are yielded in the tasks order, as soon as available.
+    When settings.PDF_RENDER_PROCESSES > 1, documents are rendered in a pool of
+    worker processes kept between requests (see render_pool). At most two
+    documents per worker are submitted ahead of the consumer, to bound memory
+    usage.
+    """
+    processes = settings.PDF_RENDER_PROCESSES
+    if processes <= 1 or len(tasks) < 2:
+        for func, args in tasks:
+            yield func(*args)
+        return
+    pool = render_pool(processes)
+    remaining = iter(tasks)
+    pending = deque()
+
+    def submit(num):
+        for func, args in islice(remaining, num):
+            pending.append((pool.submit(func, *args), func, args))
+
+    submit(processes * 2)
+    while pending:
+        future, func, args = pending.popleft()
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            # A worker died: render serially, a new pool is created next time.
+            discard_render_pool(pool)
+            yield func(*args)
+            for _, func, args in pending:
+                yield func(*args)
+            for func, args in remaining:
+                yield func(*args)
+            return
+        submit(1)
+        yield result
@@ -0,0 +1,12 @@
+"""
+Initialization of the worker processes rendering batch PDF prints (see
+stages.pdf.render_documents). Kept apart from stages.pdf, which can only be
+imported once Django is set up.
+"""
+import django
+
+
+def init_render_worker():
+    django.setup()
+    from .pdf import warm_up
+    warm_up()
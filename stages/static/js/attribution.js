@@ -13,110 +13,273 @@ function update_periods(section_id) {
     if ($.cookie('periode') != 'undefined')
         sel.val($.cookie('periode'));
 
-    var periode_val = sel.val();
-    update_students(periode_val);
-    update_corporations(periode_val);
-    update_trainings(periode_val);
+    load_period(sel.val());
   });
 }
 
-function update_students(period_id) {
-  $('#student_select').empty();
-  $('#student_filter').empty();
+function rows(columns) {
+  // Convert columnar data (a list of values per field) to a list of objects
+  var fields = Object.keys(columns);
+  var result = [];
+  if (!fields.length) return result;
+  for (var i = 0; i < columns[fields[0]].length; i++) {
+    var row = {};
+    $.each(fields, function(j, field) { row[field] = columns[field][i]; });
+    result.push(row);
+  }
+  return result;
+}
+
+function index_by_id(items) {
+  var index = {};
+  $.each(items, function() { index[this.id] = this; });
+  return index;
+}
+
+function load_period(period_id) {
+  // Students, availabilities, trainings and contacts of the period, in one request
+  if (changes_request !== null) changes_request.abort();
+  period_data = null;
+  if (period_id == '' || period_id == null) {
+    update_students();
+    update_corporations();
+    update_trainings();
+    return;
+  }
+  $.getJSON('/period/' + period_id + '/snapshot/', function(data) {
+    if ($('#period_select').val() != period_id) return;
+    period_data = {
+      id: period_id,
+      version: data.version,
+      students: rows(data.students),
+      availabilities: rows(data.availabilities),
+      trainings: rows(data.trainings),
+      contacts: rows(data.contacts)
+    };
+    period_data.students_by_id = index_by_id(period_data.students);
+    period_data.availabilities_by_id = index_by_id(period_data.availabilities);
+    period_data.trainings_by_id = index_by_id(period_data.trainings);
+    update_students();
+    update_corporations();
+    update_trainings();
+    watch_changes(period_data);
+  });
+}
+
+function watch_changes(data) {
+  // Polling of the period change feed, as long as the period is displayed.
+  // The server holds each request a few seconds, then the next one is delayed
+  // unless changes were received.
+  if (period_data !== data) return;
+  changes_request = $.getJSON('/period/' + data.id + '/changes/', {since: data.version, wait: 1});
+  changes_request.done(function(changes) {
+    var changed = changes.version > data.version;
+    apply_changes(data, changes);
+    if (changed) watch_changes(data);
+    else setTimeout(function() { watch_changes(data); }, CHANGES_POLL_DELAY);
+  }).fail(function(xhr, status) {
+    if (status != 'abort') setTimeout(function() { watch_changes(data); }, CHANGES_POLL_DELAY);
+  });
+}
+
+function fetch_changes() {
+  // Immediately get the changes done by this client
+  var data = period_data;
+  if (data === null) return;
+  $.getJSON('/period/' + data.id + '/changes/', {since: data.version}, function(changes) {
+    apply_changes(data, changes);
+  });
+}
+
+function apply_changes(data, changes) {
+  // Patch the period local state with the trainings saved or deleted since its version
+  if (period_data !== data || changes.version <= data.version) return;
+  function release(training) {
+    var student = data.students_by_id[training.student_id];
+    if (student) student.training_id = null;
+    var avail = data.availabilities_by_id[training.avail_id];
+    if (avail) avail.free = true;
+  }
+  $.each(rows(changes.deleted), function() {
+    var training = data.trainings_by_id[this.id];
+    release(training || this);
+    if (training) {
+      data.trainings.splice(data.trainings.indexOf(training), 1);
+      delete data.trainings_by_id[this.id];
+      $('li#training_' + this.id).remove();
+    }
+  });
+  $.each(rows(changes.trainings), function() {
+    var previous = data.trainings_by_id[this.id];
+    if (previous) {
+      release(previous);
+      data.trainings.splice(data.trainings.indexOf(previous), 1);
+      $('li#training_' + this.id).remove();
+    }
+    var student = data.students_by_id[this.student_id];
+    if (student) student.training_id = this.id;
+    var avail = data.availabilities_by_id[this.avail_id];
+    if (avail) avail.free = false;
+    // Insert the training at its place in the list (sorted by student name)
+    var pos = 0;
+    while (pos < data.trainings.length && data.trainings[pos].student.localeCompare(this.student) <= 0) pos++;
+    data.trainings.splice(pos, 0, this);
+    data.trainings_by_id[this.id] = this;
+    if (pos == 0) $('ul#training_list').prepend(training_item(this));
+    else $('li#training_' + data.trainings[pos - 1].id).after(training_item(this));
+  });
+  data.version = changes.version;
+  render_students();
+  render_corporations();
+  if (data.trainings.length > 0) $('input#export').show();
+  else $('input#export').hide();
+}
+
+function clear_student() {
   $('#student_detail').html('').removeClass("filled");
   current_student = null;
   $('input#valid_training').hide();
-  if (period_id == '') return;
-  $.getJSON('/period/' + period_id + '/students/', function(data) {
-    var sel = $('#student_select');
-    var classes = [];
-    var options = [];
-    $('#student_filter').append($("<option />").val('').text('Toutes les classes'));
-    $.each(data, function() {
-      if (this.training_id == null) {
-        options.push(this);
-        sel.append($("<option />").val(this.id).text(this.name + ' (' + this.klass + ')'));
-      }
-      if ($.inArray(this.klass, classes) < 0) {
-        classes.push(this.klass);
-        $('#student_filter').append($("<option />").val(this.klass).text(this.klass));
-      }
-    });
-    // Keep options as data to enable filtering
-    sel.data('options', options);
-    $('div#student_total').html(options.length + " étudiant-e-s").data('num', options.length);
+}
+
+function update_students() {
+  $('#student_select').empty();
+  $('#student_filter').empty();
+  clear_student();
+  if (period_data === null) return;
+  var classes = [];
+  $('#student_filter').append($("<option />").val('').text('Toutes les classes'));
+  $.each(period_data.students, function() {
+    if ($.inArray(this.klass, classes) < 0) {
+      classes.push(this.klass);
+      $('#student_filter').append($("<option />").val(this.klass).text(this.klass));
+    }
   });
+  render_students();
 }
 
-function update_corporations(period_id) {
-  $('#corp_select').empty();
+function render_students() {
+  // Fill the select with the free students, keeping the selected one if still free
+  var sel = $('#student_select');
+  var filter_val = $('#student_filter').val() || '';
+  var options = $.grep(period_data.students, function(student) { return student.training_id == null; });
+  sel.empty();
+  $.each(options, function() {
+    if (this.klass == filter_val || filter_val == '') {
+      sel.append($("<option />").val(this.id).text(this.name + ' (' + this.klass + ')'));
+    }
+  });
+  if (current_student !== null) {
+    if (period_data.students_by_id[current_student].training_id == null) sel.val(current_student);
+    else clear_student();
+  }
+  // Keep options as data to enable filtering
+  sel.data('options', options);
+  $('div#student_total').html(options.length + " étudiant-e-s").data('num', options.length);
+}
+
+function clear_corporation() {
   $('#corp_detail').html('').removeClass("filled");
   current_avail = null;
   $('#contact_select').find('option:gt(0)').remove();
   $('input#valid_training').hide();
-  if (period_id == '') {
+}
+
+function update_corporations() {
+  $('#corp_select').empty();
+  clear_corporation();
+  if (period_data === null) {
       $('input#export_non_attr').hide();
       return;
   }
-  $.getJSON('/period/' + period_id + '/corporations/', function(data) {
-    var sel = $('#corp_select');
-    var domains = [];
-    var options = [];
-    $('#corp_filter').empty().append($("<option />").val('').text('Tous les domaines'));
-    // data contains availabilities (id is availability not corporation)
-    $.each(data, function() {
-      if (this.free) {
-        options.push(this);
-        var new_opt = $("<option />").val(this.id).text(this.corp_name).data('idCorp', this.id_corp);
-        if (this.priority) new_opt.addClass('priority');
-        sel.append(new_opt);
-      }
-      if ($.inArray(this.domain, domains) < 0) {
-        domains.push(this.domain);
-        $('#corp_filter').append($("<option />").val(this.domain).text(this.domain));
-      }
-    });
-    sel.data('options', options);
-    if (options.length > 0) $('input#export_non_attr').show();
-    else $('input#export_non_attr').hide();
-    $('div#corp_total').html(options.length + " disponibilités").data('num', options.length);
+  var domains = [];
+  $('#corp_filter').empty().append($("<option />").val('').text('Tous les domaines'));
+  $.each(period_data.availabilities, function() {
+    if ($.inArray(this.domain, domains) < 0) {
+      domains.push(this.domain);
+      $('#corp_filter').append($("<option />").val(this.domain).text(this.domain));
+    }
   });
+  render_corporations();
 }
 
-function update_trainings(period_id) {
-  function set_export_visibility() {
-      if ($('ul#training_list').children().length > 0)
-        $('input#export').show();
-      else $('input#export').hide();
+function render_corporations() {
+  // Fill the select with the free availabilities, keeping the selected one if still free
+  var sel = $('#corp_select');
+  var filter_val = $('#corp_filter').val() || '';
+  var options = $.grep(period_data.availabilities, function(avail) { return avail.free; });
+  sel.empty();
+  // id is availability not corporation
+  $.each(options, function() {
+    if (this.domain == filter_val || filter_val == '') {
+      var new_opt = $("<option />").val(this.id).text(this.corp_name).data('idCorp', this.id_corp);
+      if (this.priority) new_opt.addClass('priority');
+      sel.append(new_opt);
+    }
+  });
+  if (current_avail !== null) {
+    if (period_data.availabilities_by_id[current_avail].free) sel.val(current_avail);
+    else clear_corporation();
   }
+  sel.data('options', options);
+  if (options.length > 0) $('input#export_non_attr').show();
+  else $('input#export_non_attr').hide();
+  $('div#corp_total').html(options.length + " disponibilités").data('num', options.length);
+}
+
+function training_item(training) {
+  var list = $('ul#training_list');
+  var li = $('<li />').attr('id', 'training_' + training.id).text(
+    training.student + ' (' + training.klass + ') - ' + training.corp_name + ' - ' + training.domain + ' '
+  );
+  if (training.referent) li.append(document.createTextNode(' (réf: ' + training.referent + ')'));
+  else li.append('- ', $('<span class="missing" />').text('Pas de référent'));
+  if (training.contact) li.append(document.createTextNode(' (cont: ' + training.contact + ')'));
+  else li.append('- ', $('<span class="missing" />').text('Pas de contact'));
+  var change_url = list.data('changeUrl').replace('/0/', '/' + training.id + '/');
+  li.append(
+    '&nbsp;&nbsp;',
+    $('<a class="edit_training" />').attr('href', change_url).append(
+      $('<img />').attr('src', list.data('changeIcon'))
+    ),
+    ' ',
+    $('<img class="delete_training" />').attr('src', list.data('deleteIcon'))
+  );
+  return li;
+}
 
-  if (period_id == '') {
-      $('ul#training_list').html('');
+function update_trainings() {
+  var list = $('ul#training_list').empty();
+  $('div#assignment_preview').hide();
+  if (period_data === null) $('input#propose_assignment').hide();
+  else $('input#propose_assignment').show();
+  if (period_data === null || period_data.trainings.length == 0) {
       $('input#export').hide();
-  } else $('ul#training_list').load('/training/by_period/' + period_id + '/', function() {
-      $('img.delete_training').click(function() {
-        if (!confirm("Voulez-vous vraiment supprimer cette pratique professionnelle ?")) return;
-        var li = $(this).parents('li');
-        $.post('/training/del/',
-          {pk: li.attr('id').split('_')[1],
-           csrfmiddlewaretoken: $("input[name='csrfmiddlewaretoken']").val()}, function(data) {
-            li.remove();
-            // dispatch student and corp in their listings
-            update_students($('#period_select').val());
-            update_corporations($('#period_select').val());
-            set_export_visibility();
-            // Decrement referent number
-            var referent = $('#referent_select option[value="' + data.ref_id + '"]')
-            var parsed = referent.text().match(/(.*)\((\d+)\)/);
-            referent.text(parsed[1] +' (' + (parseInt(parsed[2]) - 1) + ')');
-        });
-      });
-      $('a.edit_training').click(function(ev) {
-        ev.preventDefault();
-        showAddAnotherPopup(this);
-      });
-      set_export_visibility();
+      return;
+  }
+  $.each(period_data.trainings, function() { list.append(training_item(this)); });
+  $('input#export').show();
+}
+
+function show_assignment(proposals) {
+  // Preview of the proposed assignment, each proposal can be unchecked before acceptance
+  var body = $('div#assignment_preview tbody').empty();
+  $.each(proposals, function() {
+    var remarks = [];
+    if (this.priority) remarks.push('prioritaire');
+    if (this.domain_repeats) remarks.push('domaine déjà pratiqué');
+    if (this.corp_repeats) remarks.push('institution déjà fréquentée');
+    var check = $('<input type="checkbox" checked />').data('item', {
+      student: this.student_id, avail: this.avail_id, referent: null, contact: this.contact_id
+    });
+    body.append($('<tr />').append(
+      $('<td />').append(check),
+      $('<td />').text(this.student + ' (' + this.klass + ')'),
+      $('<td />').text(this.corp_name),
+      $('<td />').text(this.domain),
+      $('<td />').text(remarks.join(', '))
+    ));
   });
+  $('div#assignment_preview').show();
 }
 
 $(document).ready(function() {
@@ -130,12 +293,38 @@ $(document).ready(function() {
 
   $('#period_select').change(function(ev) {
     // Update student/corporation list when period is modified
-    update_students($(this).val());
-    update_corporations($(this).val());
-    update_trainings($(this).val());
+    load_period($(this).val());
     $.cookie('periode', $(this).val(), { expires: 7 });
   });
 
+  $('ul#training_list').on('click', 'img.delete_training', function() {
+    if (!confirm("Voulez-vous vraiment supprimer cette pratique professionnelle ?")) return;
+    var li = $(this).parents('li');
+    $.post('/training/del/',
+      {pk: li.attr('id').split('_')[1],
+       csrfmiddlewaretoken: $("input[name='csrfmiddlewaretoken']").val()}, function(data) {
+        // dispatch student and corp in their listings
+        fetch_changes();
+        // Decrement referent number
+        var referent = $('#referent_select option[value="' + data.ref_id + '"]')
+        var parsed = referent.text().match(/(.*)\((\d+)\)/);
+        if (parsed) referent.text(parsed[1] +' (' + (parseInt(parsed[2]) - 1) + ')');
+    });
+  });
+  $('#student_detail').on('click', 'ul#suggestions_list li', function() {
+    // Select the suggested availability, showing all domains
+    var avail_id = $(this).data('avail');
+    var avail = period_data !== null ? period_data.availabilities_by_id[avail_id] : null;
+    if (!avail || !avail.free) return;
+    $('#corp_filter').val('');
+    render_corporations();
+    $('#corp_select').val(avail_id).change();
+  });
+  $('ul#training_list').on('click', 'a.edit_training', function(ev) {
+    ev.preventDefault();
+    showAddAnotherPopup(this);
+  });
+
   $('#student_filter').change(function(ev) {
     var sel = $('#student_select');
     var options = sel.data('options');
@@ -188,15 +377,16 @@ $(document).ready(function() {
     var sel = $('#contact_select');
     sel.html('<option value="">-------</option>');
     var id_corp = $(this).find("option:selected").data('idCorp');
-    if (id_corp) {
-        $.getJSON('/corporation/' + id_corp + '/contacts/', function(data) {
-            $.each(data, function(key, contact) {
-                var item = contact.first_name + ' ' + contact.last_name;
-                if (contact.role.length) item += ' (' + contact.role + ')';
-                sel.append($("<option />").val(contact.id).text(item));
-            });
-            if (data.length == 1) sel.val(data[0].id);
+    if (id_corp && period_data !== null) {
+        var contacts = $.grep(period_data.contacts, function(contact) {
+            return contact.corporation_id == id_corp;
         });
+        $.each(contacts, function(key, contact) {
+            var item = contact.first_name + ' ' + contact.last_name;
+            if (contact.role.length) item += ' (' + contact.role + ')';
+            sel.append($("<option />").val(contact.id).text(item));
+        });
+        if (contacts.length == 1) sel.val(contacts[0].id);
     }
   });
 
@@ -211,19 +401,6 @@ $(document).ready(function() {
             alert(data);
             return;
           }
-          // Clear selected student/corp
-          $('option:selected', '#student_select').remove();
-          var prev_num = $('div#student_total').data('num');
-          $('div#student_total').html((prev_num - 1) + " étudiant-e-s").data('num', prev_num - 1);
-          $('#student_detail').html('').removeClass("filled");
-          $('option:selected', '#corp_select').remove();
-          prev_num = $('div#corp_total').data('num');
-          $('div#corp_total').html((prev_num - 1) + " disponibilités").data('num', prev_num - 1);
-          $('#corp_detail').html('').removeClass("filled");
-          current_student = null;
-          current_avail = null;
-          $('input#valid_training').hide();
-
           // Update referent select
           var parsed = $('#referent_select option:selected').text().match(/(.*)\((\d+)\)/);
           if (parsed) {
@@ -232,11 +409,43 @@ $(document).ready(function() {
           }
           $('#contact_select').val('');
 
-          update_trainings($('#period_select').val());
+          fetch_changes();
         }
     );
   });
 
+  $('input#propose_assignment').click(function() {
+    if (period_data === null) return;
+    $.getJSON('/period/' + period_data.id + '/assignment/', function(data) {
+      var proposals = rows(data);
+      if (proposals.length == 0) alert("Aucune attribution possible pour cette période.");
+      else show_assignment(proposals);
+    });
+  });
+  $('input#accept_assignment').click(function() {
+    var items = $('div#assignment_preview tbody input:checked').map(function() {
+      return $(this).data('item');
+    }).get();
+    if (items.length == 0) return;
+    $.ajax({
+      url: '/training/batch/', type: 'POST', dataType: 'json',
+      contentType: 'application/json', data: JSON.stringify({create: items}),
+      headers: {'X-CSRFToken': $("input[name='csrfmiddlewaretoken']").val()}
+    }).done(function(results) {
+      var errors = $.grep(results.create, function(result) { return result.error; });
+      if (errors.length) {
+        alert(errors.length + " attribution(s) refusée(s) :\n" + $.map(errors, function(result) {
+          return result.error;
+        }).join('\n'));
+      }
+      $('div#assignment_preview').hide();
+      fetch_changes();
+    });
+  });
+  $('input#cancel_assignment').click(function() {
+    $('div#assignment_preview').hide();
+  });
+
   $('input#export').click(function(ev) {
     ev.preventDefault();
     $('form#list_export').find('input#period').val($('#period_select').val());
@@ -257,3 +466,7 @@ $(document).ready(function() {
 
 var current_student = null;
 var current_avail = null;
+var period_data = null;
+var changes_request = null;
+// Delay (ms) before the next change feed request when nothing changed
+var CHANGES_POLL_DELAY = 5000;
@@ -0,0 +1,121 @@
+"""
+Ranking of the free availabilities of a period for a student (attribution
+screen, StudentSummaryView).
+
+The features of the free availabilities of a period are computed once as
+NumPy arrays and kept in memory until the availabilities, trainings,
+corporations or domains change (see data_versions), so that ranking them for
+a student only needs the student previous trainings and postal code.
+
+Distances between postal codes (NPA) are computed between the approximate
+locality coordinates of data/npa_centroids.csv (localities of the canton of
+Neuchâtel and of the main neighbouring towns). Unknown postal codes are placed
+at the mean of the known ones of the same area (same two first digits).
+"""
+import csv
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from .assignment import CORPORATION_REPEAT_COST, DOMAIN_REPEAT_COST, NON_PRIORITY_COST
+from .models import Availability, Corporation, Domain, Training, data_versions
+
+NPA_CENTROIDS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'npa_centroids.csv')
+
+# Cost of a kilometre between the student and the corporation (10 km are worth a priority availability)
+DISTANCE_COST = 0.1
+# Distance considered when a postal code is unknown
+UNKNOWN_DISTANCE = 30
+SUGGESTIONS_LIMIT = 5
+
+
+@lru_cache(maxsize=None)
+def npa_centroids():
+    """Return a {postal code: (latitude, longitude)} dict, including two digits area prefixes."""
+    with open(NPA_CENTROIDS_PATH, encoding='utf-8') as fh:
+        centroids = {row['npa']: (float(row['lat']), float(row['lon'])) for row in csv.DictReader(fh)}
+    areas = {}
+    for npa, coords in centroids.items():
+        areas.setdefault(npa[:2], []).append(coords)
+    for area, coords in areas.items():
+        centroids[area] = tuple(np.mean(coords, axis=0))
+    return centroids
+
+
+def npa_coordinates(pcode):
+    """Return the (latitude, longitude) of the postal code `pcode`, or None when unknown."""
+    pcode = (pcode or '').strip()
+    if len(pcode) != 4:
+        return None
+    centroids = npa_centroids()
+    return centroids.get(pcode) or centroids.get(pcode[:2])
+
+
+class PeriodFeatures:
+    """Features of the free availabilities of a period, as arrays."""
+    def __init__(self, period_id):
+        avails = list(Availability.objects.filter(period_id=period_id, training__isnull=True).select_related(
+            'corporation', 'domain'
+        ).order_by('corporation__name'))
+        self.avails = [{
+            'id': avail.pk, 'corporation': avail.corporation.name, 'city': avail.corporation.city,
+            'domain': avail.domain.name, 'priority': avail.priority,
+        } for avail in avails]
+        self.domain_ids = np.array([avail.domain_id for avail in avails])
+        self.corp_ids = np.array([avail.corporation_id for avail in avails])
+        self.non_priority = np.array([not avail.priority for avail in avails])
+        coords = [npa_coordinates(avail.corporation.pcode) for avail in avails]
+        self.coords = np.radians(np.array([c if c is not None else (np.nan, np.nan) for c in coords]).reshape(-1, 2))
+
+    def distances(self, coords):
+        """Return the distances (km, NaN when unknown) of the availabilities to `coords`."""
+        if coords is None:
+            return np.full(len(self.avails), np.nan)
+        lat, lon = np.radians(coords)
+        # Haversine formula
+        hav = (
+            np.sin((self.coords[:, 0] - lat) / 2) ** 2 +
+            np.cos(lat) * np.cos(self.coords[:, 0]) * np.sin((self.coords[:, 1] - lon) / 2) ** 2
+        )
+        return 2 * 6371 * np.arcsin(np.sqrt(hav))
+
+
+@lru_cache(maxsize=8)
+def _period_features(period_id, versions):
+    # `versions` (data versions of the source models) is only part of the cache key.
+    return PeriodFeatures(period_id)
+
+
+def period_features(period_id):
+    return _period_features(period_id, tuple(data_versions(Availability, Training, Corporation, Domain)))
+
+
+def suggest_availabilities(student, period_id, previous_trainings, limit=SUGGESTIONS_LIMIT):
+    """
+    Return the `limit` best free availabilities of the period for `student`,
+    whose `previous_trainings` are (domain id, corporation id) pairs: new
+    corporations first, then new domains, priority availabilities and
+    closest corporations.
+    """
+    features = period_features(period_id)
+    if not features.avails:
+        return []
+    domain_repeats = np.zeros(len(features.avails))
+    corp_repeats = np.zeros(len(features.avails))
+    for domain_id, corp_id in previous_trainings:
+        domain_repeats += features.domain_ids == domain_id
+        corp_repeats += features.corp_ids == corp_id
+    distances = features.distances(npa_coordinates(student.pcode))
+    cost = (
+        CORPORATION_REPEAT_COST * corp_repeats +
+        DOMAIN_REPEAT_COST * domain_repeats +
+        NON_PRIORITY_COST * features.non_priority +
+        DISTANCE_COST * np.where(np.isnan(distances), UNKNOWN_DISTANCE, distances)
+    )
+    best = np.argsort(cost, kind='stable')[:limit]
+    return [dict(
+        features.avails[idx],
+        distance=None if np.isnan(distances[idx]) else int(round(distances[idx])),
+        domain_repeats=int(domain_repeats[idx]), corp_repeats=int(corp_repeats[idx]),
+    ) for idx in best]
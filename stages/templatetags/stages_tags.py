@@ -0,0 +1,10 @@
+from django import template
+
+from ..views.base import pdf_cache_stats as _pdf_cache_stats
+
+register = template.Library()
+
+
+@register.simple_tag
+def pdf_cache_stats():
+    return _pdf_cache_stats()
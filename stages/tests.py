@@ -1,22 +1,56 @@
+import csv
+import io
 import json
 import os
-from datetime import date, datetime
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from openpyxl import load_workbook
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import escape
 
 from candidats.models import Candidate
 from .models import (
     Level, Domain, Section, Klass, Option, Period, Student, Corporation, Availability,
-    CorpContact, Teacher, Training, Course, Examination, ExamEDESession,
+    CorpContact, Teacher, Training, Course, Examination, ExamEDESession, ImportJob,
+    ChargeCalculator, TeacherChargeSnapshot, ExportColumnSet, TrainingChange,
+    IMPUTATION_CHOICES, data_versions,
 )
-from .utils import school_year
+from .admin import ExportColumnSetForm
+from .pdf import discard_render_pool, render_pool, render_update_form
+from .utils import TabularReader, school_year, school_year_start
+from .views import TRAINING_FIELDS
+from .views.base import pdf_cache_stats
+from .views.imports import HPContactsImportView, StudentImportView, run_import_job
 
+# Exports and PDF documents are cached under MEDIA_ROOT: test classes requesting
+# cached views use a temporary one, emptied after each test.
+TEMP_MEDIA_ROOT = tempfile.mkdtemp()
 
+
+def tearDownModule():
+    shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class StagesTests(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -63,7 +97,7 @@ class StagesTests(TestCase):
             title="Stage de pré-sensibilisation", start_date="2012-11-26", end_date="2012-12-07",
             section=sect_ase, level=lev1,
         )
-        p2 = Period.objects.create(
+        cls.p2 = p2 = Period.objects.create(
             title="Stage final", start_date="2013-02-01", end_date="2013-03-15",
             section=sect_ase, level=lev2,
         )
@@ -91,6 +125,9 @@ class StagesTests(TestCase):
 
     def setUp(self):
         self.client.login(username='me', password='mepassword')
+        # Cached data may come from rolled back transactions of other tests
+        cache.clear()
+        self.addCleanup(shutil.rmtree, TEMP_MEDIA_ROOT, ignore_errors=True)
 
     def test_export_stages(self):
         response1 = self.client.get(reverse('stages_export', args=['all']))
@@ -98,19 +135,183 @@ class StagesTests(TestCase):
 
         response2 = self.client.get(reverse('stages_export'), {'period': '2', 'non_attr': '0'})
         self.assertEqual(response2.status_code, 200)
-        self.assertGreater(len(response1.content), len(response2.content))
+        self.assertGreater(
+            len(b''.join(response1.streaming_content)), len(b''.join(response2.streaming_content))
+        )
 
         response3 = self.client.get(reverse('stages_export'), {'period': '1', 'non_attr': '1'})
         self.assertEqual(response2.status_code, 200)
 
+    def test_export_stages_default_contacts(self):
+        """Default and always-cc contacts are filled when trainings have no contact."""
+        def exported_contacts():
+            response = self.client.get(reverse('stages_export'), {'period': self.p2.pk, 'non_attr': '0'})
+            rows = list(load_workbook(io.BytesIO(b''.join(response.streaming_content))).active.values)
+            line = dict(zip(rows[0], rows[1]))
+            return line['Nom contact'], line.get('Courriel contact - copie')
+
+        self.assertEqual(exported_contacts(), ('Horner', None))
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        contact = CorpContact.objects.create(
+            corporation=corp, first_name="Paul", last_name="Cc", email="paul@example.org", always_cc=True,
+        )
+        self.assertEqual(exported_contacts(), ('Horner', None))
+        # The index is updated when sections of a contact change
+        contact.sections.add(Section.objects.get(name='MP_ASE'))
+        self.assertEqual(exported_contacts(), ('Cc', 'paul@example.org'))
+
+    def test_klass_view_constant_queries(self):
+        """The class page and its XLS export cost the same number of queries for any class size."""
+        section = Section.objects.create(name='ASE', has_stages=True)
+        level = Level.objects.get(name='1')
+        option = Option.objects.create(name='Généraliste')
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        domain = Domain.objects.first()
+
+        def create_klass(name, size):
+            klass = Klass.objects.create(name=name, section=section, level=level)
+            period = Period.objects.create(
+                title="Stage", start_date="2013-02-01", end_date="2013-03-15", section=section, level=level,
+            )
+            for idx in range(size):
+                student = Student.objects.create(
+                    first_name="Prénom%d" % idx, last_name="Nom%d" % idx, birth_date="1994-05-12",
+                    klass=klass, option_ase=option, corporation=corp,
+                )
+                Training.objects.create(student=student, availability=Availability.objects.create(
+                    corporation=corp, domain=domain, period=period,
+                ))
+            return klass
+
+        small, big = create_klass('1ASEa', 2), create_klass('1ASEb', 200)
+        for params in ({}, {'format': 'xls'}):
+            with CaptureQueriesContext(connection) as small_ctx:
+                response = self.client.get(reverse('class', args=[small.pk]), params)
+            self.assertEqual(response.status_code, 200)
+            with CaptureQueriesContext(connection) as big_ctx:
+                response = self.client.get(reverse('class', args=[big.pk]), params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(small_ctx.captured_queries), len(big_ctx.captured_queries))
+            if not params:
+                self.assertContains(response, "Nom199")
+
+    def test_export_cache(self):
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root):
+            response = self.client.get(reverse('general-export'))
+            etag = response['ETag']
+            content = b''.join(response.streaming_content)
+            self.assertTrue(response['Content-Disposition'].startswith('attachment; filename=general_export_'))
+            # Second download is served from the cache without querying students
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse('general-export'))
+                self.assertEqual(b''.join(response.streaming_content), content)
+            self.assertEqual(response['ETag'], etag)
+            self.assertFalse([q for q in ctx.captured_queries if 'stages_student' in q['sql']])
+            response = self.client.get(reverse('general-export'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            # Modifying data invalidates the cached file
+            student = Student.objects.get(last_name='Dupond')
+            student.last_name = 'Dupont'
+            student.save()
+            response = self.client.get(reverse('general-export'))
+            self.assertNotEqual(response['ETag'], etag)
+            wb = load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+            self.assertIn('Dupont', [row[1] for row in wb.active.values])
+            # Least recently used files are evicted
+            cache_dir = os.path.join(media_root, 'export_cache')
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            with self.settings(EXPORT_CACHE_MAX_SIZE=1):
+                response = self.client.get(reverse('corporations-export'))
+                response.close()
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_export_institutions_parent(self):
+        parent = Corporation.objects.get(name="Centre pédagogique XY")
+        parent.sector = "Social"
+        parent.save()
+        Corporation.objects.create(name="Crèche Les Moineaux", pcode="2000", city="Neuchâtel", parent=parent)
+        response = self.client.get(reverse('corporations-export'), {'format': 'csv'})
+        lines = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        rows = {line[lines[0].index('Nom')]: line[lines[0].index('Institution mère')] for line in lines[1:]}
+        self.assertEqual(rows["Crèche Les Moineaux"], str(parent))
+        self.assertEqual(rows["Centre pédagogique XY"], '')
+
+    def test_export_definitions(self):
+        column_set = ExportColumnSet.objects.create(
+            export='general', name='Noms', columns="Nom_Ele\nPrenom_Ele\nNom_Emp\n"
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('general-export'), {'format': 'csv', 'columns': column_set.pk})
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'Nom_Ele,Prenom_Ele,Nom_Emp')
+        self.assertIn('Schmid,Gil,Centre pédagogique XY', lines)
+        # Only the tables of the exported columns (and ordering) are joined
+        student_queries = [q['sql'] for q in ctx.captured_queries if 'stages_student' in q['sql']]
+        self.assertEqual(len(student_queries), 1)
+        self.assertNotIn('stages_option', student_queries[0])
+        self.assertNotIn('stages_corpcontact', student_queries[0])
+
+        response = self.client.get(reverse('admin:stages_exportcolumnset_changelist'))
+        self.assertContains(response, '%s?columns=%d' % (reverse('general-export'), column_set.pk))
+        form = ExportColumnSetForm(data={'export': 'general', 'name': 'Erreur', 'columns': 'Nom_Ele\nInconnue'})
+        self.assertEqual(form.errors, {'columns': ['Colonnes inconnues : Inconnue']})
+
     def test_export_students(self):
         response = self.client.get(reverse('general-export'))
         self.assertEqual(response.status_code, 200)
+        wb = load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        ws = wb.active
+        self.assertEqual(ws.title, 'Exportation')
+        self.assertEqual(ws['A1'].value, 'Num_Ele')
+        self.assertTrue(ws['A1'].font.bold)
+        self.assertEqual(ws.max_row, Student.objects.filter(archived=False).count() + 1)
+        # Students without gender are exported as 'Madame' (historical behaviour)
+        rows = list(ws.values)
+        gender_idx = rows[0].index('Genre_Ele')
+        self.assertEqual({row[gender_idx] for row in rows[1:]}, {'Madame'})
 
     def test_export_qualif_ede(self):
         response = self.client.get(reverse('export-qualif', args=['ede']))
         self.assertEqual(response.status_code, 200)
 
+    def test_export_qualif_constant_queries(self):
+        """Qualification exports cost the same number of queries for any number of students."""
+        level = Level.objects.get(name='3')
+        session = ExamEDESession.objects.create(year=2018, season='printemps')
+        teacher = Teacher.objects.create(first_name='Pierre', last_name='Dubois', abrev='PDU')
+        expert = CorpContact.objects.get(last_name="Horner")
+
+        def create_students(section_name, size):
+            klass = Klass.objects.create(
+                name='3%sa' % section_name, section=Section.objects.get(name=section_name), level=level,
+            )
+            students = Student.objects.bulk_create([
+                Student(first_name="Prénom%d" % idx, last_name="Nom%d" % idx, birth_date="1994-05-12",
+                        klass=klass)
+                for idx in range(size)
+            ])
+            Examination.objects.bulk_create([
+                Examination(student=student, session=session, type_exam=type_exam,
+                            internal_expert=teacher, external_expert=expert, mark='5.0')
+                for student in students for type_exam in ('exam', 'entr', 'exam')
+            ])
+
+        create_students('EDS', 2)
+        create_students('EDE', 500)
+        for params in ({}, {'format': 'json'}):
+            with CaptureQueriesContext(connection) as small_ctx:
+                response = self.client.get(reverse('export-qualif', args=['eds']), params)
+                b''.join(response.streaming_content)
+            with CaptureQueriesContext(connection) as big_ctx:
+                response = self.client.get(reverse('export-qualif', args=['ede']), params)
+                content = b''.join(response.streaming_content)
+            self.assertEqual(len(small_ctx.captured_queries), len(big_ctx.captured_queries))
+        lines = json.loads(content.decode())
+        self.assertEqual(len(lines), 1500)
+        self.assertEqual(lines[0]['Exp_int.'], 'Pierre Dubois')
+        self.assertEqual(lines[0]['Expert ext. Nom'], 'Jean Horner')
+        self.assertEqual(lines[0]['Note'], '5.00')
+
     def test_export_sap(self):
         response = self.client.get(reverse('export_sap'))
         self.assertEqual(response.status_code, 200)
@@ -179,6 +380,116 @@ class StagesTests(TestCase):
         avail.refresh_from_db()
         self.assertEqual(avail.training.student, student)
 
+    def test_batch_trainings(self):
+        url = reverse('batch_trainings')
+        justine, elvire = Student.objects.get(last_name='Varrin'), Student.objects.get(last_name='Hickx')
+        free_avail = Availability.objects.get(period=self.p1, priority=True)
+        albin_training = Training.objects.get(student__last_name='Dupond')
+        contact = CorpContact.objects.get(last_name='Horner')
+        version = data_versions(Training)
+        # Trainings can only be changed with the change_training permission
+        User.objects.create_user('teach', 'teach@example.org', 'passd')
+        self.client.login(username='teach', password='passd')
+        response = self.client.post(url, {
+            'create': [{'student': justine.pk, 'avail': free_avail.pk, 'referent': None, 'contact': None}],
+            'delete': [albin_training.pk],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(Training.objects.filter(pk=albin_training.pk).exists())
+        self.assertFalse(Training.objects.filter(student=justine).exists())
+        self.client.login(username='me', password='mepassword')
+        response = self.client.post(url, {'create': [{'student': 'x'}]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {
+            'create': [
+                {'student': justine.pk, 'avail': free_avail.pk, 'referent': None, 'contact': contact.pk},
+                # Conflicts with the previous item
+                {'student': elvire.pk, 'avail': free_avail.pk},
+                {'student': justine.pk, 'avail': albin_training.availability_id},
+                # Freed by the deletion
+                {'student': elvire.pk, 'avail': albin_training.availability_id},
+                {'student': 0, 'avail': free_avail.pk},
+                {'student': elvire.pk, 'avail': free_avail.pk, 'contact': 999},
+            ],
+            'delete': [albin_training.pk, 999],
+        }, content_type='application/json')
+        results = response.json()
+        self.assertEqual(
+            [list(res) for res in results['create']], [['id'], ['error'], ['error'], ['id'], ['error'], ['error']]
+        )
+        self.assertEqual(results['create'][1]['error'], "La disponibilité est déjà attribuée")
+        self.assertEqual(
+            results['create'][2]['error'], "L’étudiant a déjà une pratique professionnelle durant cette période"
+        )
+        self.assertEqual(results['delete'], [{'id': albin_training.pk}, {'error': "Pratique professionnelle inconnue"}])
+        self.assertEqual(Training.objects.get(pk=results['create'][0]['id']).student, justine)
+        self.assertEqual(Training.objects.get(pk=results['create'][3]['id']).student, elvire)
+        self.assertFalse(Training.objects.filter(pk=albin_training.pk).exists())
+        self.assertNotEqual(data_versions(Training), version)
+        # The changes are in the period change feed
+        changes = self.client.get(reverse('period_changes', args=[self.p1.pk]), {'since': 0}).json()
+        self.assertEqual(sorted(changes['trainings']['student']), ['Hickx Elvire', 'Varrin Justine'])
+        self.assertEqual(changes['deleted']['id'], [albin_training.pk])
+
+    def create_current_period(self):
+        """A period of the current school year for the 1ASE3 class, with 3 availabilities."""
+        period = Period.objects.create(
+            title="Stage d'automne", start_date=school_year_start() + timedelta(days=40),
+            end_date=school_year_start() + timedelta(days=60),
+            section=self.p1.section, level=Level.objects.get(name='1'),
+        )
+        corp_xy = Corporation.objects.get(name="Centre pédagogique XY")
+        corp2 = Corporation.objects.create(name="Crèche Les Moineaux", pcode="2000", city="Neuchâtel")
+        hand, pe = Domain.objects.get(name='handicap'), Domain.objects.get(name='petite enfance')
+        Availability.objects.bulk_create([
+            Availability(corporation=corp_xy, domain=pe, period=period),
+            Availability(corporation=corp2, domain=hand, period=period, priority=True),
+            Availability(corporation=corp2, domain=pe, period=period),
+        ])
+        return period
+
+    def test_period_assignment(self):
+        period = self.create_current_period()
+        data = self.client.get(reverse('period_assignment', args=[period.pk])).json()
+        self.assertEqual(data['student'], ['Dupond Albin', 'Hickx Elvire', 'Varrin Justine'])
+        # Albin already had a training in the handicap domain at Centre pédagogique XY
+        self.assertEqual((data['corp_name'][0], data['domain'][0]), ('Crèche Les Moineaux', 'petite enfance'))
+        self.assertEqual(data['domain_repeats'], [0, 0, 0])
+        self.assertEqual(data['corp_repeats'], [0, 0, 0])
+        self.assertIn(True, data['priority'])
+        # The proposal is accepted through the batch endpoint
+        items = [{'student': student, 'avail': avail} for student, avail in zip(data['student_id'], data['avail_id'])]
+        response = self.client.post(reverse('batch_trainings'), {'create': items}, content_type='application/json')
+        self.assertEqual([list(result) for result in response.json()['create']], [['id']] * 3)
+        self.assertEqual(self.client.get(reverse('period_assignment', args=[period.pk])).json()['student'], [])
+
+    def test_student_summary_suggestions(self):
+        period = self.create_current_period()
+        albin = Student.objects.get(last_name='Dupond')
+        url = '/student/%d/summary/?period=%d' % (albin.pk, period.pk)
+        response = self.client.get(url)
+        # Albin (2300 La Chaux-de-Fonds) already had a training in the handicap domain
+        # at Centre pédagogique XY (2500 Biel/Bienne).
+        self.assertEqual(
+            [(avail['corporation'], avail['domain']) for avail in response.context['suggestions']],
+            [('Crèche Les Moineaux', 'petite enfance'), ('Crèche Les Moineaux', 'handicap'),
+             ('Centre pédagogique XY', 'petite enfance')]
+        )
+        self.assertEqual(response.context['suggestions'][0]['distance'], 14)
+        self.assertEqual(response.context['suggestions'][2]['corp_repeats'], 1)
+        self.assertContains(response, 'institution déjà fréquentée')
+        # The period features are kept in memory until the availabilities change
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([q for q in queries.captured_queries if 'stages_domain' in q['sql']])
+        Availability.objects.filter(period=period, priority=True).delete()
+        self.assertEqual(len(self.client.get(url).context['suggestions']), 2)
+        # Renamed domains are not kept in memory
+        domain = Domain.objects.get(name='petite enfance')
+        domain.name = 'enfance'
+        domain.save()
+        self.assertEqual([avail['domain'] for avail in self.client.get(url).context['suggestions']], ['enfance'] * 2)
+
     def test_archived_trainings(self):
         """
         Once a student is archived, training data are serialized in its archive_text field.
@@ -194,12 +505,88 @@ class StagesTests(TestCase):
         st.save()
         self.assertEqual(st.archived_text, "")
 
-    def test_period_availabilities(self):
-        # Testing here because PeriodTest does not have all data at hand.
-        response = self.client.get(reverse('period_availabilities', args=[self.p1.pk]))
-        decoded = json.loads(response.content.decode('utf-8'))
-        self.assertEqual(len(decoded), 2)
-        self.assertEqual([item['priority'] for item in decoded], [True, False])
+    def test_period_snapshot(self):
+        url = reverse('period_snapshot', args=[self.p1.pk])
+        # 2 queries for the session and user
+        with self.assertNumQueries(9):
+            response = self.client.get(url)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['availabilities']['priority'], [True, False])
+        self.assertEqual(data['availabilities']['free'], [True, False])
+        self.assertEqual(data['trainings']['student'], ['Dupond Albin'])
+        self.assertEqual(data['trainings']['referent'], ['Caux Julie'])
+        self.assertEqual(data['contacts']['last_name'], ['Horner'])
+        # An unchanged period is not computed again
+        etag = response['ETag']
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Adding availabilities does not add queries
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        for domain in Domain.objects.all():
+            av = Availability.objects.create(corporation=corp, domain=domain, period=self.p1)
+            Training.objects.create(availability=av, student=Student.objects.get(first_name="Justine"))
+        with self.assertNumQueries(9):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content.decode('utf-8'))['trainings']['id']), 3)
+
+    def test_period_changes(self):
+        url = reverse('period_changes', args=[self.p1.pk])
+        version = json.loads(self.client.get(reverse('period_snapshot', args=[self.p1.pk])).content)['version']
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(json.loads(self.client.get(url, {'since': version}).content), {
+            'version': version,
+            'trainings': {field: [] for field in TRAINING_FIELDS},
+            'deleted': {'id': [], 'student_id': [], 'avail_id': []},
+        })
+        # Without changes, a held request ends after TRAINING_CHANGES_WAIT seconds
+        with self.settings(TRAINING_CHANGES_WAIT=0.2):
+            changes = json.loads(self.client.get(url, {'since': version, 'wait': 1}).content)
+        self.assertEqual(changes['version'], version)
+        student = Student.objects.get(last_name='Varrin')
+        avail = Availability.objects.get(period=self.p1, priority=True)
+        contact = CorpContact.objects.get(last_name='Horner')
+        response = self.client.post(
+            reverse('new_training'), {'student': student.pk, 'avail': avail.pk, 'contact': contact.pk}
+        )
+        self.assertEqual(response.content, b'OK')
+        # Trainings of other periods are not part of the feed
+        Training.objects.filter(availability__period=self.p2).delete()
+        changes = json.loads(self.client.get(url, {'since': version}).content)
+        self.assertGreater(changes['version'], version)
+        self.assertEqual(changes['trainings']['student'], ['Varrin Justine'])
+        self.assertEqual(changes['trainings']['contact'], [str(contact)])
+        self.assertEqual(changes['deleted']['id'], [])
+        # Only the last state of a training is sent
+        training = Training.objects.get(student=student)
+        self.client.post(reverse('del_training'), {'pk': training.pk})
+        changes = json.loads(self.client.get(url, {'since': version}).content)
+        self.assertEqual(changes['trainings']['id'], [])
+        self.assertEqual(changes['deleted'], {'id': [training.pk], 'student_id': [student.pk], 'avail_id': [avail.pk]})
+        # Deleting a period deletes its change feed
+        self.p1.delete()
+        self.assertFalse(TrainingChange.objects.filter(period=self.p1.pk).exists())
+
+    def test_period_changes_other_process(self):
+        """Changes not seen in the data versions (per-process cache) are found at the end of the wait."""
+        url = reverse('period_changes', args=[self.p1.pk])
+        version = json.loads(self.client.get(reverse('period_snapshot', args=[self.p1.pk])).content)['version']
+        real_sleep = time.sleep
+        changed = []
+
+        def change_elsewhere(seconds):
+            if not changed:
+                # bulk_create() sends no signal, so the data versions are not bumped
+                changed.extend(TrainingChange.objects.bulk_create([TrainingChange(
+                    period=self.p1, training_id=0, student_id=0, availability_id=0, deleted=True
+                )]))
+            real_sleep(seconds)
+
+        with self.settings(TRAINING_CHANGES_WAIT=0.2), mock.patch('stages.views.time.sleep', change_elsewhere):
+            changes = json.loads(self.client.get(url, {'since': version, 'wait': 1}).content)
+        self.assertEqual(changes['version'], changed[0].pk)
+        self.assertEqual(changes['deleted']['id'], [0])
 
     def test_export_update_forms(self):
         self.client.login(username='me', password='mepassword')
@@ -207,7 +594,50 @@ class StagesTests(TestCase):
         self.assertEqual(
             response['Content-Disposition'], 'attachment; filename="modification.zip"'
         )
-        self.assertGreater(int(response['Content-Length']), 10)
+        self.assertGreater(len(b''.join(response.streaming_content)), 10)
+
+    def test_pdf_logo_embedded_once(self):
+        """The header logo of update forms is embedded once for all students of a class."""
+        student = {
+            'civility': 'Madame', 'full_name': 'Julie Dubois', 'last_name': 'Dubois', 'first_name': 'Julie',
+            'street': 'Rue du parc 1', 'pcode_city': '2000 Neuchâtel', 'mobile': '',
+            'corporation': None, 'instructor': None,
+        }
+        content = render_update_form({'name': '2EDS', 'students': [student] * 3}, date(2018, 9, 14))
+        self.assertEqual(len(re.findall(rb'/Type /Page\b(?!s)', content)), 3)
+        self.assertEqual(content.count(b'/Subtype /Image'), 1)
+
+    def test_print_klass_list(self):
+        """Class lists are rendered by worker processes and archived in the classes order."""
+        expected = ['1ase3.pdf', '2ase3.pdf', '2eds.pdf']
+        # Stop the worker processes started by this test
+        self.addCleanup(discard_render_pool, render_pool(2))
+        for processes in (1, 2):
+            with self.settings(PDF_RENDER_PROCESSES=processes):
+                response = self.client.get(reverse('print-klass-list'))
+            with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+                self.assertEqual(archive.namelist(), expected)
+                for info in archive.infolist():
+                    # PDF files are not compressed again
+                    self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                    self.assertTrue(archive.read(info).startswith(b'%PDF'))
+                self.assertIsNone(archive.testzip())
+
+    def test_render_pool_concurrent_creation(self):
+        """Concurrent batch prints share a single pool of spawned worker processes."""
+        pools = []
+        threads = [threading.Thread(target=lambda: pools.append(render_pool(2))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool = pools[0]
+        self.assertTrue(all(p is pool for p in pools))
+        self.assertEqual(pool._mp_context.get_start_method(), 'spawn')
+        discard_render_pool(pool)
+        new_pool = render_pool(2)
+        self.assertIsNot(new_pool, pool)
+        discard_render_pool(new_pool)
 
     def test_send_ede_convocation(self):
         st = Student.objects.get(first_name="Albin")
@@ -369,6 +799,57 @@ tél. 032 886 33 00
         self.assertEqual(response['Content-Type'], 'application/pdf')
         self.assertGreater(int(response['Content-Length']), 1000)
 
+    def test_pdf_cache(self):
+        """Per-object documents are rendered again only when the data they read change."""
+        st = Student.objects.get(first_name="Albin")
+        st.mentor = CorpContact.objects.get(last_name="Horner")
+        st.save()
+        url = reverse('print-mentor-compens-form', args=[st.pk])
+        self.client.login(username='me', password='mepassword')
+
+        def counters():
+            stats = {name: (hits, misses) for name, hits, misses in pdf_cache_stats()}
+            return stats.get('MentorCompensationPdfForm', (0, 0))
+
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root):
+            hits, misses = counters()
+            content = b''.join(self.client.get(url).streaming_content)
+            self.assertEqual(counters(), (hits, misses + 1))
+            self.assertEqual(b''.join(self.client.get(url).streaming_content), content)
+            self.assertEqual(counters(), (hits + 1, misses + 1))
+            # Unrelated changes do not invalidate the document
+            st.mentor.role = 'Directeur'
+            st.mentor.save()
+            self.client.get(url).close()
+            self.assertEqual(counters(), (hits + 2, misses + 1))
+            st.mentor.tel = '032 111 22 33'
+            st.mentor.save()
+            self.assertNotEqual(b''.join(self.client.get(url).streaming_content), content)
+            self.assertEqual(counters(), (hits + 2, misses + 2))
+            self.assertEqual(len(os.listdir(os.path.join(media_root, 'pdf_cache'))), 2)
+        response = self.client.get(reverse('admin:index'))
+        self.assertContains(response, '<td>MentorCompensationPdfForm</td><td>%d</td>' % (hits + 2))
+
+    def test_print_session_compensation_forms(self):
+        """Compensation forms of a whole session share one background per form type."""
+        session = ExamEDESession.objects.create(year=2020, season='1')
+        expert = CorpContact.objects.get(last_name="Horner")
+        for student in Student.objects.all()[:2]:
+            for type_exam in ('entr', 'exam'):
+                Examination.objects.create(
+                    student=student, session=session, type_exam=type_exam, external_expert=expert,
+                    date_exam=datetime(2020, 6, 28, 12, 0),
+                )
+        self.client.login(username='me', password='mepassword')
+        response = self.client.get(reverse('print-session-compens-forms') + '?ids=%d' % session.pk)
+        self.assertEqual(
+            response['Content-Disposition'], 'attachment; filename="indemnites_experts.pdf"'
+        )
+        content = b''.join(response.streaming_content)
+        self.assertEqual(len(re.findall(rb'/Type /Page\b(?!s)', content)), 4)
+        self.assertEqual(content.count(b'/Subtype /Form'), 2)
+        self.assertEqual(content.count(b'/Subtype /Image'), 3)
+
     def test_print_eds_compensation_forms(self):
         klass = Klass.objects.create(
             name="3EDS", section=Section.objects.get(name='EDS'), level=Level.objects.get(name='3')
@@ -443,6 +924,7 @@ class PeriodTests(TestCase):
         self.assertEqual(per.weeks, 2)
 
 
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class TeacherTests(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -458,6 +940,9 @@ class TeacherTests(TestCase):
             teacher=cls.teacher, period=4, subject='Sém. enfance 2', imputation='EDEpe',
         )
 
+    def setUp(self):
+        self.addCleanup(shutil.rmtree, TEMP_MEDIA_ROOT, ignore_errors=True)
+
     def test_export_charge_sheet(self):
         change_url = reverse('admin:stages_teacher_changelist')
         self.client.login(username='me', password='mepassword')
@@ -470,7 +955,7 @@ class TeacherTests(TestCase):
             'attachment; filename="archive_FeuillesDeCharges.zip"'
         )
         self.assertEqual(response['Content-Type'], 'application/zip')
-        self.assertGreater(len(response.content), 200)
+        self.assertGreater(len(b''.join(response.streaming_content)), 200)
 
     def test_calc_activity(self):
         expected = {
@@ -561,6 +1046,79 @@ class TeacherTests(TestCase):
 
 
 
+    def test_charge_calculator(self):
+        """ChargeCalculator results are identical to calc_activity/calc_imputations."""
+        rand = random.Random(42)
+        imputations = [choice[0] for choice in IMPUTATION_CHOICES] + ['ASE', 'ASSC']
+        Teacher.objects.bulk_create([
+            Teacher(
+                first_name='Prénom%d' % idx, last_name='Nom%d' % idx,
+                rate=rand.choice([0, 30, 50, 80, 100]), previous_report=rand.randint(-50, 50),
+            ) for idx in range(80)
+        ])
+        teachers = list(Teacher.objects.all())
+        Course.objects.bulk_create([
+            Course(
+                teacher=rand.choice(teachers + [None]), period=rand.randint(0, 400),
+                subject=rand.choice(['#Mandat', '#ASE Colloque', 'Cours', 'Sém. enfance']),
+                imputation=rand.choice(imputations),
+            ) for _ in range(600)
+        ])
+
+        def sum_periods(imputation):
+            return Course.objects.filter(imputation=imputation).aggregate(Sum('period'))['period__sum'] or 0
+
+        def ratio(part, other):
+            part, other = sum_periods(part), sum_periods(other)
+            return 1 if part + other == 0 else part / (part + other)
+
+        expected_ratios = {
+            'edepe': ratio('EDEpe', 'EDEps'), 'asefe': ratio('ASEFE', 'MPTS'), 'asscfe': ratio('ASSCFE', 'MPS'),
+        }
+        with self.assertNumQueries(1):
+            charges = ChargeCalculator()
+            ratios = charges.ratios()
+        self.assertEqual(ratios, expected_ratios)
+        self.assertEqual(ChargeCalculator(teachers[:3]).ratios(), expected_ratios)
+        for teacher in teachers:
+            expected_activities, expected_imputations = teacher.calc_imputations(ratios)
+            activities, imputations = charges.imputations(teacher, ratios)
+            activities.pop('mandats')
+            expected_activities.pop('mandats')
+            self.assertEqual(activities, expected_activities)
+            self.assertEqual(imputations, expected_imputations)
+            self.assertEqual(
+                [type(val) for val in imputations.values()],
+                [type(val) for val in expected_imputations.values()]
+            )
+
+        charges = ChargeCalculator(teachers[:5], with_mandats=True)
+        for teacher in teachers[:5]:
+            self.assertEqual(
+                charges.activity(teacher)['mandats'],
+                list(teacher.calc_activity()['mandats'].order_by('pk'))
+            )
+
+    def test_charge_snapshots(self):
+        TeacherChargeSnapshot.objects.refresh()
+        snapshot = TeacherChargeSnapshot.objects.get(teacher=self.teacher)
+        self.assertEqual(snapshot.year, school_year_start().year)
+        expected = self.teacher.calc_imputations(ChargeCalculator().ratios())
+        activities, imputations = snapshot.get_charges()
+        self.assertEqual(activities, dict(expected[0], mandats=[]))
+        self.assertEqual(imputations, expected[1])
+
+        # Charge sheets and exports only read the snapshots
+        self.client.login(username='me', password='mepassword')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('imputations_export'))
+            self.client.get(reverse('export_sap'))
+            response = self.client.get(reverse('print-charge-sheet') + '?ids=%d' % self.teacher.pk)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertFalse([
+            q['sql'] for q in ctx.captured_queries if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+        ])
+
     def test_export_imputations(self):
         self.client.login(username='me', password='mepassword')
         response = self.client.get(reverse('imputations_export'))
@@ -570,6 +1128,7 @@ class TeacherTests(TestCase):
         )
 
 
+@override_settings(IMPORT_JOBS_IN_BACKGROUND=False)
 class ImportTests(TestCase):
     def setUp(self):
         User.objects.create_user('me', 'me@example.org', 'mepassword')
@@ -672,6 +1231,95 @@ class ImportTests(TestCase):
         corp.refresh_from_db()
         self.assertEqual(corp.ext_id, 100)
 
+        # Importing the same file again skips unchanged lines, except the one
+        # which produced an error (student not found in candidates).
+        with open(path, 'rb') as fh:
+            response = self.client.post(reverse('import-students'), {'upload': fh}, follow=True)
+        msg = "\n".join(str(m) for m in response.context['messages'])
+        self.assertIn("Lignes inchangées : 2", msg)
+        self.assertIn("Objets créés : 0", msg)
+        # A modified line (Lampion RPN login) is imported again
+        path = os.path.join(os.path.dirname(__file__), 'test_files', 'CLOEE2_Export_FE_2018_modified.xlsx')
+        with open(path, 'rb') as fh:
+            response = self.client.post(reverse('import-students'), {'upload': fh}, follow=True)
+        msg = "\n".join(str(m) for m in response.context['messages'])
+        self.assertIn("Objets modifiés : 1", msg)
+        self.assertIn("Lignes inchangées : 2", msg)
+        student1.refresh_from_db()
+        self.assertEqual(student1.login_rpn, 'lampions')
+        self.assertEqual(student1.klass.name, '2ASSCFEa')
+
+    def test_tabular_reader(self):
+        path = os.path.join(os.path.dirname(__file__), 'test_files', 'CLOEE2_Export_FE_2018.xlsx')
+        with TabularReader(path) as reader:
+            self.assertEqual(reader.headers[:3], ['ELE_NUMERO', 'ELE_AVS', 'ELE_NOM'])
+            rows = list(reader)
+        self.assertEqual(len(rows), 3)
+        # Empty cells are returned as empty strings
+        self.assertNotIn(None, [value for row in rows for value in row.values()])
+
+        path = os.path.join(os.path.dirname(__file__), 'test_files', 'HYPERPLANNING.csv')
+        with TabularReader(path) as reader:
+            self.assertIn('NOMPERSO_ENS', reader.headers)
+            self.assertEqual(len(list(reader)), 31)
+
+    def test_import_students_constant_queries(self):
+        """The number of queries of the student import does not depend on the file size."""
+        Klass.objects.create(
+            name='1ASSCFEa', section=Section.objects.create(name='ASSC'), level=Level.objects.create(name='1')
+        )
+        Teacher.objects.create(first_name='Jeanne', last_name='Dupond', birth_date='1974-08-08')
+
+        def cloee_lines(num):
+            return [{
+                'ELE_NUMERO': 1000 + idx, 'ELE_NOM': 'Nom%d' % idx, 'ELE_PRENOM': 'Prénom',
+                'ELE_RUE': 'Rue du Lac 1', 'ELE_NPA_LOCALITE': '2000 Neuchâtel', 'ELE_CODE_CANTON': 'NE',
+                'ELE_TEL_PRIVE': '', 'ELE_TEL_MOBILE': '', 'ELE_EMAIL_RPN': '', 'ELE_COMPTE_RPN': '',
+                'ELE_DATE_NAISSANCE': '01.02.2003', 'ELE_AVS': '', 'ELE_SEXE': 'F',
+                'INS_CLASSE': '1ASSCFEa', 'INS_MC': 'Dupond Jeanne', 'PROF_DOMAINE_SPEC': '',
+                'ENT_NUMERO': 200 + idx, 'ENT_NOM': 'Institution %d' % idx, 'ENT_RUE': '',
+                'ENT_NPA': '2000', 'ENT_LOCALITE': 'Neuchâtel', 'ENT_TEL': '', 'ENT_CODE_CANTON': 'NE',
+            } for idx in range(num)]
+
+        num_queries = []
+        # Keep under the SQLite bulk insert batch size.
+        for num in (2, 20):
+            with CaptureQueriesContext(connection) as ctx:
+                stats = StudentImportView().import_data(cloee_lines(num))
+            self.assertEqual(stats['created'], num)
+            num_queries.append(len(ctx.captured_queries))
+            Student.objects.all().delete()
+            Corporation.objects.all().delete()
+        self.assertEqual(num_queries[0], num_queries[1])
+
+    def test_import_students_new_corporation(self):
+        """A corporation created by the import is set on an existing student without corporation."""
+        klass = Klass.objects.create(
+            name='1ASSCFEa', section=Section.objects.create(name='ASSC'), level=Level.objects.create(name='1')
+        )
+        student = Student.objects.create(ext_id=1000, first_name="Prénom", last_name="Nom0", klass=klass)
+        line = {
+            'ELE_NUMERO': 1000, 'ELE_NOM': 'Nom0', 'ELE_PRENOM': 'Prénom',
+            'ELE_RUE': 'Rue du Lac 1', 'ELE_NPA_LOCALITE': '2000 Neuchâtel', 'ELE_CODE_CANTON': 'NE',
+            'ELE_TEL_PRIVE': '', 'ELE_TEL_MOBILE': '', 'ELE_EMAIL_RPN': '', 'ELE_COMPTE_RPN': '',
+            'ELE_DATE_NAISSANCE': '01.02.2003', 'ELE_AVS': '', 'ELE_SEXE': 'F',
+            'INS_CLASSE': '1ASSCFEa', 'INS_MC': '', 'PROF_DOMAINE_SPEC': '',
+            'ENT_NUMERO': 200, 'ENT_NOM': 'Institution', 'ENT_RUE': '',
+            'ENT_NPA': '2000', 'ENT_LOCALITE': 'Neuchâtel', 'ENT_TEL': '', 'ENT_CODE_CANTON': 'NE',
+        }
+
+        class CorporationImportView(StudentImportView):
+            fields_to_overwrite = StudentImportView.fields_to_overwrite + ['corporation']
+
+        # Lines without or with an invalid student number are skipped
+        stats = CorporationImportView().import_data([
+            line, dict(line, ELE_NUMERO=''), dict(line, ELE_NUMERO='12a'),
+        ])
+        self.assertEqual(stats['modified'], 1)
+        self.assertEqual(stats['errors'], ["Numéro d’étudiant non valable\xa0: 12a"])
+        student.refresh_from_db()
+        self.assertEqual(student.corporation.name, 'Institution')
+
     def test_import_students_ESTER(self):
         """
         Import CLOEE file for ESTER students (MP_*) version 2018
@@ -740,6 +1388,109 @@ class ImportTests(TestCase):
         self.assertContains(response, "Impossible de trouver «Nom Inconnu» dans la liste des enseignant-e-s")
         self.assertEqual(teacher.course_set.count(), 13)
 
+    def test_import_hp_diff_mode(self):
+        teacher = Teacher.objects.create(
+            first_name='Jeanne', last_name='Dupond', birth_date='1974-08-08'
+        )
+        path = os.path.join(os.path.dirname(__file__), 'test_files', 'HYPERPLANNING.csv')
+        self.client.login(username='me', password='mepassword')
+        with open(path, 'rb') as fh:
+            self.client.post(reverse('import-hp'), {'upload': fh}, follow=True)
+        unchanged = teacher.course_set.exclude(subject='#ASE Colloque').first()
+        changed = teacher.course_set.get(subject='#ASE Colloque')
+        changed.period = 2
+        changed.save()
+        Course.objects.create(teacher=teacher, subject='Obsolète', public='1ASEFEa', imputation='ASEFE')
+
+        with open(path, 'rb') as fh:
+            response = self.client.post(reverse('import-hp'), {'upload': fh, 'diff_mode': 'on'}, follow=True)
+        self.check_form_errors(response)
+        self.assertContains(response, "Objets créés : 0")
+        self.assertContains(response, "Objets modifiés : 1")
+        self.assertContains(response, "Objets supprimés : 1")
+        self.assertContains(response, "Lignes traitées : 31")
+        self.assertEqual(teacher.course_set.count(), 13)
+        changed.refresh_from_db()
+        self.assertEqual(changed.period, 24)
+        # Unchanged rows are kept as is.
+        self.assertTrue(Course.objects.filter(pk=unchanged.pk).exists())
+
+    @override_settings(IMPORT_JOBS_IN_BACKGROUND=True)
+    def test_import_hp_background_job(self):
+        teacher = Teacher.objects.create(
+            first_name='Jeanne', last_name='Dupond', birth_date='1974-08-08'
+        )
+        path = os.path.join(os.path.dirname(__file__), 'test_files', 'HYPERPLANNING.csv')
+        self.client.login(username='me', password='mepassword')
+        with open(path, 'rb') as fh:
+            response = self.client.post(reverse('import-hp'), {'upload': fh})
+        job = ImportJob.objects.get()
+        self.assertRedirects(response, reverse('import-job', args=[job.pk]))
+        self.assertEqual(job.status, ImportJob.PENDING)
+        self.assertEqual(teacher.course_set.count(), 0)
+
+        call_command('run_import_jobs', '--once', stdout=io.StringIO())
+        response = self.client.get(reverse('import-job-progress', args=[job.pk]))
+        data = response.json()
+        self.assertEqual(data['status'], ImportJob.DONE)
+        self.assertEqual(data['rows_processed'], 31)
+        self.assertEqual(data['created'], 13)
+        self.assertEqual(data['modified'], 10)
+        self.assertEqual(
+            data['errors'], ["Impossible de trouver «Nom Inconnu» dans la liste des enseignant-e-s"]
+        )
+        self.assertEqual(teacher.course_set.count(), 13)
+        job.refresh_from_db()
+        self.assertIsNotNone(job.duration)
+        self.assertEqual(job.upload.name, '')
+
+    def test_import_job_lock(self):
+        """Jobs of the same kind cannot run concurrently."""
+        running = ImportJob.objects.create(kind='hp', status=ImportJob.RUNNING)
+        pending = ImportJob.objects.create(kind='hp')
+        other_kind = ImportJob.objects.create(kind='hp_contacts')
+        self.assertFalse(ImportJob.objects.claim(pending))
+        self.assertEqual(ImportJob.objects.claim_next(), other_kind)
+        running.status = ImportJob.DONE
+        running.save()
+        self.assertTrue(ImportJob.objects.claim(pending))
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, ImportJob.RUNNING)
+        self.assertFalse(ImportJob.objects.claim(pending))
+
+    def test_import_job_interrupted(self):
+        """An interrupted or stale job does not prevent later jobs of its kind."""
+        class InterruptedReader:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def __iter__(self):
+                raise KeyboardInterrupt
+
+        job = ImportJob.objects.create(kind='hp')
+        self.assertTrue(ImportJob.objects.claim(job))
+        with self.assertRaises(KeyboardInterrupt):
+            run_import_job(job, reader=InterruptedReader())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.error, "L'importation a été interrompue.")
+        self.assertTrue(ImportJob.objects.claim(ImportJob.objects.create(kind='hp')))
+
+        # The worker of a running job was killed
+        stale = ImportJob.objects.create(kind='hp_contacts')
+        self.assertTrue(ImportJob.objects.claim(stale))
+        pending = ImportJob.objects.create(kind='hp_contacts')
+        self.assertFalse(ImportJob.objects.claim(pending))
+        ImportJob.objects.filter(pk=stale.pk).update(
+            started=timezone.now() - timedelta(seconds=settings.IMPORT_JOB_TIMEOUT + 1)
+        )
+        self.assertTrue(ImportJob.objects.claim(pending))
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ImportJob.FAILED)
+
     def test_import_hp_contacts(self):
         # Those data should have been imported with the student main import file.
         corp = Corporation.objects.create(
@@ -763,6 +1514,44 @@ class ImportTests(TestCase):
         st1.refresh_from_db()
         self.assertEqual(st1.instructor.last_name, 'Geiser')
 
+    def test_import_hp_contacts_last_line(self):
+        """The last line of a student wins, even when it names the current instructor."""
+        corp = Corporation.objects.create(ext_id=44444, name="Crèche Les Mousaillons", city="Moulineaux")
+        current = CorpContact.objects.create(corporation=corp, first_name='Lise', last_name='Geiser')
+        student = Student.objects.create(
+            ext_id=164718, first_name='Margot', last_name='Fellmann', city='Moulineaux',
+            corporation=corp, instructor=current,
+        )
+        line = {'UID_ETU': 164718, 'NoSIRET': 44444, 'PRENOMMDS': 'Lise', 'CIVMDS': '', 'EMAILMDS': ''}
+        stats = HPContactsImportView().import_data([
+            dict(line, NOMMDS='Autre'), dict(line, NOMMDS='Geiser'),
+        ])
+        self.assertEqual(stats['modified'], 0)
+        student.refresh_from_db()
+        self.assertEqual(student.instructor, current)
+
+    def test_import_hp_contacts_constant_queries(self):
+        corp = Corporation.objects.create(ext_id=44444, name="Crèche Les Mousaillons", city="Moulineaux")
+        Student.objects.bulk_create([
+            Student(ext_id=idx, first_name='Prénom', last_name='Nom%d' % idx, city='Moulineaux')
+            for idx in range(20)
+        ])
+
+        def lines(num):
+            return [{
+                'UID_ETU': idx, 'NoSIRET': 44444, 'NOMMDS': 'Geiser%d' % idx, 'PRENOMMDS': 'Lise',
+                'CIVMDS': 'Madame', 'EMAILMDS': '',
+            } for idx in range(num)]
+
+        num_queries = []
+        for num in (2, 20):
+            with CaptureQueriesContext(connection) as ctx:
+                stats = HPContactsImportView().import_data(lines(num))
+            self.assertEqual(stats['modified'], num)
+            num_queries.append(len(ctx.captured_queries))
+            corp.corpcontact_set.all().delete()
+        self.assertEqual(num_queries[0], num_queries[1])
+
     def test_import_and_send_bulletins(self):
         lev1 = Level.objects.create(name='1')
         klass1 = Klass.objects.create(
@@ -1,4 +1,15 @@
+import os
+import time
+import unicodedata
+from contextlib import suppress
 from datetime import date
+from itertools import zip_longest
+from tempfile import NamedTemporaryFile
+
+from openpyxl import load_workbook
+from tabimport import CSVImportedFile, ODSImportedFile, UnsupportedFileFormat, XLSImportedFile
+
+from django.core.files import File
 
 
 def school_year(date, as_tuple=False):
@@ -32,3 +43,115 @@ def is_int(s):
         return True
     except ValueError:
         return False
+
+
+def normalize_name(name):
+    """
+    Return a case-folded, accent-free version of `name`, with normalized
+    whitespace, suitable for name comparisons.
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    return ' '.join(
+        ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().split()
+    )
+
+
+def open_cached_file(path):
+    """
+    Open a file of an on-disk cache (see store_cached_file) and mark it as
+    recently used. Return the file and its stat result.
+    """
+    cached = open(path, 'rb')
+    stat = os.fstat(cached.fileno())
+    # Access time is used for LRU eviction, modification time is the generation time
+    os.utime(cached.fileno(), (time.time(), stat.st_mtime))
+    return cached, stat
+
+
+def store_cached_file(chunks, path, max_size):
+    """
+    Atomically write `chunks` to `path`, then remove the least recently used
+    files of the same extension in its directory as long as their total size
+    exceeds `max_size`.
+    """
+    cache_dir = os.path.dirname(path)
+    extension = os.path.splitext(path)[1]
+    os.makedirs(cache_dir, exist_ok=True)
+    with NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as fh:
+        for chunk in chunks:
+            fh.write(chunk)
+    os.replace(fh.name, path)
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(extension):
+            stat = entry.stat()
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total_size <= max_size or entry_path == path:
+            break
+        with suppress(FileNotFoundError):
+            os.remove(entry_path)
+        total_size -= size
+
+
+class TabularReader:
+    """
+    Row iterator over a CSV, XLSX, XLS or ODS file, parsed only once.
+    `headers` is available before iteration (for validation), and rows are
+    dicts {header: value}, empty cells being returned as ''.
+    XLSX files are streamed (read-only mode), so that memory usage does not
+    grow with the number of rows.
+    """
+    def __init__(self, path, name=None, content_type=''):
+        name = (name or path).lower()
+        content_type = content_type or ''
+        self._fh = self._book = None
+        if 'opendocument.spreadsheet' in content_type or name.endswith('.ods'):
+            self._read_tabimport(ODSImportedFile(path))
+        elif 'spreadsheetml' in content_type or name.endswith('.xlsx'):
+            self._read_xlsx(path)
+        elif 'excel' in content_type or name.endswith('.xls'):
+            self._read_tabimport(XLSImportedFile(path))
+        elif 'csv' in content_type or content_type == 'text/plain' or name.endswith('.csv'):
+            self._fh = open(path, mode='r', encoding='utf-8-sig', newline='')
+            self._read_tabimport(CSVImportedFile(File(self._fh)))
+        else:
+            raise UnsupportedFileFormat("Ce fichier n'est pas dans un format reconnu (csv, xlsx, xls, ods)")
+
+    def _read_tabimport(self, imp_file):
+        self.headers = imp_file.get_headers()
+        self._rows = imp_file
+
+    def _read_xlsx(self, path):
+        self._book = load_workbook(path, read_only=True, data_only=True)
+        sheets = []
+        for sheet in self._book.worksheets:
+            rows = sheet.iter_rows(values_only=True)
+            headers = next(rows, None)
+            if headers and any(h is not None for h in headers):
+                sheets.append((['' if h is None else str(h).strip() for h in headers], rows))
+        self.headers = sheets[0][0] if sheets else []
+        self._rows = (
+            dict(zip_longest(headers, row[:len(headers)]))
+            for headers, rows in sheets for row in rows
+        )
+
+    def __iter__(self):
+        for row in self._rows:
+            if all(value is None or value == '' for value in row.values()):
+                continue
+            yield {key: '' if value is None else value for key, value in row.items()}
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+        if self._book is not None:
+            self._book.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,34 +1,50 @@
+import hashlib
 import io
 import json
 import os
+import time
 
 from collections import OrderedDict
 from datetime import date, datetime, timedelta
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.core.mail import EmailMessage
-from django.db.models import Count
-from django.http import FileResponse, HttpResponse, HttpResponseNotAllowed, HttpResponseRedirect
+from django.db import transaction
+from django.db.models import Count, Max, Prefetch
+from django.http import (
+    FileResponse, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed,
+    HttpResponseRedirect,
+)
 from django.shortcuts import get_object_or_404, redirect
 from django.template import loader
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.utils.dateformat import format as django_format
 from django.utils.text import slugify
-from django.views.generic import DetailView, FormView, ListView, TemplateView, UpdateView
+from django.views.decorators.http import condition
+from django.views.generic import DetailView, FormView, ListView, TemplateView, UpdateView, View
 
 from .base import EmailConfirmationBaseView, PDFBaseView, ZippedFilesBaseView
 from .export import OpenXMLExport
-from .imports import HPContactsImportView, HPImportView, ImportReportsView, StudentImportView
+from .imports import (
+    HPContactsImportView, HPImportView, ImportJobView, ImportReportsView, StudentImportView,
+    import_job_progress,
+)
 from ..forms import CorporationMergeForm, EmailBaseForm, StudentCommentForm
 from ..models import (
-    Klass, Section, Student, Teacher, Corporation, CorpContact, Period,
-    Training, Availability, Examination,
+    Klass, Level, Section, Student, Teacher, Corporation, CorpContact, Domain, Period,
+    Training, TrainingChange, Availability, Examination, TeacherChargeSnapshot, bump_data_version,
+    data_versions, record_training_changes,
 )
 from .. import pdf
 from ..utils import school_year_start
 
+# Seconds between two checks of the change feed of a held period_changes request.
+TRAINING_CHANGES_POLL_INTERVAL = 0.5
+
 
 class CorporationListView(ListView):
     model = Corporation
@@ -100,7 +116,13 @@ class KlassView(DetailView):
         context = super().get_context_data(**kwargs)
         context.update({
             'students': self.object.student_set.filter(archived=False
-                ).prefetch_related('training_set').order_by('last_name', 'first_name'),
+                ).select_related('option_ase', 'corporation'
+                ).prefetch_related(Prefetch(
+                    'training_set',
+                    queryset=Training.objects.select_related(
+                        'availability__period', 'availability__corporation', 'availability__domain'
+                    )
+                )).order_by('last_name', 'first_name'),
             'show_option_ase': self.object.section.name.endswith('ASE'),
             'show_pp': self.object.section.has_stages,
             'show_employeur': not self.object.section.is_ESTER,
@@ -138,9 +160,7 @@ class KlassView(DetailView):
                     if student.corporation else ''
                 )
             if context['show_pp']:
-                for training in student.training_set.select_related(
-                            'availability', 'availability__corporation', 'availability__domain'
-                        ).all():
+                for training in student.training_set.all():
                     values.append(training.availability.corporation.name)
                     values.append(training.availability.domain.name)
             export.write_line(values)
@@ -172,13 +192,13 @@ class AttributionView(TemplateView):
     Base view for the attribution screen. Populate sections and referents.
     All other data are retrieved through AJAX requests:
       * training periods: section_period
-      * corp. availabilities for current period: period_availabilities
-      * already planned training for current period: TrainingsByPeriodView
-      * student list targetted by current period: period_students
-    When an availability is chosen:
-      * corp. contact list: CorpContactJSONView
+      * student list targetted by current period, corp. availabilities,
+        already planned trainings and corp. contacts for current period:
+        period_snapshot, then patched from period_changes
+      * proposed assignment of the period: period_assignment (accepted
+        through batch_trainings)
     When a student is chosen;
-      * details of a student: StudentSummaryView
+      * details of a student and suggested availabilities: StudentSummaryView
     """
     permission_required = 'stages.change_training'
     template_name = 'attribution.html'
@@ -208,9 +228,12 @@ class StudentSummaryView(DetailView):
     template_name = 'student_summary.html'
 
     def get_context_data(self, **kwargs):
+        # NumPy is only needed by the suggestions
+        from ..suggestions import suggest_availabilities
+
         context = super().get_context_data(**kwargs)
-        context['previous_stages'] = self.object.training_set.all(
-            ).select_related('availability__corporation').order_by('availability__period__end_date')
+        context['previous_stages'] = list(self.object.training_set.all(
+            ).select_related('availability__corporation').order_by('availability__period__end_date'))
         period_id = self.request.GET.get('period')
         if period_id:
             try:
@@ -220,6 +243,10 @@ class StudentSummaryView(DetailView):
             else:
                 context['age_for_stage'] = self.object.age_at(period.start_date)
                 context['age_style'] = 'under_17' if (int(context['age_for_stage'].split()[0]) < 17) else ''
+                context['suggestions'] = suggest_availabilities(self.object, period.pk, [
+                    (stage.availability.domain_id, stage.availability.corporation_id)
+                    for stage in context['previous_stages']
+                ])
         return context
 
 
@@ -228,16 +255,6 @@ class AvailabilitySummaryView(DetailView):
     template_name = 'availability_summary.html'
 
 
-class TrainingsByPeriodView(ListView):
-    template_name = 'trainings_list.html'
-    context_object_name = 'trainings'
-
-    def get_queryset(self):
-        return Training.objects.select_related('student__klass', 'availability__corporation', 'availability__domain'
-            ).filter(availability__period__pk=self.kwargs['pk']
-            ).order_by('student__last_name', 'student__first_name')
-
-
 class CorpContactJSONView(ListView):
     """ Return all contacts from a given corporation """
     return_fields = ['id', 'first_name', 'last_name', 'role', 'is_main', 'corporation_id']
@@ -266,32 +283,160 @@ def section_classes(request, pk):
     return HttpResponse(json.dumps(classes), content_type="application/json")
 
 
-def period_students(request, pk):
+def columnar(fields, rows):
+    """Compact JSON structure of `rows` (tuples of `fields` values): a list of values per field."""
+    columns = {field: [] for field in fields}
+    for row in rows:
+        for field, value in zip(fields, row):
+            columns[field].append(value)
+    return columns
+
+
+TRAINING_FIELDS = (
+    'id', 'student_id', 'student', 'klass', 'avail_id', 'corp_name', 'domain', 'referent_id', 'referent', 'contact',
+)
+
+
+def training_rows(trainings):
+    """Rows of TRAINING_FIELDS values of the attribution screen, sorted by student name."""
+    trainings = trainings.select_related(
+        'student__klass', 'referent', 'availability__corporation', 'availability__domain',
+        'availability__contact__corporation',
+    ).order_by('student__last_name', 'student__first_name')
+    return [(
+        t.id, t.student_id, str(t.student), t.student.klass.name if t.student.klass else '',
+        t.availability_id, t.availability.corporation.name, t.availability.domain.name,
+        t.referent_id, str(t.referent) if t.referent else None,
+        str(t.availability.contact) if t.availability.contact else None,
+    ) for t in trainings]
+
+
+SNAPSHOT_MODELS = (
+    Period, Level, Klass, Student, Availability, Corporation, Domain, Training, Teacher, CorpContact,
+)
+
+
+def period_snapshot_etag(request, pk):
+    # The period students depend on the current school year (Period.relative_level).
+    key = json.dumps([pk, school_year_start().isoformat(), data_versions(*SNAPSHOT_MODELS)])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+@condition(etag_func=period_snapshot_etag)
+def period_snapshot(request, pk):
     """
-    Return all active students from period's section and level,
-    with corresponding Training if existing (JSON)
+    Return all data of the attribution screen for a period, in a fixed number
+    of queries: students of the period section/level, availabilities with
+    their free status, planned trainings and contacts of the period
+    corporations (columnar JSON: a list of values per field).
+    The response has an ETag, so unchanged periods are answered with 304.
     """
-    period = get_object_or_404(Period, pk=pk)
+    period = get_object_or_404(Period.objects.select_related('level'), pk=pk)
+    # Read the version first: changes done meanwhile are sent again by period_changes.
+    version = period.trainingchange_set.aggregate(Max('id'))['id__max'] or 0
+    trainings = training_rows(Training.objects.filter(availability__period=period))
+    training_ids = {row[1]: row[0] for row in trainings}
     students = Student.objects.filter(
-        archived=False, klass__section=period.section, klass__level=period.relative_level
-        ).order_by('last_name')
-    trainings = dict((t.student_id, t.id) for t in Training.objects.filter(availability__period=period))
-    data = [{
-        'name': str(s),
-        'id': s.id,
-        'training_id': trainings.get(s.id),
-        'klass': s.klass.name} for s in students]
+        archived=False, klass__section=period.section_id, klass__level=period.relative_level
+    ).select_related('klass').order_by('last_name')
+    # Sorting by the boolean priority is first with PostgreSQL, last with SQLite :-/
+    availabilities = period.availability_set.order_by('-priority', 'corporation__name').values_list(
+        'id', 'corporation_id', 'corporation__name', 'domain__name', 'priority', 'training__id',
+    )
+    contacts = CorpContact.objects.filter(
+        corporation__availability__period=period, archived=False
+    ).distinct().order_by('last_name', 'first_name').values_list(
+        'id', 'first_name', 'last_name', 'role', 'is_main', 'corporation_id',
+    )
+    data = {
+        'version': version,
+        'students': columnar(
+            ('id', 'name', 'klass', 'training_id'),
+            [(s.id, str(s), s.klass.name, training_ids.get(s.id)) for s in students]
+        ),
+        'availabilities': columnar(
+            ('id', 'id_corp', 'corp_name', 'domain', 'priority', 'free'),
+            [av[:5] + (av[5] is None,) for av in availabilities]
+        ),
+        'trainings': columnar(TRAINING_FIELDS, trainings),
+        'contacts': columnar(
+            ('id', 'first_name', 'last_name', 'role', 'is_main', 'corporation_id'), contacts
+        ),
+    }
+    response = HttpResponse(json.dumps(data), content_type="application/json")
+    # Let browsers keep the response, but revalidate it (If-None-Match) each time
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def period_changes(request, pk):
+    """
+    Change feed of the attribution screen: trainings of the period saved or
+    deleted since the version `since` (see TrainingChange), as current
+    training rows and deleted (id, student_id, avail_id) triples.
+    With `wait`, the request is held (long polling) until a change happens or
+    TRAINING_CHANGES_WAIT seconds have elapsed. Each held request occupies a
+    web worker (thread or process) for that time.
+    """
+    try:
+        since = int(request.GET.get('since', ''))
+    except ValueError:
+        return HttpResponseBadRequest("Paramètre since manquant ou non valable")
+    period = get_object_or_404(Period, pk=pk)
+    deadline = time.monotonic() + (settings.TRAINING_CHANGES_WAIT if 'wait' in request.GET else 0)
+    checked_version = None
+    while True:
+        # Only query the feed when a training changed somewhere, and once more
+        # at the end of the wait, as the data versions only follow changes made
+        # by other processes with a shared cache backend.
+        current_version = data_versions(TrainingChange)[0]
+        waited = time.monotonic() >= deadline
+        if current_version != checked_version or waited:
+            checked_version = current_version
+            changes = list(period.trainingchange_set.filter(pk__gt=since).order_by('pk'))
+            if changes or waited:
+                break
+        time.sleep(TRAINING_CHANGES_POLL_INTERVAL)
+
+    last_changes = {change.training_id: change for change in changes}
+    saved_ids = [change.training_id for change in last_changes.values() if not change.deleted]
+    trainings = training_rows(
+        Training.objects.filter(pk__in=saved_ids, availability__period=period)
+    ) if saved_ids else []
+    # Trainings moved meanwhile to another period are deleted from this one.
+    found_ids = {row[0] for row in trainings}
+    deleted = [
+        (change.training_id, change.student_id, change.availability_id)
+        for change in last_changes.values() if change.training_id not in found_ids
+    ]
+    data = {
+        'version': changes[-1].pk if changes else since,
+        'trainings': columnar(TRAINING_FIELDS, trainings),
+        'deleted': columnar(('id', 'student_id', 'avail_id'), deleted),
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def period_assignment(request, pk):
+    """
+    Assignment of the free availabilities of the period to its students without
+    training proposed by the solver (see assignment.propose_assignment), as a
+    preview to be accepted through batch_trainings.
+    """
+    # NumPy is only needed by the solver
+    from ..assignment import propose_assignment
+
+    period = get_object_or_404(Period.objects.select_related('level'), pk=pk)
+    proposals = [(
+        student.pk, str(student), student.klass.name, avail.pk, avail.corporation.name, avail.domain.name,
+        avail.priority, avail.contact_id, domain_repeats, corp_repeats,
+    ) for student, avail, domain_repeats, corp_repeats in propose_assignment(period)]
+    data = columnar((
+        'student_id', 'student', 'klass', 'avail_id', 'corp_name', 'domain', 'priority', 'contact_id',
+        'domain_repeats', 'corp_repeats',
+    ), proposals)
     return HttpResponse(json.dumps(data), content_type="application/json")
 
-def period_availabilities(request, pk):
-    """ Return all availabilities in the specified period """
-    period = get_object_or_404(Period, pk=pk)
-    # Sorting by the boolean priority is first with PostgreSQL, last with SQLite :-/
-    corps = [{'id': av.id, 'id_corp': av.corporation.id, 'corp_name': av.corporation.name,
-              'domain': av.domain.name, 'free': av.free, 'priority': av.priority}
-             for av in period.availability_set.select_related('corporation').all(
-                                             ).order_by('-priority', 'corporation__name')]
-    return HttpResponse(json.dumps(corps), content_type="application/json")
 
 def new_training(request):
     if request.method != 'POST':
@@ -302,14 +447,15 @@ def new_training(request):
         ref = Teacher.objects.get(pk=ref_key) if ref_key else None
         contact = CorpContact.objects.get(pk=cont_key) if cont_key else None
         avail = Availability.objects.get(pk=request.POST.get('avail'))
-        training = Training.objects.create(
+        # Before the training creation, so that its change feed entry gets the contact.
+        if avail.contact != contact:
+            avail.contact = contact
+            avail.save()
+        Training.objects.create(
             student=Student.objects.get(pk=request.POST.get('student')),
             availability=avail,
             referent=ref,
         )
-        if avail.contact != contact:
-            avail.contact = contact
-            avail.save()
     except Exception as exc:
         return HttpResponse(str(exc))
     return HttpResponse(b'OK')
@@ -324,6 +470,94 @@ def del_training(request):
     return HttpResponse(json.dumps({'ref_id': ref_id}), content_type="application/json")
 
 
+def batch_trainings(request):
+    """
+    Create and delete trainings of a planning in one transaction. The JSON body is:
+        {"create": [{"student": id, "avail": id, "referent": id or null, "contact": id or null}, ...],
+         "delete": [training id, ...]}
+    Deletions are applied first. Items are validated against preloaded objects,
+    unknown objects and conflicts (availability already taken, student already
+    placed in the period of the availability) are rejected.
+    Return a result per item: {"id": training id} or {"error": message}.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not request.user.has_perm('stages.change_training'):
+        return HttpResponseForbidden("Vous n’avez pas la permission de modifier les stages.")
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        delete_ids = [int(pk) for pk in data.get('delete', [])]
+        items = [
+            {key: int(item[key]) if item.get(key) else None for key in ('student', 'avail', 'referent', 'contact')}
+            for item in data.get('create', [])
+        ]
+    except (ValueError, TypeError, AttributeError, KeyError):
+        return HttpResponseBadRequest("Données non valables")
+
+    def ids(key):
+        return {item[key] for item in items if item[key] is not None}
+
+    with transaction.atomic():
+        to_delete = Training.objects.select_related('availability').in_bulk(delete_ids)
+        students = Student.objects.in_bulk(ids('student'))
+        avails = Availability.objects.in_bulk(ids('avail'))
+        referents = Teacher.objects.in_bulk(ids('referent'))
+        contacts = CorpContact.objects.in_bulk(ids('contact'))
+        remaining = Training.objects.exclude(pk__in=to_delete)
+        taken_avails = set(remaining.filter(availability__in=avails).values_list('availability_id', flat=True))
+        placed = set(remaining.filter(
+            student__in=students, availability__period__in={av.period_id for av in avails.values()}
+        ).values_list('student_id', 'availability__period_id'))
+
+        delete_results = [
+            {'id': pk} if pk in to_delete else {'error': "Pratique professionnelle inconnue"} for pk in delete_ids
+        ]
+        create_results = []
+        new_trainings = []
+        changed_avails = []
+        for item in items:
+            student, avail = students.get(item['student']), avails.get(item['avail'])
+            referent, contact = referents.get(item['referent']), contacts.get(item['contact'])
+            error = None
+            if student is None:
+                error = "Étudiant inconnu"
+            elif avail is None:
+                error = "Disponibilité inconnue"
+            elif item['referent'] is not None and referent is None:
+                error = "Référent inconnu"
+            elif item['contact'] is not None and contact is None:
+                error = "Contact inconnu"
+            elif contact is not None and contact.corporation_id != avail.corporation_id:
+                error = "Le contact n’appartient pas à l’institution de la disponibilité"
+            elif avail.pk in taken_avails:
+                error = "La disponibilité est déjà attribuée"
+            elif (student.pk, avail.period_id) in placed:
+                error = "L’étudiant a déjà une pratique professionnelle durant cette période"
+            if error:
+                create_results.append({'error': error})
+                continue
+            taken_avails.add(avail.pk)
+            placed.add((student.pk, avail.period_id))
+            if avail.contact_id != item['contact']:
+                avail.contact = contact
+                changed_avails.append(avail)
+            new_trainings.append(Training(student=student, availability=avail, referent=referent))
+            create_results.append(new_trainings[-1])
+
+        for training in to_delete.values():
+            training.delete()
+        Availability.objects.bulk_update(changed_avails, ['contact'])
+        Training.objects.bulk_create(new_trainings)
+        record_training_changes(new_trainings)
+        bump_data_version(Training, Availability)
+
+    results = {
+        'create': [{'id': res.pk} if isinstance(res, Training) else res for res in create_results],
+        'delete': delete_results,
+    }
+    return HttpResponse(json.dumps(results), content_type="application/json")
+
+
 class SendStudentReportsView(FormView):
     template_name = 'email_report.html'
     form_class = EmailBaseForm
@@ -494,13 +728,39 @@ class PrintUpdateForm(ZippedFilesBaseView):
             return HttpResponseRedirect(request.META.get('HTTP_REFERER', '/'))
         return super().get(request, *args, **kwargs)
 
-    def generate_files(self):
-        for klass in Klass.objects.filter(level__gte=2
-                ).exclude(section__name='MP_ASSC').exclude(section__name='MP_ASE'):
-            buff = io.BytesIO()
-            pdf_doc = pdf.UpdateDataFormPDF(buff, self.return_date)
-            pdf_doc.produce(klass)
-            yield ('{0}.pdf'.format(klass.name), buff.getvalue())
+    def render_tasks(self):
+        klasses = Klass.objects.filter(level__gte=2
+            ).exclude(section__name='MP_ASSC').exclude(section__name='MP_ASE'
+            ).prefetch_related(Prefetch(
+                'student_set',
+                queryset=Student.objects.filter(archived=False).select_related('corporation', 'instructor')
+            ))
+        return [
+            ('{0}.pdf'.format(klass.name), pdf.render_update_form, ({
+                'name': klass.name,
+                'students': [{
+                    'civility': student.civility,
+                    'full_name': student.full_name,
+                    'last_name': student.last_name,
+                    'first_name': student.first_name,
+                    'street': student.street,
+                    'pcode_city': student.pcode_city,
+                    'mobile': student.mobile,
+                    'corporation': {
+                        'name': student.corporation.name,
+                        'street': student.corporation.street,
+                        'pcode_city': student.corporation.pcode_city,
+                    } if student.corporation else None,
+                    'instructor': {
+                        'last_name': student.instructor.last_name,
+                        'first_name': student.instructor.first_name,
+                        'tel': student.instructor.tel,
+                        'email': student.instructor.email,
+                    } if student.instructor else None,
+                } for student in klass.student_set.all()],
+            }, self.return_date))
+            for klass in klasses
+        ]
 
 
 class PrintExpertEDECompensationForm(PDFBaseView):
@@ -570,6 +830,31 @@ class PrintCompensationForm(PDFBaseView):
         return super().get(request, *args, **kwargs)
 
 
+class PrintSessionCompensationForms(View):
+    """
+    Imprime dans un seul PDF les formulaires d’indemnisation des experts
+    externes de toutes les procédures des sessions d’examen choisies.
+    """
+    pdf_classes = {
+        'entr': pdf.EntretienProfCompensationPdfForm,
+        'exam': pdf.SoutenanceCompensationPdfForm,
+    }
+
+    def get(self, request, *args, **kwargs):
+        exams = Examination.objects.filter(
+            session__in=request.GET.get('ids', '').split(','), external_expert__isnull=False,
+            type_exam__in=self.pdf_classes.keys(),
+        ).select_related(
+            'student__klass', 'external_expert__corporation'
+        ).order_by('date_exam', 'student__last_name', 'student__first_name')
+        buff = io.BytesIO()
+        pdf.render_overlay(buff, [
+            self.pdf_classes[exam.type_exam](buff, exam).layout_page() for exam in exams
+        ])
+        buff.seek(0)
+        return FileResponse(buff, as_attachment=True, filename='indemnites_experts.pdf')
+
+
 class PrintExpertEDSCompensationForm(PrintExpertEDECompensationForm):
     """
     Imprime le PDF à envoyer à l'expert EDS en accompagnement du
@@ -590,13 +875,27 @@ class PrintExpertEDSCompensationForm(PrintExpertEDECompensationForm):
 class PrintKlassList(ZippedFilesBaseView):
     filename = 'archive_RolesDeClasses.zip'
 
-    def generate_files(self):
-        for klass in Klass.active.order_by('section', 'name'):
-            buff = io.BytesIO()
-            pdf_doc = pdf.KlassListPDF(buff, klass)
-            pdf_doc.produce(klass)
-            filename = slugify(klass.name + '.pdf')
-            yield (filename, buff.getvalue())
+    def render_tasks(self):
+        klasses = Klass.active.order_by('section', 'name').prefetch_related(Prefetch(
+            'student_set',
+            queryset=Student.objects.filter(archived=False).select_related(
+                'instructor__corporation'
+            ).order_by('last_name', 'first_name')
+        ))
+        return [
+            (slugify(klass.name) + '.pdf', pdf.render_klass_list, ({
+                'name': klass.name,
+                'students': [{
+                    'last_name': student.last_name,
+                    'first_name': student.first_name,
+                    'street': student.street,
+                    'pcode_city': student.pcode_city,
+                    'mobile': student.mobile,
+                    'instructor': str(student.instructor or ''),
+                } for student in klass.student_set.all()],
+            },))
+            for klass in klasses
+        ]
 
 
 class PrintChargeSheet(ZippedFilesBaseView):
@@ -606,12 +905,20 @@ class PrintChargeSheet(ZippedFilesBaseView):
     """
     filename = 'archive_FeuillesDeCharges.zip'
 
-    def generate_files(self):
-        queryset = Teacher.objects.filter(pk__in=self.request.GET.get('ids').split(','))
-        for teacher in queryset:
-            activities = teacher.calc_activity()
-            buff = io.BytesIO()
-            pdf_doc = pdf.ChargeSheetPDF(buff, teacher)
-            pdf_doc.produce(activities)
+    def render_tasks(self):
+        teachers = list(Teacher.objects.filter(pk__in=self.request.GET.get('ids').split(',')))
+        charges = TeacherChargeSnapshot.objects.charges(teachers, with_mandats=True)
+        tasks = []
+        for teacher in teachers:
+            activities, _ = charges[teacher.pk]
+            activities = dict(activities, mandats=[
+                {'subject': course.subject, 'period': course.period} for course in activities['mandats']
+            ])
+            teacher_data = {
+                'civility': teacher.civility,
+                'full_name': teacher.full_name,
+                'previous_report': teacher.previous_report,
+            }
             filename = slugify('{0}_{1}'.format(teacher.last_name, teacher.first_name)) + '.pdf'
-            yield (filename, buff.getvalue())
+            tasks.append((filename, pdf.render_charge_sheet, (teacher_data, activities)))
+        return tasks
@@ -1,15 +1,21 @@
+import hashlib
 import io
+import json
 import os
-import tempfile
 import zipfile
 
+from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.mail import EmailMessage
-from django.http import FileResponse, HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, StreamingHttpResponse
 from django.urls import reverse_lazy
 from django.views.generic import FormView, View
 
 from stages.forms import EmailBaseForm
+from stages.pdf import EpcBaseDocTemplate, code_version, render_documents
+from stages.utils import open_cached_file, store_cached_file
 
 
 class EmailConfirmationBaseView(FormView):
@@ -55,33 +61,128 @@ class EmailConfirmationBaseView(FormView):
         return context
 
 
+def pdf_cache_dir():
+    return os.path.join(settings.MEDIA_ROOT, 'pdf_cache')
+
+
+def cached_pdf_response(pdf_class, obj, filename, render):
+    """
+    Serve the document of `pdf_class` for `obj`, produced by `render(out)`,
+    from an on-disk cache (under MEDIA_ROOT/pdf_cache). The cache key is built
+    from the document class, the hash of its code and the data it reads for
+    `obj` (pdf_class.cache_data()). The least recently used files are removed
+    when the cache size exceeds settings.PDF_CACHE_MAX_SIZE.
+    """
+    key = json.dumps([
+        pdf_class.__module__, pdf_class.__qualname__, code_version(pdf_class),
+        settings.PDF_FOOTER_TEXT, pdf_class.cache_data(obj),
+    ], cls=DjangoJSONEncoder, sort_keys=True)
+    path = os.path.join(pdf_cache_dir(), '%s.pdf' % hashlib.sha1(key.encode()).hexdigest())
+    try:
+        cached, _ = open_cached_file(path)
+    except FileNotFoundError:
+        count_pdf_cache(pdf_class, 'misses')
+        buff = io.BytesIO()
+        render(buff)
+        store_cached_file([buff.getvalue()], path, settings.PDF_CACHE_MAX_SIZE)
+        buff.seek(0)
+        return FileResponse(buff, as_attachment=True, filename=filename)
+    count_pdf_cache(pdf_class, 'hits')
+    return FileResponse(cached, as_attachment=True, filename=filename)
+
+
+def count_pdf_cache(pdf_class, counter):
+    key = 'pdf-cache-%s-%s' % (pdf_class.__name__, counter)
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
+
+
+def pdf_cache_stats():
+    """Hit/miss counters of the PDF cache, as (class name, hits, misses) tuples."""
+    base_func = EpcBaseDocTemplate.cache_data.__func__
+    classes, pending = set(), [EpcBaseDocTemplate]
+    while pending:
+        pdf_class = pending.pop()
+        pending.extend(pdf_class.__subclasses__())
+        if pdf_class.cache_data.__func__ is not base_func:
+            classes.add(pdf_class.__name__)
+    counters = cache.get_many(
+        ['pdf-cache-%s-%s' % (name, counter) for name in classes for counter in ('hits', 'misses')]
+    )
+    stats = [
+        (name, counters.get('pdf-cache-%s-hits' % name, 0), counters.get('pdf-cache-%s-misses' % name, 0))
+        for name in sorted(classes)
+    ]
+    return [(name, hits, misses) for name, hits, misses in stats if hits or misses]
+
+
 class PDFBaseView(View):
     pdf_class = None
 
     def get(self, request, *args, **kwargs):
         obj = self.get_object()
-        buff = io.BytesIO()
-        pdf = self.pdf_class(buff, obj)
-        pdf.produce()
-        buff.seek(0)
-        return FileResponse(buff, as_attachment=True, filename=self.filename(obj))
+        return cached_pdf_response(
+            self.pdf_class, obj, self.filename(obj), lambda out: self.pdf_class(out, obj).produce()
+        )
+
+
+class ZipStreamBuffer:
+    """Write-only file-like object keeping what zipfile writes until it is popped."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(files):
+    """
+    Generator of the content of a zip archive containing `files`, an iterable of
+    (file_name, file_data) tuples, yielding each entry as soon as it is added.
+    PDF files (already compressed) are stored without compression.
+    """
+    buff = ZipStreamBuffer()
+    with zipfile.ZipFile(buff, mode='w', compression=zipfile.ZIP_DEFLATED) as filezip:
+        for file_name, file_data in files:
+            compress_type = zipfile.ZIP_STORED if file_name.lower().endswith('.pdf') else None
+            filezip.writestr(file_name, file_data, compress_type=compress_type)
+            yield buff.pop()
+    # Central directory
+    yield buff.pop()
 
 
 class ZippedFilesBaseView(View):
-    """A base class to return a .zip file containing a compressed list of files."""
+    """
+    A base class to return a .zip file containing a compressed list of files.
+    The archive is streamed while files are generated.
+    """
     filename = 'to_be_defined.zip'
 
     def generate_files(self):
-        """Generator yielding (file_name, file_data) tuples."""
+        """Iterable of (file_name, file_data) tuples."""
+        # Data is fetched now, documents are rendered while the response is streamed.
+        tasks = self.render_tasks()
+        file_names = [file_name for file_name, _, _ in tasks]
+        return zip(file_names, render_documents([(func, args) for _, func, args in tasks]))
+
+    def render_tasks(self):
+        """
+        Return a list of (file_name, render function, args) tuples, rendered
+        in parallel by stages.pdf.render_documents. Args must be plain
+        (picklable) data.
+        """
         raise NotImplementedError()
 
     def get(self, request, *args, **kwargs):
-        tmp_file = tempfile.NamedTemporaryFile()
-        with zipfile.ZipFile(tmp_file, mode='w', compression=zipfile.ZIP_DEFLATED) as filezip:
-            for file_name, file_data in self.generate_files():
-                filezip.writestr(file_name, file_data)
-
-        with open(filezip.filename, mode='rb') as fh:
-            response = HttpResponse(fh.read(), content_type='application/zip')
+        response = StreamingHttpResponse(stream_zip(self.generate_files()), content_type='application/zip')
         response['Content-Disposition'] = 'attachment; filename="%s"' % self.filename
         return response
@@ -1,210 +1,406 @@
+import csv
+import hashlib
+import json
+import os
 from collections import OrderedDict
 from datetime import date
-from tempfile import NamedTemporaryFile
+from functools import wraps
+from itertools import chain
+from operator import itemgetter
+from tempfile import TemporaryFile
 
 from django.conf import settings
-from django.db.models import Q, Sum
-from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch, Q
+from django.http import FileResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 
 from ..models import (
-    Availability, CorpContact, Corporation, Course, Section, Student, Teacher,
-    Training,
+    Availability, ContactIndex, Corporation, CorpContact, Course, Domain, Examination,
+    ExportColumnSet, Klass, Option, Period, Section, Student, Teacher, TeacherChargeSnapshot,
+    Training, data_versions,
 )
-from ..utils import school_year_start
+from ..utils import open_cached_file, school_year_start, store_cached_file
 
 openxml_contenttype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
 
 class OpenXMLExport:
+    """
+    Excel export using a write-only worksheet: lines are streamed to a temporary
+    file as soon as they are written, so memory usage does not depend on the
+    number of lines, and the resulting file is served without being loaded
+    in memory.
+    """
     def __init__(self, sheet_title):
-        self.wb = Workbook()
-        self.ws = self.wb.active
-        self.ws.title = sheet_title
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(title=sheet_title)
         self.bold = Font(bold=True)
         self.row_idx = 1
 
     def write_line(self, values, bold=False, col_widths=()):
-        for col_idx, value in enumerate(values, start=1):
-            cell = self.ws.cell(row=self.row_idx, column=col_idx)
-            try:
-                cell.value = value
-            except KeyError:
-                # Ugly workaround for https://bugs.python.org/issue28969
-                from openpyxl.utils.datetime import to_excel
-                to_excel.cache_clear()
-                cell.value = value
-            if bold:
-                cell.font = self.bold
-            if col_widths:
-                self.ws.column_dimensions[get_column_letter(col_idx)].width = col_widths[col_idx - 1]
+        # Column widths can only be defined before the first line is written.
+        if col_widths and self.row_idx == 1:
+            for col_idx, width in enumerate(col_widths, start=1):
+                self.ws.column_dimensions[get_column_letter(col_idx)].width = width
+        if bold:
+            values = [self._bold_cell(value) for value in values]
+        self.ws.append(list(values))
         self.row_idx += 1
 
+    def _bold_cell(self, value):
+        cell = WriteOnlyCell(self.ws, value=value)
+        cell.font = self.bold
+        return cell
+
     def get_http_response(self, filename_base):
-        with NamedTemporaryFile() as tmp:
-            self.wb.save(tmp.name)
-            tmp.seek(0)
-            response = HttpResponse(tmp, content_type=openxml_contenttype)
-            response['Content-Disposition'] = 'attachment; filename=%s_%s.xlsx' % (
+        # The temporary file is closed (and deleted) by FileResponse once sent.
+        tmp = TemporaryFile()
+        self.wb.save(tmp)
+        tmp.seek(0)
+        response = FileResponse(tmp, content_type=openxml_contenttype)
+        response['Content-Disposition'] = 'attachment; filename=%s_%s.xlsx' % (
+            filename_base, date.strftime(date.today(), '%Y-%m-%d')
+        )
+        return response
+
+
+class CSVEcho:
+    """Pseudo-buffer returning written values, to stream csv.writer lines."""
+    def write(self, value):
+        return value
+
+
+def civility(gender):
+    return {'F': 'Madame', 'M': 'Monsieur'}.get(gender, '')
+
+
+def student_civility(gender):
+    # The general and students exports have always shown 'Madame' for an empty gender.
+    return 'Monsieur' if gender == 'M' else 'Madame'
+
+
+def yes_or_empty(value):
+    return 'Oui' if value else ''
+
+
+def choice_display(choices):
+    labels = dict(choices)
+
+    def convert(value):
+        return labels.get(value, value) if value not in ('', None) else value
+    return convert
+
+
+class Column:
+    """
+    Export column: `path` is the ORM path of the exported value (relative to
+    the export model), or a tuple of paths whose values are passed together as
+    a tuple to `convert`, an optional function applied to the value.
+    Columns without path are left empty (or filled by ExportDefinition.rows).
+    """
+    def __init__(self, header, path=None, convert=None):
+        self.header = header
+        self.path = path
+        self.convert = convert
+
+    @property
+    def paths(self):
+        if not self.path:
+            return ()
+        return self.path if isinstance(self.path, tuple) else (self.path,)
+
+
+EXPORT_DEFINITIONS = OrderedDict()
+
+
+class ExportDefinition:
+    """
+    Declarative tabular export of a model: columns, default filter and ordering
+    are compiled into a single values_list() query, only joining the tables
+    needed by the exported columns. The export is served as XLSX, or as CSV
+    with ?format=csv; ?columns=<ExportColumnSet id> restricts/reorders the
+    columns to a set saved in the admin.
+    """
+    def __init__(self, name, title, model, columns, filter=None, order_by=(),
+                 sheet_title='Exportation', url_name=None):
+        self.name = name
+        self.title = title
+        self.model = model
+        self.columns = columns
+        # Q object or callable returning a Q object (evaluated at export time)
+        self.filter = filter
+        self.order_by = order_by
+        self.sheet_title = sheet_title
+        self.url_name = url_name
+        EXPORT_DEFINITIONS[name] = self
+
+    def __str__(self):
+        return self.title
+
+    def headers(self):
+        return [col.header for col in self.columns]
+
+    def get_queryset(self):
+        query = self.model.objects.all()
+        if self.filter is not None:
+            query = query.filter(self.filter() if callable(self.filter) else self.filter)
+        return query.order_by(*self.order_by)
+
+    def get_columns(self, column_set=None):
+        if column_set is None:
+            return self.columns
+        by_header = {col.header: col for col in self.columns}
+        return [by_header[header] for header in column_set.headers() if header in by_header]
+
+    def values(self, queryset, columns, extra_paths=()):
+        """
+        Yield (values, extra_values) for each object of queryset, values being
+        the converted values of `columns` and extra_values the raw values of
+        `extra_paths`.
+        """
+        paths = list(OrderedDict.fromkeys(
+            [path for col in columns for path in col.paths] + list(extra_paths)
+        ))
+        index = {path: idx for idx, path in enumerate(paths)}
+        converters = [
+            (itemgetter(*[index[path] for path in col.paths]) if col.path else None, col.convert)
+            for col in columns
+        ]
+        extra_indexes = [index[path] for path in extra_paths]
+        for row in queryset.values_list(*paths):
+            values = [
+                None if getter is None else (convert(getter(row)) if convert else getter(row))
+                for getter, convert in converters
+            ]
+            yield values, [row[idx] for idx in extra_indexes]
+
+    def rows(self, queryset, columns):
+        for values, _ in self.values(queryset, columns):
+            yield values
+
+    def response(self, request, queryset=None, filename_base=None):
+        if queryset is None:
+            queryset = self.get_queryset()
+        column_set = None
+        if request.GET.get('columns'):
+            column_set = get_object_or_404(ExportColumnSet, pk=request.GET['columns'], export=self.name)
+        columns = self.get_columns(column_set)
+        headers = [col.header for col in columns]
+        rows = self.rows(queryset, columns)
+        filename_base = filename_base or self.name
+
+        if request.GET.get('format') == 'csv':
+            writer = csv.writer(CSVEcho())
+            response = StreamingHttpResponse(
+                (writer.writerow(line) for line in chain([headers], rows)),
+                content_type='text/csv; charset=utf-8'
+            )
+            response['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % (
                 filename_base, date.strftime(date.today(), '%Y-%m-%d')
             )
-        return response
+            return response
 
+        export = OpenXMLExport(self.sheet_title)
+        export.write_line(headers, bold=True)
+        for values in rows:
+            export.write_line(values)
+        return export.get_http_response(filename_base)
 
-EXPORT_FIELDS = [
-    # Student fields
-    ('ID externe', 'student__ext_id'),
-    ('Prénom', 'student__first_name'), ('Nom', 'student__last_name'),
-    ('Titre', 'student__gender'),
-    ('Classe', 'student__klass__name'),
-    ('Filière', 'student__klass__section__name'),
-    ('Rue élève', 'student__street'),
-    ('NPA_élève', 'student__pcode'),
-    ('Localité élève', 'student__city'),
-    ('Tél élève', 'student__tel'),
-    ('Email élève', 'student__email'),
-    ('Date de naissance', 'student__birth_date'),
-    ('No AVS', 'student__avs'),
-    # Stage fields
-    ('Nom de la pratique professionnelle', 'availability__period__title'),
-    ('Début', 'availability__period__start_date'), ('Fin', 'availability__period__end_date'),
-    ('Remarques pratique professionnelle', 'comment'),
-    ('Prénom référent', 'referent__first_name'), ('Nom référent', 'referent__last_name'),
-    ('Courriel référent', 'referent__email'),
-    ('Institution', 'availability__corporation__name'),
-    ('ID externe Inst', 'availability__corporation__ext_id'),
-    ('Rue Inst', 'availability__corporation__street'),
-    ('NPA Inst', 'availability__corporation__pcode'),
-    ('Ville Inst', 'availability__corporation__city'),
-    ('Tél Inst', 'availability__corporation__tel'),
-    ('Domaine', 'availability__domain__name'),
-    ('Remarques Inst', 'availability__comment'),
-    ('Civilité contact', 'availability__contact__civility'),
-    ('Prénom contact', 'availability__contact__first_name'),
-    ('Nom contact', 'availability__contact__last_name'),
-    ('ID externe contact', 'availability__contact__ext_id'),
-    ('Tél contact', 'availability__contact__tel'),
-    ('Courriel contact', 'availability__contact__email'),
-    ('Courriel contact - copie', None),
-]
+
+class StagesExportDefinition(ExportDefinition):
+    """
+    Export of trainings or availabilities, where contact columns are filled with
+    the default contact of the corporation when no contact is defined, and
+    where always-cc contacts are listed in the 'Courriel contact - copie' column.
+    """
+    def __init__(self, *args, corporation_path, section_path, contact_path, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.corporation_path = corporation_path
+        self.section_path = section_path
+        self.contact_path = contact_path
+
+    def rows(self, queryset, columns):
+        prefix = self.contact_path + '__'
+        contact_columns = [
+            (idx, col.path[len(prefix):]) for idx, col in enumerate(columns)
+            if col.path and col.path.startswith(prefix)
+        ]
+        cc_columns = [idx for idx, col in enumerate(columns) if col.header == 'Courriel contact - copie']
+        lines = list(self.values(
+            queryset, columns, extra_paths=(self.corporation_path, self.section_path, self.contact_path)
+        ))
+        contacts = ContactIndex({corp_id for _, (corp_id, _, _) in lines})
+        for values, (corp_id, section_id, contact_id) in lines:
+            if contact_id is None:
+                # Use default contact
+                contact = contacts.contact(corp_id, section_id)
+                if contact:
+                    for idx, attr in contact_columns:
+                        values[idx] = getattr(contact, attr)
+            always_ccs = contacts.always_ccs(corp_id, section_id)
+            if always_ccs:
+                for idx in cc_columns:
+                    values[idx] = "; ".join([c.email for c in always_ccs])
+            yield values
+
+
+def export_cache_dir():
+    return os.path.join(settings.MEDIA_ROOT, 'export_cache')
+
+
+def cached_export(filename_base, models, params=()):
+    """
+    Decorator caching the file generated by an export view on disk (under
+    MEDIA_ROOT/export_cache). The cache key is built from the view name and
+    arguments, the `params` GET parameters, the current date and the data
+    version tokens of `models`, so a cached file is served until one of
+    these models (or a saved ExportColumnSet) is modified. Files are served
+    with ETag/Last-Modified headers, the least recently used files are removed
+    when the cache size exceeds settings.EXPORT_CACHE_MAX_SIZE.
+    CSV exports (?format=csv) are streamed and not cached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.GET.get('format') == 'csv':
+                return view(request, *args, **kwargs)
+            key = json.dumps([
+                view.__name__, args, sorted(kwargs.items()),
+                [request.GET.get(param) for param in params + ('columns',)],
+                date.today().isoformat(), data_versions(*models, ExportColumnSet),
+            ])
+            digest = hashlib.sha1(key.encode()).hexdigest()
+            path = os.path.join(export_cache_dir(), '%s.xlsx' % digest)
+            try:
+                cached, stat = open_cached_file(path)
+            except FileNotFoundError:
+                store_export(view(request, *args, **kwargs), path)
+                cached, stat = open_cached_file(path)
+            etag = '"%s"' % digest
+            response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+            if response is not None:
+                cached.close()
+            else:
+                response = FileResponse(cached, content_type=openxml_contenttype)
+                response['Content-Disposition'] = 'attachment; filename=%s_%s.xlsx' % (
+                    filename_base, date.strftime(date.today(), '%Y-%m-%d')
+                )
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(stat.st_mtime)
+            return response
+        return wrapper
+    return decorator
+
+
+def store_export(response, path):
+    """Write the content of an export `response` to `path`, then evict old cached files."""
+    store_cached_file(response.streaming_content, path, settings.EXPORT_CACHE_MAX_SIZE)
+    response.close()
+
+
+STAGES_EXPORT = StagesExportDefinition(
+    'stages', "Pratiques professionnelles", Training, [
+        # Student fields
+        Column('ID externe', 'student__ext_id'),
+        Column('Prénom', 'student__first_name'), Column('Nom', 'student__last_name'),
+        Column('Titre', 'student__gender', civility),
+        Column('Classe', 'student__klass__name'),
+        Column('Filière', 'student__klass__section__name'),
+        Column('Rue élève', 'student__street'),
+        Column('NPA_élève', 'student__pcode'),
+        Column('Localité élève', 'student__city'),
+        Column('Tél élève', 'student__tel'),
+        Column('Email élève', 'student__email'),
+        Column('Date de naissance', 'student__birth_date'),
+        Column('No AVS', 'student__avs'),
+        # Stage fields
+        Column('Nom de la pratique professionnelle', 'availability__period__title'),
+        Column('Début', 'availability__period__start_date'),
+        Column('Fin', 'availability__period__end_date'),
+        Column('Remarques pratique professionnelle', 'comment'),
+        Column('Prénom référent', 'referent__first_name'),
+        Column('Nom référent', 'referent__last_name'),
+        Column('Courriel référent', 'referent__email'),
+        Column('Institution', 'availability__corporation__name'),
+        Column('ID externe Inst', 'availability__corporation__ext_id'),
+        Column('Rue Inst', 'availability__corporation__street'),
+        Column('NPA Inst', 'availability__corporation__pcode'),
+        Column('Ville Inst', 'availability__corporation__city'),
+        Column('Tél Inst', 'availability__corporation__tel'),
+        Column('Domaine', 'availability__domain__name'),
+        Column('Remarques Inst', 'availability__comment'),
+        Column('Civilité contact', 'availability__contact__civility'),
+        Column('Prénom contact', 'availability__contact__first_name'),
+        Column('Nom contact', 'availability__contact__last_name'),
+        Column('ID externe contact', 'availability__contact__ext_id'),
+        Column('Tél contact', 'availability__contact__tel'),
+        Column('Courriel contact', 'availability__contact__email'),
+        Column('Courriel contact - copie'),
+    ],
+    filter=lambda: Q(availability__period__end_date__gt=school_year_start()),
+    sheet_title='Pratiques professionnelles', url_name='stages_export',
+    corporation_path='availability__corporation', section_path='student__klass__section',
+    contact_path='availability__contact',
+)
 
 
-NON_ATTR_EXPORT_FIELDS = [
-    ('Filière', 'period__section__name'),
-    ('Nom de la pratique professionnelle', 'period__title'),
-    ('Début', 'period__start_date'), ('Fin', 'period__end_date'),
-    ('Institution', 'corporation__name'),
-    ('Rue Inst', 'corporation__street'),
-    ('NPA Inst', 'corporation__pcode'),
-    ('Ville Inst', 'corporation__city'),
-    ('Tél Inst', 'corporation__tel'),
-    ('Domaine', 'domain__name'),
-    ('Remarques Inst', 'comment'),
-    ('Civilité contact', 'contact__civility'),
-    ('Prénom contact', 'contact__first_name'),
-    ('Nom contact', 'contact__last_name'),
-    ('Tél contact', 'contact__tel'),
-    ('Courriel contact', 'contact__email'),
-    ('Courriel contact - copie', None),
-]
+NON_ATTR_STAGES_EXPORT = StagesExportDefinition(
+    'stages_non_attr', "Pratiques professionnelles non attribuées", Availability, [
+        Column('Filière', 'period__section__name'),
+        Column('Nom de la pratique professionnelle', 'period__title'),
+        Column('Début', 'period__start_date'), Column('Fin', 'period__end_date'),
+        Column('Institution', 'corporation__name'),
+        Column('Rue Inst', 'corporation__street'),
+        Column('NPA Inst', 'corporation__pcode'),
+        Column('Ville Inst', 'corporation__city'),
+        Column('Tél Inst', 'corporation__tel'),
+        Column('Domaine', 'domain__name'),
+        Column('Remarques Inst', 'comment'),
+        Column('Civilité contact', 'contact__civility'),
+        Column('Prénom contact', 'contact__first_name'),
+        Column('Nom contact', 'contact__last_name'),
+        Column('Tél contact', 'contact__tel'),
+        Column('Courriel contact', 'contact__email'),
+        Column('Courriel contact - copie'),
+    ],
+    filter=Q(training__isnull=True), sheet_title='Pratiques professionnelles',
+    corporation_path='corporation', section_path='period__section', contact_path='contact',
+)
 
 
+@cached_export('pp_export', (
+    Training, Availability, Period, Student, Klass, Section, Teacher, Corporation, CorpContact, Domain,
+), params=('period', 'non_attr'))
 def stages_export(request, scope=None):
     period_filter = request.GET.get('period')
     non_attributed = bool(int(request.GET.get('non_attr', 0)))
 
-    export_fields = OrderedDict(EXPORT_FIELDS)
-    contact_test_field = 'availability__contact__last_name'
-    corp_name_field = 'availability__corporation__name'
-
+    definition = STAGES_EXPORT
     if period_filter:
         if non_attributed:
             # Export non attributed availabilities for a specific period
-            query = Availability.objects.filter(period_id=period_filter, training__isnull=True)
-            export_fields = OrderedDict(NON_ATTR_EXPORT_FIELDS)
-            contact_test_field = 'contact__last_name'
-            corp_name_field = 'corporation__name'
+            definition = NON_ATTR_STAGES_EXPORT
+            query = definition.get_queryset().filter(period_id=period_filter)
         else:
             # Export trainings for a specific period
             query = Training.objects.filter(availability__period_id=period_filter)
+    elif scope and scope == 'all':
+        # Export all trainings in the database
+        query = Training.objects.all()
     else:
-        if scope and scope == 'all':
-            # Export all trainings in the database
-            query = Training.objects.all()
-        else:
-            query = Training.objects.filter(availability__period__end_date__gt=school_year_start())
-
-    # Prepare "default" contacts (when not defined on training)
-    section_names = Section.objects.all().values_list('name', flat=True)
-    default_contacts = dict(
-        (c, {s: '' for s in section_names})
-        for c in Corporation.objects.all().values_list('name', flat=True)
-    )
-    always_ccs = dict(
-        (c, {s: [] for s in section_names})
-        for c in Corporation.objects.all().values_list('name', flat=True)
-    )
-    for contact in CorpContact.objects.filter(corporation__isnull=False
-            ).select_related('corporation'
-            ).prefetch_related('sections').order_by('corporation'):
-        for section in contact.sections.all():
-            if not default_contacts[contact.corporation.name][section.name] or contact.is_main is True:
-                default_contacts[contact.corporation.name][section.name] = contact
-            if contact.always_cc:
-                always_ccs[contact.corporation.name][section.name].append(contact)
-        if contact.is_main:
-            for sname in section_names:
-                if not default_contacts[contact.corporation.name][sname]:
-                    default_contacts[contact.corporation.name][sname] = contact
-
-    export = OpenXMLExport('Pratiques professionnelles')
-    export.write_line(export_fields.keys(), bold=True)  # Headers
-    # Data
-    query_keys = [f for f in export_fields.values() if f is not None]
-    for line in query.values(*query_keys):
-        values = []
-        for field in query_keys:
-            value = line[field]
-            if 'gender' in field:
-                value = {'F': 'Madame', 'M': 'Monsieur', '': ''}[value]
-            values.append(value)
-        if line[contact_test_field] is None:
-            # Use default contact
-            contact = default_contacts.get(line[corp_name_field], {}).get(line[export_fields['Filière']])
-            if contact:
-                values = values[:-6] + [
-                    contact.civility, contact.first_name, contact.last_name, contact.ext_id,
-                    contact.tel, contact.email
-                ]
-        if always_ccs[line[corp_name_field]].get(line[export_fields['Filière']]):
-            values.append("; ".join(
-                [c.email for c in always_ccs[line[corp_name_field]].get(line[export_fields['Filière']])]
-            ))
-        export.write_line(values)
-
-    return export.get_http_response('pp_export')
-
-
-def _ratio_Ede_Ase_Assc():
-    # Spliting for unattribued periods
-    tot_edeps = Course.objects.filter(imputation='EDEps').aggregate(Sum('period'))['period__sum'] or 0
-    tot_edepe = Course.objects.filter(imputation='EDEpe').aggregate(Sum('period'))['period__sum'] or 0
-    edepe_ratio = 1 if tot_edepe + tot_edeps == 0 else tot_edepe / (tot_edepe + tot_edeps)
-
-    tot_asefe = Course.objects.filter(imputation='ASEFE').aggregate(Sum('period'))['period__sum'] or 0
-    tot_mpts = Course.objects.filter(imputation='MPTS').aggregate(Sum('period'))['period__sum'] or 0
-    asefe_ratio = 1 if tot_asefe + tot_mpts == 0 else tot_asefe / (tot_asefe + tot_mpts)
-
-    tot_asscfe = Course.objects.filter(imputation='ASSCFE').aggregate(Sum('period'))['period__sum'] or 0
-    tot_mps = Course.objects.filter(imputation='MPS').aggregate(Sum('period'))['period__sum'] or 0
-    asscfe_ratio = 1 if tot_asscfe + tot_mps == 0 else tot_asscfe / (tot_asscfe + tot_mps)
-
-    return {'edepe': edepe_ratio, 'asefe': asefe_ratio, 'asscfe': asscfe_ratio}
+        query = definition.get_queryset()
+    return definition.response(request, queryset=query, filename_base='pp_export')
 
 
+@cached_export('Imputations_export', (Teacher, TeacherChargeSnapshot, Course))
 def imputations_export(request):
     IMPUTATIONS_EXPORT_FIELDS = [
         'Nom', 'Prénom', 'Report passé', 'Ens', 'Discipline',
@@ -212,19 +408,19 @@ def imputations_export(request):
         'ASA', 'ASSC', 'ASE', 'MPTS', 'MPS', 'EDEpe', 'EDEps', 'EDS', 'CAS_FPP'
     ]
 
-    ratios = _ratio_Ede_Ase_Assc()
-
     export = OpenXMLExport('Imputations')
     export.write_line(IMPUTATIONS_EXPORT_FIELDS, bold=True)  # Headers
 
-    for teacher in Teacher.objects.filter(archived=False):
-        activities, imputations = teacher.calc_imputations(ratios)
+    teachers = Teacher.objects.filter(archived=False)
+    charges = TeacherChargeSnapshot.objects.charges(teachers)
+    for teacher in teachers:
+        activities, imputations = charges[teacher.pk]
         values = [
             teacher.last_name, teacher.first_name, teacher.previous_report,
             activities['tot_ens'], 'Ens. prof.', activities['tot_mandats'] + activities['tot_formation'],
             'Accompagnement', activities['tot_paye'], 'Charge globale',
             '{0:.2f}'.format(activities['tot_paye']/settings.GLOBAL_CHARGE_PERCENT),
-            teacher.next_report,
+            activities['report'],
         ]
         values.extend(imputations.values())
         export.write_line(values)
@@ -232,6 +428,7 @@ def imputations_export(request):
     return export.get_http_response('Imputations_export')
 
 
+@cached_export('Export_SAP', (Teacher, TeacherChargeSnapshot, Course))
 def export_sap(request):
     EXPORT_SAP_HEADERS = [
         'PERNR', 'PERNOM', 'DEGDA', 'ENDDA', 'ZNOM', 'ZUND',
@@ -249,8 +446,6 @@ def export_sap(request):
         'MPS': 'CIFO01.04.03.06.03.01 - MPS Santé',
     }
 
-    ratios = _ratio_Ede_Ase_Assc()
-
     export = OpenXMLExport('Imputations')
     export.write_line(EXPORT_SAP_HEADERS, bold=True)  # Headers
     start_date = '20.08.2018'
@@ -261,8 +456,10 @@ def export_sap(request):
     centre_cout = ''
     stat = ''
 
-    for teacher in Teacher.objects.filter(archived=False):
-        activities, imputations = teacher.calc_imputations(ratios)
+    teachers = Teacher.objects.filter(archived=False)
+    charges = TeacherChargeSnapshot.objects.charges(teachers)
+    for teacher in teachers:
+        activities, imputations = charges[teacher.pk]
         for key in imputations:
             if imputations[key] > 0:
                 values = [
@@ -282,169 +479,147 @@ def export_sap(request):
 
         # Next report
         values = [
-            teacher.ext_id, teacher.full_name, start_date, end_date, teacher.next_report, indice, type_act,
+            teacher.ext_id, teacher.full_name, start_date, end_date, activities['report'], indice, type_act,
             branche, 'Report suivant', centre_cout, stat,
-            round(teacher.next_report / settings.GLOBAL_CHARGE_PERCENT, 2),
+            round(activities['report'] / settings.GLOBAL_CHARGE_PERCENT, 2),
         ]
         export.write_line(values)
     return export.get_http_response('Export_SAP')
 
 
-GENERAL_EXPORT_FIELDS = [
-    ('Num_Ele', 'ext_id'),
-    ('Nom_Ele', 'last_name'),
-    ('Prenom_Ele', 'first_name'),
-    ('Genre_Ele', 'gender'),
-    ('Rue_Ele', 'street'),
-    ('NPA_Ele', 'pcode'),
-    ('Ville_Ele', 'city'),
-    ('DateNaissance_Ele', 'birth_date'),
-    ('NOAVS_Ele', 'avs'),
-    ('Canton_Ele', 'district'),
-    ('Email_Ele', 'email'),
-    ('Mobile_Ele', 'mobile'),
-    ('Compte_RPN', 'login_rpn'),
-    ('DispenseCG_Ele', 'dispense_ecg'),
-    ('DispenseEPS_Ele', 'dispense_eps'),
-    ('SoutienDYS_Ele', 'soutien_dys'),
-
-    ('Classe_Ele', 'klass__name'),
-    ('Filiere_Ele', 'klass__section__name'),
-    ('MaitreDeClasseNom_Ele', 'klass__teacher__last_name'),
-    ('MaitreDeClassePrenom_Ele', 'klass__teacher__first_name'),
-    ('OptionASE_Ele', 'option_ase__name'),
-
-    ('Num_Emp', 'corporation__ext_id'),
-    ('Nom_Emp', 'corporation__name'),
-    ('Rue_Emp', 'corporation__street'),
-    ('NPA_Emp', 'corporation__pcode'),
-    ('Ville_Emp', 'corporation__city'),
-    ('Canton_Emp', 'corporation__district'),
-    ('Secteur_Emp', 'corporation__sector'),
-    ('Type_EMP', 'corporation__typ'),
-    ('Tel_Emp', 'corporation__tel'),
-
-    ('Num_Form', 'instructor__ext_id'),
-    ('Titre_Form', 'instructor__civility'),
-    ('Prenom_Form', 'instructor__first_name'),
-    ('Nom_Form', 'instructor__last_name'),
-    ('Tel_Form', 'instructor__tel'),
-    ('Email_Form', 'instructor__email'),
-    ('Num_Form2', 'instructor2__ext_id'),
-    ('Titre_Form2', 'instructor2__civility'),
-    ('Prenom_Form2', 'instructor2__first_name'),
-    ('Nom_Form2', 'instructor2__last_name'),
-    ('Tel_Form2', 'instructor2__tel'),
-    ('Email_Form2', 'instructor2__email'),
-    ('EmailCopie_Form', None),
-]
+GENERAL_EXPORT = ExportDefinition(
+    'general', "Exportation générale des étudiants", Student, [
+        Column('Num_Ele', 'ext_id'),
+        Column('Nom_Ele', 'last_name'),
+        Column('Prenom_Ele', 'first_name'),
+        Column('Genre_Ele', 'gender', student_civility),
+        Column('Rue_Ele', 'street'),
+        Column('NPA_Ele', 'pcode'),
+        Column('Ville_Ele', 'city'),
+        Column('DateNaissance_Ele', 'birth_date'),
+        Column('NOAVS_Ele', 'avs'),
+        Column('Canton_Ele', 'district'),
+        Column('Email_Ele', 'email'),
+        Column('Mobile_Ele', 'mobile'),
+        Column('Compte_RPN', 'login_rpn'),
+        Column('DispenseCG_Ele', 'dispense_ecg', yes_or_empty),
+        Column('DispenseEPS_Ele', 'dispense_eps', yes_or_empty),
+        Column('SoutienDYS_Ele', 'soutien_dys', yes_or_empty),
+
+        Column('Classe_Ele', 'klass__name'),
+        Column('Filiere_Ele', 'klass__section__name'),
+        Column('MaitreDeClasseNom_Ele', 'klass__teacher__last_name'),
+        Column('MaitreDeClassePrenom_Ele', 'klass__teacher__first_name'),
+        Column('OptionASE_Ele', 'option_ase__name'),
+
+        Column('Num_Emp', 'corporation__ext_id'),
+        Column('Nom_Emp', 'corporation__name'),
+        Column('Rue_Emp', 'corporation__street'),
+        Column('NPA_Emp', 'corporation__pcode'),
+        Column('Ville_Emp', 'corporation__city'),
+        Column('Canton_Emp', 'corporation__district'),
+        Column('Secteur_Emp', 'corporation__sector'),
+        Column('Type_EMP', 'corporation__typ'),
+        Column('Tel_Emp', 'corporation__tel'),
+
+        Column('Num_Form', 'instructor__ext_id'),
+        Column('Titre_Form', 'instructor__civility'),
+        Column('Prenom_Form', 'instructor__first_name'),
+        Column('Nom_Form', 'instructor__last_name'),
+        Column('Tel_Form', 'instructor__tel'),
+        Column('Email_Form', 'instructor__email'),
+        Column('Num_Form2', 'instructor2__ext_id'),
+        Column('Titre_Form2', 'instructor2__civility'),
+        Column('Prenom_Form2', 'instructor2__first_name'),
+        Column('Nom_Form2', 'instructor2__last_name'),
+        Column('Tel_Form2', 'instructor2__tel'),
+        Column('Email_Form2', 'instructor2__email'),
+        Column('EmailCopie_Form'),
+    ],
+    filter=Q(archived=False), order_by=('klass__name', 'last_name', 'first_name'),
+    url_name='general-export',
+)
 
 
+@cached_export('general_export', (Student, Klass, Section, Teacher, Option, Corporation, CorpContact))
 def general_export(request):
     """
     Export all current students data
     """
-    export_fields = OrderedDict(GENERAL_EXPORT_FIELDS)
-    export = OpenXMLExport('Exportation')
-    export.write_line(export_fields.keys(), bold=True)  # Headers
-    # Data
-    query_keys = [f for f in export_fields.values() if f is not None]
-    query = Student.objects.filter(archived=False).order_by('klass__name', 'last_name', 'first_name')
-    for line in query.values(*query_keys):
-        values = []
-        for field in query_keys:
-            if field == 'gender':
-                values.append(('Madame', 'Monsieur')[line[field] == 'M'])
-            elif field in ('dispense_ecg', 'dispense_eps', 'soutien_dys'):
-                values.append('Oui' if line[field] is True else '')
-            else:
-                values.append(line[field])
-        export.write_line(values)
-
-    return export.get_http_response('general_export')
-
-
-ORTRA_EXPORT_FIELDS = [
-    ('Num_Ele', 'ext_id'),
-    ('Nom_Ele', 'last_name'),
-    ('Prenom_Ele', 'first_name'),
-    ('Genre_Ele', 'gender'),
-    ('Rue_Ele', 'street'),
-    ('NPA_Ele', 'pcode'),
-    ('Ville_Ele', 'city'),
-    ('DateNaissance_Ele', 'birth_date'),
-    ('Email_Ele', 'email'),
-    ('Mobile_Ele', 'mobile'),
-
-    ('Classe_Ele', 'klass__name'),
-    ('Filiere_Ele', 'klass__section__name'),
-    ('MaitreDeClasseNom_Ele', 'klass__teacher__last_name'),
-    ('MaitreDeClassePrenom_Ele', 'klass__teacher__first_name'),
-    ('OptionASE_Ele', 'option_ase__name'),
-
-    ('Num_Emp', 'corporation__ext_id'),
-    ('Nom_Emp', 'corporation__name'),
-    ('Rue_Emp', 'corporation__street'),
-    ('NPA_Emp', 'corporation__pcode'),
-    ('Ville_Emp', 'corporation__city'),
-    ('Tel_Emp', 'corporation__tel'),
-
-    ('Titre_Form', 'instructor__civility'),
-    ('Prenom_Form', 'instructor__first_name'),
-    ('Nom_Form', 'instructor__last_name'),
-    ('Tel_Form', 'instructor__tel'),
-    ('Email_Form', 'instructor__email'),
-]
+    return GENERAL_EXPORT.response(request, filename_base='general_export')
+
+
+ORTRA_EXPORT = ExportDefinition(
+    'ortra', "Exportation OrTra", Student, [
+        Column('Num_Ele', 'ext_id'),
+        Column('Nom_Ele', 'last_name'),
+        Column('Prenom_Ele', 'first_name'),
+        Column('Genre_Ele', 'gender', student_civility),
+        Column('Rue_Ele', 'street'),
+        Column('NPA_Ele', 'pcode'),
+        Column('Ville_Ele', 'city'),
+        Column('DateNaissance_Ele', 'birth_date'),
+        Column('Email_Ele', 'email'),
+        Column('Mobile_Ele', 'mobile'),
+
+        Column('Classe_Ele', 'klass__name'),
+        Column('Filiere_Ele', 'klass__section__name'),
+        Column('MaitreDeClasseNom_Ele', 'klass__teacher__last_name'),
+        Column('MaitreDeClassePrenom_Ele', 'klass__teacher__first_name'),
+        Column('OptionASE_Ele', 'option_ase__name'),
+
+        Column('Num_Emp', 'corporation__ext_id'),
+        Column('Nom_Emp', 'corporation__name'),
+        Column('Rue_Emp', 'corporation__street'),
+        Column('NPA_Emp', 'corporation__pcode'),
+        Column('Ville_Emp', 'corporation__city'),
+        Column('Tel_Emp', 'corporation__tel'),
+
+        Column('Titre_Form', 'instructor__civility'),
+        Column('Prenom_Form', 'instructor__first_name'),
+        Column('Nom_Form', 'instructor__last_name'),
+        Column('Tel_Form', 'instructor__tel'),
+        Column('Email_Form', 'instructor__email'),
+    ],
+    filter=(Q(klass__name__contains='ASAFE') | Q(klass__name__contains='ASEFE') |
+            Q(klass__name__contains='ASSCFE')) & Q(archived=False),
+    order_by=('klass__name', 'last_name', 'first_name'),
+    url_name='ortra-export',
+)
 
 
+@cached_export('ortra_export', (Student, Klass, Section, Teacher, Option, Corporation, CorpContact))
 def ortra_export(request):
     """
     Export students data from sections ASAFE, ASEFE and ASSCFE
     """
-    export_fields = OrderedDict(ORTRA_EXPORT_FIELDS)
-    export = OpenXMLExport('Exportation')
-    export.write_line(export_fields.keys(), bold=True)  # Headers
-    # Data
-    query_keys = [f for f in export_fields.values() if f is not None]
-    query = Student.objects.filter(Q(klass__name__contains='ASAFE') |
-                                   Q(klass__name__contains='ASEFE') |
-                                   Q(klass__name__contains='ASSCFE'),
-                                   archived=False).order_by('klass__name',
-                                                            'last_name',
-                                                            'first_name')
-
-    for line in query.values(*query_keys):
-        values = []
-        for field in query_keys:
-            if field == 'gender':
-                values.append(('Madame', 'Monsieur')[line[field] == 'M'])
-            else:
-                values.append(line[field])
-        export.write_line(values)
+    return ORTRA_EXPORT.response(request, filename_base='ortra_export')
 
-    return export.get_http_response('ortra_export')
 
+QUALIFICATION_EXPORT_HEADERS = [
+    'Classe', 'Etudiant-e',
+    'Référent pratique', 'Titre TD', 'Résumé TD', 'Ens. référent',
+    'Mentor',
+    'Session', 'Type', 'Exp_int.',
+    'Expert ext. Civilité', 'Expert ext. Nom', 'Expert ext. Adresse', 'Expert ext. Localité',
+    'Date', 'Salle', 'Note',
+]
 
-def export_qualification(request, section='ede'):
-    headers = [
-        'Classe', 'Etudiant-e',
-        'Référent pratique', 'Titre TD', 'Résumé TD', 'Ens. référent',
-        'Mentor',
-        'Session', 'Type', 'Exp_int.',
-        'Expert ext. Civilité', 'Expert ext. Nom', 'Expert ext. Adresse', 'Expert ext. Localité',
-        'Date', 'Salle', 'Note',
-    ]
 
-    export_name = 'Export_qualif_%s' % section.upper()
-    export = OpenXMLExport(export_name)
-    export.write_line(headers, bold=True)
-
-    # Data
-    empty_values = [''] * 7
-    for student in Student.objects.filter(klass__name__startswith='3%s' % section.upper(), archived=False
-            ).select_related('klass', 'referent', 'training_referent', 'mentor',
-            ).prefetch_related('examination_set'
-            ).order_by('klass__name', 'last_name'):
+def qualification_lines(section):
+    """
+    Generator yielding (student values, examination values) for each examination
+    of third-year students of `section` (examination values being None for
+    students without examination). Queries do not depend on the number of students.
+    """
+    students = Student.objects.filter(
+        klass__name__startswith='3%s' % section.upper(), archived=False
+    ).select_related('klass', 'referent', 'training_referent', 'mentor',
+    ).prefetch_related(Prefetch(
+        'examination_set',
+        queryset=Examination.objects.select_related('session', 'internal_expert', 'external_expert')
+    )).order_by('klass__name', 'last_name')
+    for student in students:
         stud_values = [
             student.klass.name,
             student.full_name,
@@ -454,44 +629,103 @@ def export_qualification(request, section='ede'):
             student.referent.full_name if student.referent else '',
             student.mentor.full_name if student.mentor else '',
         ]
-        lines_exported = 0
-        for exam in student.examination_set.all():
-            exam_values = [
+        exams = student.examination_set.all()
+        if not exams:
+            yield stud_values, None
+        for exam in exams:
+            expert = exam.external_expert
+            yield stud_values, [
                 str(exam.session),
                 exam.get_type_exam_display(),
                 exam.internal_expert.full_name if exam.internal_expert else '',
-                exam.external_expert.civility if exam.external_expert else '',
-                exam.external_expert.full_name if exam.external_expert else '',
-                exam.external_expert.street if exam.external_expert else '',
-                exam.external_expert.pcode_city if exam.external_expert else '',
+                expert.civility if expert else '',
+                expert.full_name if expert else '',
+                expert.street if expert else '',
+                expert.pcode_city if expert else '',
                 exam.date_exam,
                 exam.room,
                 exam.mark,
             ]
-            if lines_exported == 0:
-                export.write_line(stud_values + exam_values)
-            else:
-                export.write_line(empty_values + exam_values)
-            lines_exported += 1
-        if lines_exported == 0:
+
+
+def export_qualification(request, section='ede'):
+    """
+    Excel export of qualification examinations, or JSON export (list of objects
+    whose keys are the Excel headers) with ?format=json.
+    """
+    if request.GET.get('format') == 'json':
+        lines = (
+            dict(zip(QUALIFICATION_EXPORT_HEADERS, stud_values + (exam_values or [])))
+            for stud_values, exam_values in qualification_lines(section)
+        )
+        return StreamingHttpResponse(stream_json_list(lines), content_type='application/json')
+
+    export_name = 'Export_qualif_%s' % section.upper()
+    export = OpenXMLExport(export_name)
+    export.write_line(QUALIFICATION_EXPORT_HEADERS, bold=True)
+
+    # Data
+    empty_values = [''] * 7
+    previous = None
+    for stud_values, exam_values in qualification_lines(section):
+        if exam_values is None:
             export.write_line(stud_values)
+        elif stud_values is previous:
+            # Only the first examination line contains student data
+            export.write_line(empty_values + exam_values)
+        else:
+            export.write_line(stud_values + exam_values)
+        previous = stud_values
 
     return export.get_http_response(export_name)
 
 
-def institutions_export(request):
-    def format_value(val):
-        return '' if val is None else str(val)
+def stream_json_list(items):
+    """Generator of the JSON serialization of the `items` iterable, chunk by chunk."""
+    yield '['
+    for idx, item in enumerate(items):
+        yield (',' if idx else '') + json.dumps(item, cls=DjangoJSONEncoder)
+    yield ']'
 
-    fields = [
-        (f.verbose_name, f.name)
-        for f in Corporation._meta.get_fields() if hasattr(f, 'verbose_name') and f.name not in ('archived',)
-    ]
-    headers = [f[0] for f in fields]
 
-    export = OpenXMLExport('Institutions')
-    export.write_line(headers, bold=True)
-    for corp in Corporation.objects.filter(archived=False).order_by('name'):
-        values = [format_value(getattr(corp, f[1])) for f in fields]
-        export.write_line(values)
-    return export.get_http_response('Institutions')
+def format_value(value):
+    return '' if value is None else str(value)
+
+
+def format_corporation(values):
+    """Format the (name, sector, pcode, city) values of a corporation as str(Corporation)."""
+    name, sector, pcode, city = values
+    if name is None:
+        return ''
+    sect = ' (%s)' % sector if sector else ''
+    return "%s%s, %s %s" % (name, sect, pcode, city)
+
+
+INSTITUTIONS_EXPORT = ExportDefinition(
+    'institutions', "Institutions", Corporation, [
+        Column(
+            field.verbose_name, ('parent__name', 'parent__sector', 'parent__pcode', 'parent__city'),
+            format_corporation
+        ) if field.is_relation else Column(field.verbose_name, field.name, format_value)
+        for field in Corporation._meta.get_fields()
+        if hasattr(field, 'verbose_name') and field.name not in ('archived',)
+    ],
+    filter=Q(archived=False), order_by=('name',), sheet_title='Institutions',
+    url_name='corporations-export',
+)
+
+
+CORPORATIONS_EXPORT = ExportDefinition(
+    'corporations', "Institutions (sélection de l'admin)", Corporation, [
+        Column(field.verbose_name, field.name, yes_or_empty if field.name == 'archived' else None)
+        for field in Corporation._meta.get_fields() if field.name in (
+            'name', 'short_name', 'sector', 'typ', 'street', 'pcode',
+            'city', 'district', 'tel', 'email', 'web', 'ext_id', 'archived'
+        )
+    ],
+)
+
+
+@cached_export('Institutions', (Corporation,))
+def institutions_export(request):
+    return INSTITUTIONS_EXPORT.response(request, filename_base='Institutions')
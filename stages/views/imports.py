@@ -1,35 +1,43 @@
+import hashlib
+import json
 import os
 import re
 import tempfile
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from fnmatch import fnmatch
-from subprocess import PIPE, Popen, call
-
-from tabimport import CSVImportedFile, FileFactory
+from subprocess import PIPE, call, run
 
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.files import File
 from django.db import IntegrityError, transaction
-from django.db.models import Value
-from django.db.models.functions import Concat
-from django.http import HttpResponseRedirect
+from django.db.models import Case, Value, When
+from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
-from django.views.generic import FormView
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.views.generic import DetailView, FormView
 
 from candidats.models import Candidate
-from ..forms import StudentImportForm, UploadHPFileForm, UploadReportForm
+from ..forms import StudentImportForm, UploadHPCoursesForm, UploadHPFileForm, UploadReportForm
 from ..models import (
-    Corporation, CorpContact, Course, Klass, Option, Section, Student, Teacher,
+    Corporation, CorpContact, Course, ImportJob, ImportRowHash, Klass, Option, Section,
+    Student, Teacher, TeacherChargeSnapshot, Training, bump_data_version,
+    invalidate_contact_index,
 )
-from ..utils import is_int
+from ..utils import TabularReader, is_int, normalize_name
 
 
 class ImportViewBase(FormView):
     template_name = 'file_import.html'
+    # One of ImportJob.KIND_CHOICES
+    import_kind = None
+    # Models modified by bulk operations (not sending signals) during the import
+    bulk_models = ()
 
     @staticmethod
     def _sanitize_date(txt):
@@ -38,35 +46,54 @@ class ImportViewBase(FormView):
         elif isinstance(txt, str):
             return datetime.strptime(txt, '%d.%m.%Y').date()
 
+    def get_job_options(self, form):
+        """Keyword arguments used to instantiate the view running the import job."""
+        return {}
+
     def form_valid(self, form):
         upfile = form.cleaned_data['upload']
-        is_csv = (
-            upfile.name.endswith('.csv') or
-            'csv' in upfile.content_type or
-            upfile.content_type == 'text/plain'
+        job = ImportJob(
+            kind=self.import_kind,
+            content_type=getattr(upfile, 'content_type', None) or '',
+            options=json.dumps(self.get_job_options(form)),
+            user=self.request.user if self.request.user.is_authenticated else None,
         )
-        try:
-            if is_csv:
-                # Reopen the file in text mode
-                upfile = open(upfile.temporary_file_path(), mode='r', encoding='utf-8-sig')
-                imp_file = CSVImportedFile(File(upfile))
-            else:
-                imp_file = FileFactory(upfile)
-            with transaction.atomic():
-                stats = self.import_data(imp_file)
-        except Exception as e:
-            if settings.DEBUG:
-                raise
-            msg = "L'importation a échoué. Erreur: %s" % e
-            if hasattr(upfile, 'content_type'):
-                msg += " (content-type: %s)" % upfile.content_type
-            messages.error(self.request, msg)
+        if settings.IMPORT_JOBS_IN_BACKGROUND:
+            # The worker will parse the file again from the stored copy
+            form.reader.close()
+            job.upload = upfile
+            job.save()
+            messages.info(self.request, "L'importation a été mise en file d'attente.")
+            return HttpResponseRedirect(reverse('import-job', args=[job.pk]))
+
+        # Synchronous import: reuse the reader which validated the headers
+        job.save()
+        if not ImportJob.objects.claim(job):
+            form.reader.close()
+            job.delete()
+            messages.error(
+                self.request,
+                "Une importation du même type est déjà en cours, veuillez réessayer plus tard."
+            )
+            return HttpResponseRedirect(reverse('admin:index'))
+        run_import_job(job, reader=form.reader, reraise=settings.DEBUG)
+        if job.status == ImportJob.FAILED:
+            messages.error(self.request, job.error)
         else:
+            stats = job.get_stats()
             non_fatal_errors = stats.get('errors', [])
             if 'created' in stats:
                 messages.info(self.request, "Objets créés : %d" % stats['created'])
             if 'modified' in stats:
                 messages.info(self.request, "Objets modifiés : %d" % stats['modified'])
+            if 'deleted' in stats:
+                messages.info(self.request, "Objets supprimés : %d" % stats['deleted'])
+            if 'unchanged' in stats:
+                messages.info(self.request, "Lignes inchangées : %d" % stats['unchanged'])
+            if 'lines' in stats:
+                messages.info(self.request, "Lignes traitées : %d en %.1f s" % (
+                    stats['lines'], job.duration.total_seconds()
+                ))
             if non_fatal_errors:
                 messages.warning(self.request, "Erreurs rencontrées:\n %s" % "\n".join(non_fatal_errors))
         return HttpResponseRedirect(reverse('admin:index'))
@@ -75,6 +102,8 @@ class ImportViewBase(FormView):
 class StudentImportView(ImportViewBase):
     title = "Importation étudiants EPC"
     form_class = StudentImportForm
+    import_kind = 'students'
+    bulk_models = (Klass, Student, Corporation)
     # Mapping between column names of a tabular file and Student field names
     student_mapping = {
         'ELE_NUMERO': 'ext_id',
@@ -122,6 +151,22 @@ class StudentImportView(ImportViewBase):
         })
         return kwargs
 
+    @cached_property
+    def _klasses(self):
+        return {k.name: k for k in Klass.objects.all()}
+
+    @cached_property
+    def _options(self):
+        return {opt.name: opt for opt in Option.objects.all()}
+
+    @cached_property
+    def _candidates(self):
+        # When several candidates share the same name, the most recent one wins.
+        return {
+            (cand.last_name, cand.first_name): cand
+            for cand in Candidate.objects.select_related('corporation', 'instructor').order_by('pk')
+        }
+
     def clean_values(self, values):
         """Post-process some of the imported values."""
         if 'birth_date' in values:
@@ -135,19 +180,12 @@ class StudentImportView(ImportViewBase):
                 values['klass'] = None
             else:
                 try:
-                    k = Klass.objects.get(name=values['klass'])
-                except Klass.DoesNotExist:
+                    values['klass'] = self._klasses[values['klass']]
+                except KeyError:
                     raise Exception("La classe '%s' n'existe pas encore" % values['klass'])
-                values['klass'] = k
 
         if 'option_ase' in values:
-            if values['option_ase']:
-                try:
-                    values['option_ase'] = Option.objects.get(name=values['option_ase'])
-                except Option.DoesNotExist:
-                    values['option_ase'] = None
-            else:
-                values['option_ase'] = None
+            values['option_ase'] = self._options.get(values['option_ase']) if values['option_ase'] else None
         return values
 
     @property
@@ -159,25 +197,45 @@ class StudentImportView(ImportViewBase):
         )
 
     def update_defaults_from_candidate(self, defaults):
-        # Any DoesNotExist exception will bubble up.
-        candidate = Candidate.objects.get(last_name=defaults['last_name'],
-                                          first_name=defaults['first_name'])
+        candidate = self._candidates.get((defaults['last_name'], defaults['first_name']))
+        if candidate is None:
+            raise Candidate.DoesNotExist
         # Mix CLOEE data and Candidate data
         if candidate.option in self.mapping_option_ase:
-            defaults['option_ase'] = Option.objects.get(name=self.mapping_option_ase[candidate.option])
+            defaults['option_ase'] = self._options.get(self.mapping_option_ase[candidate.option])
         if candidate.corporation:
             defaults['corporation'] = candidate.corporation
         defaults['instructor'] = candidate.instructor
         defaults['dispense_ecg'] = candidate.exemption_ecg
         defaults['soutien_dys'] = candidate.handicap
 
+    @staticmethod
+    def _field_differs(obj, field_name, value):
+        """Compare without fetching related objects (FKs are compared by pk)."""
+        field = obj._meta.get_field(field_name)
+        if field.is_relation:
+            if value is not None and value.pk is None:
+                # Object created by this import (saved in bulk later)
+                return True
+            return getattr(obj, field.attname) != (value.pk if value is not None else None)
+        return getattr(obj, field_name) != value
+
+    @staticmethod
+    def row_digest(line):
+        return hashlib.sha1(json.dumps(line, sort_keys=True, default=str).encode()).hexdigest()
+
     def import_data(self, up_file):
-        """ Import Student data from uploaded file. """
+        """
+        Import Student data from uploaded file.
+        All lookups are done in preloaded dictionaries and changes are written
+        in bulk, so the number of queries does not depend on the file size.
+        Lines identical to the previous import of an existing student are
+        skipped (see ImportRowHash).
+        """
 
         def strip(val):
             return val.strip() if isinstance(val, str) else val
 
-        obj_created = obj_modified = 0
         err_msg = []
         seen_students_ids = set()
         existing_students_ids = set(
@@ -185,11 +243,27 @@ class StudentImportView(ImportViewBase):
         )
         seen_klasses = set()
         prof_dict = {str(t): t for t in Teacher.objects.all()}
+        students = {st.ext_id: st for st in Student.objects.filter(ext_id__isnull=False)}
+        if self.corporation_mapping:
+            self.load_corporations()
+        students_to_create = []
+        students_to_update = {}
+        klasses_to_update = set()
+        row_hashes = {h.ext_id: h for h in ImportRowHash.objects.filter(kind=self.import_kind)}
+        hashes_to_save = []
+        unchanged = 0
 
         for line in up_file:
             student_defaults = {
                 val: strip(line.get(key, '')) for key, val in self.student_mapping.items()
             }
+            if student_defaults['ext_id'] in ('', None):
+                continue
+            try:
+                student_defaults['ext_id'] = int(student_defaults['ext_id'])
+            except (TypeError, ValueError):
+                err_msg.append("Numéro d’étudiant non valable : {0}".format(student_defaults['ext_id']))
+                continue
             if student_defaults['ext_id'] in seen_students_ids:
                 # Second line for student, ignore it
                 continue
@@ -198,6 +272,14 @@ class StudentImportView(ImportViewBase):
                     continue
             seen_students_ids.add(student_defaults['ext_id'])
 
+            digest = self.row_digest(line)
+            row_hash = row_hashes.get(student_defaults['ext_id'])
+            student = students.get(student_defaults['ext_id'])
+            if row_hash is not None and row_hash.digest == digest and student is not None and not student.archived:
+                unchanged += 1
+                continue
+            num_errors = len(err_msg)
+
             if self.corporation_mapping:
                 corporation_defaults = {
                     val: strip(line[key]) for key, val in self.corporation_mapping.items()
@@ -220,27 +302,26 @@ class StudentImportView(ImportViewBase):
                     # Set the teacher for this klass
                     try:
                         klass.teacher = prof_dict[full_name]
-                        klass.save()
+                        klasses_to_update.add(klass)
                     except KeyError:
                         err_msg.append(
                             "L’enseignant {0} n'existe pas dans la base de données".format(full_name)
                         )
                     seen_klasses.add(klass)
 
-            try:
-                student = Student.objects.get(ext_id=defaults['ext_id'])
+            if student is not None:
                 modified = False
                 for field_name in self.fields_to_overwrite:
-                    if getattr(student, field_name) != defaults[field_name]:
+                    if self._field_differs(student, field_name, defaults[field_name]):
                         setattr(student, field_name, defaults[field_name])
                         modified = True
                 if student.archived:
                     student.archived = False
+                    student.archived_text = ''
                     modified = True
                 if modified:
-                    student.save()
-                    obj_modified += 1
-            except Student.DoesNotExist:
+                    students_to_update[student.pk] = student
+            else:
                 try:
                     self.update_defaults_from_candidate(defaults)
                 except Candidate.DoesNotExist:
@@ -252,53 +333,119 @@ class StudentImportView(ImportViewBase):
                     )
 
                 defaults.pop('teacher', None)
-                Student.objects.create(**defaults)
-                obj_created += 1
+                students_to_create.append(Student(**defaults))
+
+            if len(err_msg) == num_errors:
+                # Lines with errors are processed again (and reported) on next import
+                if row_hash is None:
+                    row_hash = ImportRowHash(kind=self.import_kind, ext_id=defaults['ext_id'])
+                row_hash.digest = digest
+                hashes_to_save.append(row_hash)
+
+        if self.corporation_mapping:
+            self.save_corporations()
+        if klasses_to_update:
+            Klass.objects.bulk_update(klasses_to_update, ['teacher'])
+        if students_to_update:
+            Student.objects.bulk_update(
+                students_to_update.values(), self.fields_to_overwrite + ['archived', 'archived_text']
+            )
+        if students_to_create:
+            Student.objects.bulk_create(students_to_create)
+        self.save_row_hashes(hashes_to_save)
 
         # Archive students who have not been exported
-        rest = existing_students_ids - seen_students_ids
-        archived = 0
-        for student_id in rest:
-            st = Student.objects.get(ext_id=student_id)
-            st.archived = True
-            st.save()
-            archived += 1
+        archived = self.archive_students(existing_students_ids - seen_students_ids)
         return {
-            'created': obj_created, 'modified': obj_modified, 'archived': archived,
-            'errors': err_msg,
+            'created': len(students_to_create), 'modified': len(students_to_update), 'archived': archived,
+            'unchanged': unchanged, 'errors': err_msg,
         }
 
+    def save_row_hashes(self, row_hashes):
+        ImportRowHash.objects.bulk_update([h for h in row_hashes if h.pk], ['digest'], batch_size=500)
+        ImportRowHash.objects.bulk_create([h for h in row_hashes if not h.pk], batch_size=500)
+
+    def archive_students(self, ext_ids):
+        """
+        Archive students in one UPDATE query, filling archived_text the same way
+        as Student.save() does.
+        """
+        if not ext_ids:
+            return 0
+        trainings = defaultdict(list)
+        for training in Training.objects.filter(student__ext_id__in=ext_ids).select_related(
+                'referent', 'availability__period', 'availability__corporation',
+                'availability__contact__corporation', 'availability__domain'):
+            trainings[training.student_id].append(training.serialize())
+        return Student.objects.filter(ext_id__in=ext_ids).update(
+            archived=True,
+            archived_text=Case(
+                *[When(pk=pk, then=Value(json.dumps(serialized))) for pk, serialized in trainings.items()],
+                default=Value(json.dumps([])),
+            ),
+        )
+
+    def load_corporations(self):
+        self._corporations = {}
+        self._corporations_by_name = {}
+        self._duplicate_corp_ids = set()
+        self._new_corporations = []
+        self._modified_corporations = []
+        for corp in Corporation.objects.all():
+            if corp.ext_id is not None:
+                if corp.ext_id in self._corporations:
+                    self._duplicate_corp_ids.add(corp.ext_id)
+                self._corporations[corp.ext_id] = corp
+            self._corporations_by_name[(corp.name, corp.city)] = corp
+
     def get_corporation(self, corp_values):
         if corp_values['ext_id'] == '':
             return None
         if 'city' in corp_values and is_int(corp_values['city'][:4]):
             corp_values['pcode'], _, corp_values['city'] = corp_values['city'].partition(' ')
-        try:
-            corp, created = Corporation.objects.get_or_create(
-                ext_id=corp_values['ext_id'],
-                defaults=corp_values
-            )
-        except IntegrityError:
-            # It may happen that the corporation exists (name and city are enforced unique)
-            # but without the ext_id. In that case, we update the ext_id.
-            try:
-                corp = Corporation.objects.get(name=corp_values['name'], city=corp_values['city'])
-                if corp.ext_id:
-                    raise
-                corp.ext_id = corp_values['ext_id']
-                corp.save()
-            except Corporation.DoesNotExist:
-                raise
-        except Corporation.MultipleObjectsReturned:
+        corp_values['ext_id'] = int(corp_values['ext_id'])
+        if corp_values['ext_id'] in self._duplicate_corp_ids:
             raise ValueError(
                 "Il existe plusieurs institutions avec le numéro %s (%s, %s)" % (
                     corp_values['ext_id'], corp_values['name'], corp_values['city']
             ))
+        corp = self._corporations.get(corp_values['ext_id'])
+        if corp is not None:
+            return corp
+        # It may happen that the corporation exists (name and city are enforced unique)
+        # but without the ext_id. In that case, we update the ext_id.
+        corp = self._corporations_by_name.get((corp_values['name'], corp_values['city']))
+        if corp is None:
+            corp = Corporation(**corp_values)
+            self._new_corporations.append(corp)
+            self._corporations_by_name[(corp.name, corp.city)] = corp
+        elif corp.ext_id:
+            raise IntegrityError(
+                "L’institution %s, %s existe déjà avec le numéro %s" % (corp.name, corp.city, corp.ext_id)
+            )
+        else:
+            corp.ext_id = corp_values['ext_id']
+            self._modified_corporations.append(corp)
+        self._corporations[corp.ext_id] = corp
         return corp
 
+    def save_corporations(self):
+        if self._modified_corporations:
+            Corporation.objects.bulk_update(self._modified_corporations, ['ext_id'])
+        if self._new_corporations:
+            Corporation.objects.bulk_create(self._new_corporations)
+            if any(corp.pk is None for corp in self._new_corporations):
+                # The database backend did not return primary keys from the bulk insert
+                pks = dict(Corporation.objects.filter(
+                    ext_id__in=[corp.ext_id for corp in self._new_corporations]
+                ).values_list('ext_id', 'pk'))
+                for corp in self._new_corporations:
+                    corp.pk = pks[corp.ext_id]
+
 
 class StudentEsterImportView(StudentImportView):
     title = "Importation étudiants ESTER"
+    import_kind = 'students_ester'
     # Mapping between column names of a tabular file and Student field names
     student_mapping = {
         'ELE_NUMERO': 'ext_id',
@@ -338,7 +485,9 @@ class HPImportView(ImportViewBase):
     Importation du fichier HyperPlanning pour l'établissement  des feuilles
     de charges.
     """
-    form_class = UploadHPFileForm
+    form_class = UploadHPCoursesForm
+    import_kind = 'hp'
+    bulk_models = (Course,)
     mapping = {
         'NOMPERSO_ENS': 'teacher',
         'LIBELLE_MAT': 'subject',
@@ -369,15 +518,34 @@ class HPImportView(ImportViewBase):
         ('#Mandat_ASSC', 'ASSC'),
     ])
 
+    # Number of objects per INSERT/UPDATE query
+    batch_size = 500
+    # When True, only changed Course rows are inserted, updated or deleted
+    diff_mode = False
+
+    def get_job_options(self, form):
+        return {'diff_mode': form.cleaned_data['diff_mode']}
+
+    def get_imputation(self, public):
+        for k, v in self.account_categories.items():
+            if k in public:
+                return v
+        return ''
+
     def import_data(self, up_file):
-        obj_created = obj_modified = 0
+        """
+        Periods are first summed in memory by (teacher, subject, public), then
+        the resulting courses are written in bulk.
+        """
         errors = []
+        num_lines = merged = 0
 
         # Pour accélérer la recherche
         profs = {str(t): t for t in Teacher.objects.all()}
-        Course.objects.all().delete()
 
+        periods = OrderedDict()
         for line in up_file:
+            num_lines += 1
             if (line['LIBELLE_MAT'] == '' or line['NOMPERSO_DIP'] == '' or line['TOTAL'] == ''):
                 continue
 
@@ -389,29 +557,64 @@ class HPImportView(ImportViewBase):
                     errors.append(msg)
                 continue
 
-            obj, created = Course.objects.get_or_create(
-                teacher=teacher,
-                subject=line['LIBELLE_MAT'],
-                public=line['NOMPERSO_DIP'],
-            )
-
+            key = (teacher, line['LIBELLE_MAT'], line['NOMPERSO_DIP'])
             period = int(float(line['TOTAL'].replace("'", "").replace('\xa0', '')))
-            if created:
-                obj.period = period
-                obj_created += 1
-                for k, v in self.account_categories.items():
-                    if k in obj.public:
-                        obj.imputation = v
-                        break
+            if key in periods:
+                periods[key] += period
+                merged += 1
             else:
-                obj.period += period
-                obj_modified += 1
-            obj.save()
+                periods[key] = period
 
-            if not obj.imputation:
-                errors.append("Le cours {0} n'a pas pu être imputé correctement!". format(str(obj)))
+        courses = []
+        for (teacher, subject, public), period in periods.items():
+            course = Course(
+                teacher=teacher, subject=subject, public=public, period=period,
+                imputation=self.get_imputation(public),
+            )
+            if not course.imputation:
+                errors.append("Le cours {0} n'a pas pu être imputé correctement!". format(str(course)))
+            courses.append(course)
 
-        return {'created': obj_created, 'modified': obj_modified, 'errors': errors}
+        if self.diff_mode:
+            stats = self.apply_diff(courses)
+        else:
+            Course.objects.all().delete()
+            Course.objects.bulk_create(courses, batch_size=self.batch_size)
+            # Lines merged into an already imported course count as modifications.
+            stats = {'created': len(courses), 'modified': merged}
+        TeacherChargeSnapshot.objects.refresh()
+        stats.update({'lines': num_lines, 'errors': errors})
+        return stats
+
+    def apply_diff(self, courses):
+        """Only insert, update or delete Course rows differing from `courses`."""
+        existing = {}
+        to_delete = []
+        for course in Course.objects.all():
+            key = (course.teacher_id, course.subject, course.public)
+            if key in existing:
+                to_delete.append(course.pk)
+            else:
+                existing[key] = course
+
+        to_create, to_update = [], []
+        for course in courses:
+            current = existing.pop((course.teacher_id, course.subject, course.public), None)
+            if current is None:
+                to_create.append(course)
+            elif (current.period, current.imputation) != (course.period, course.imputation):
+                current.period = course.period
+                current.imputation = course.imputation
+                to_update.append(current)
+        to_delete.extend(course.pk for course in existing.values())
+
+        if to_delete:
+            Course.objects.filter(pk__in=to_delete).delete()
+        if to_update:
+            Course.objects.bulk_update(to_update, ['period', 'imputation'], batch_size=self.batch_size)
+        if to_create:
+            Course.objects.bulk_create(to_create, batch_size=self.batch_size)
+        return {'created': len(to_create), 'modified': len(to_update), 'deleted': len(to_delete)}
 
 
 class HPContactsImportView(ImportViewBase):
@@ -419,14 +622,30 @@ class HPContactsImportView(ImportViewBase):
     Importation du fichier Hyperplanning contenant les formateurs d'étudiants.
     """
     form_class = UploadHPFileForm
+    import_kind = 'hp_contacts'
+    bulk_models = (CorpContact, Student)
 
     def import_data(self, up_file):
-        obj_modified = 0
+        """
+        Students, corporations and contacts are preloaded in dictionaries,
+        changes are written in bulk at the end of the import.
+        """
         errors = []
+        students = {st.ext_id: st for st in Student.objects.filter(ext_id__isnull=False)}
+        corporations = {corp.ext_id: corp for corp in Corporation.objects.filter(ext_id__isnull=False)}
+        contacts = {}
+        for contact in CorpContact.objects.filter(corporation__isnull=False).order_by('pk'):
+            contacts.setdefault(
+                self._contact_key(contact.corporation_id, contact.first_name, contact.last_name), contact
+            )
+
+        instructors = {}  # student -> contact
+        students_to_update = set()
+        contacts_to_create = []
+        contacts_to_update = set()
         for idx, line in enumerate(up_file, start=2):
-            try:
-                student = Student.objects.get(ext_id=int(line['UID_ETU']))
-            except Student.DoesNotExist:
+            student = students.get(int(line['UID_ETU']))
+            if student is None:
                 errors.append(
                     "Impossible de trouver l’étudiant avec le numéro %s" % int(line['UID_ETU'])
                 )
@@ -436,9 +655,8 @@ class HPContactsImportView(ImportViewBase):
                     "NoSIRET est vide à ligne %d. Ligne ignorée" % idx
                 )
                 continue
-            try:
-                corp = Corporation.objects.get(ext_id=int(line['NoSIRET']))
-            except Corporation.DoesNotExist:
+            corp = corporations.get(int(line['NoSIRET']))
+            if corp is None:
                 errors.append(
                     "Impossible de trouver l’institution avec le numéro %s" % int(line['NoSIRET'])
                 )
@@ -448,29 +666,137 @@ class HPContactsImportView(ImportViewBase):
             if student.corporation_id != corp.pk:
                 # This import has priority over the corporation set by StudentImportView
                 student.corporation = corp
-                student.save()
+                students_to_update.add(student)
 
-            contact = corp.corpcontact_set.filter(
-                first_name__iexact=line['PRENOMMDS'].strip(),
-                last_name__iexact=line['NOMMDS'].strip()
-            ).first()
+            key = self._contact_key(corp.pk, line['PRENOMMDS'], line['NOMMDS'])
+            contact = contacts.get(key)
             if contact is None:
-                contact = CorpContact.objects.create(
+                contact = CorpContact(
                     corporation=corp, first_name=line['PRENOMMDS'].strip(),
                     last_name=line['NOMMDS'].strip(), civility=line['CIVMDS'], email=line['EMAILMDS']
                 )
+                contacts[key] = contact
+                contacts_to_create.append(contact)
             else:
                 if line['CIVMDS'] and contact.civility != line['CIVMDS']:
                     contact.civility = line['CIVMDS']
-                    contact.save()
+                    contacts_to_update.add(contact)
                 if line['EMAILMDS'] and contact.email != line['EMAILMDS']:
                     contact.email = line['EMAILMDS']
-                    contact.save()
-            if student.instructor != contact:
+                    contacts_to_update.add(contact)
+            # The last line of a student wins
+            instructors[student] = contact
+
+        if contacts_to_update:
+            CorpContact.objects.bulk_update(contacts_to_update, ['civility', 'email'])
+        if contacts_to_create:
+            self._create_contacts(contacts_to_create)
+        if contacts_to_update or contacts_to_create:
+            # Bulk operations do not send the signals updating the contact index
+            invalidate_contact_index()
+        modified = 0
+        for student, contact in instructors.items():
+            if student.instructor_id != contact.pk:
                 student.instructor = contact
-                student.save()
-                obj_modified += 1
-        return {'modified': obj_modified, 'errors': errors}
+                students_to_update.add(student)
+                modified += 1
+        if students_to_update:
+            Student.objects.bulk_update(students_to_update, ['corporation', 'instructor'])
+        return {'modified': modified, 'errors': errors}
+
+    @staticmethod
+    def _contact_key(corp_id, first_name, last_name):
+        return (corp_id, first_name.strip().casefold(), last_name.strip().casefold())
+
+    def _create_contacts(self, contacts):
+        CorpContact.objects.bulk_create(contacts)
+        if any(contact.pk is None for contact in contacts):
+            # The database backend did not return primary keys from the bulk insert
+            pks = {
+                self._contact_key(c.corporation_id, c.first_name, c.last_name): c.pk
+                for c in CorpContact.objects.filter(
+                    corporation__in={contact.corporation_id for contact in contacts}
+                ).order_by('pk')
+            }
+            for contact in contacts:
+                contact.pk = pks[self._contact_key(contact.corporation_id, contact.first_name, contact.last_name)]
+
+
+IMPORT_VIEWS = {
+    view.import_kind: view
+    for view in (StudentImportView, StudentEsterImportView, HPImportView, HPContactsImportView)
+}
+
+# Number of lines between two progress updates of a running import job
+PROGRESS_STEP = 100
+
+
+def run_import_job(job, reader=None, reraise=False):
+    """
+    Run the import of a claimed (running) ImportJob and store its results.
+    `reader` is an already opened TabularReader of the uploaded file, if any;
+    otherwise the file stored with the job is read.
+    The progress of the import is published in the cache while it runs.
+    """
+    view = IMPORT_VIEWS[job.kind](**job.get_options())
+    rows = 0
+
+    def counted(reader):
+        nonlocal rows
+        for rows, line in enumerate(reader, start=1):
+            if rows % PROGRESS_STEP == 0:
+                cache.set(job.progress_key, rows)
+            yield line
+
+    try:
+        if reader is None:
+            reader = TabularReader(job.upload.path, content_type=job.content_type)
+        with reader, transaction.atomic():
+            stats = view.import_data(counted(reader))
+    except Exception as e:
+        job.status = ImportJob.FAILED
+        job.error = "L'importation a échoué. Erreur: %s" % e
+        if job.content_type:
+            job.error += " (content-type: %s)" % job.content_type
+        if reraise:
+            raise
+    else:
+        job.status = ImportJob.DONE
+        job.stats = json.dumps(stats)
+        bump_data_version(*view.bulk_models)
+    finally:
+        if job.status != ImportJob.DONE:
+            # Also when the worker is interrupted (KeyboardInterrupt, SystemExit)
+            job.status = ImportJob.FAILED
+            job.error = job.error or "L'importation a été interrompue."
+        job.finished = timezone.now()
+        job.rows_processed = rows
+        job.upload.delete(save=False)
+        job.save()
+        cache.delete(job.progress_key)
+
+
+class ImportJobView(DetailView):
+    model = ImportJob
+    template_name = 'import_job.html'
+    context_object_name = 'job'
+
+
+def import_job_progress(request, pk):
+    """ Return the status and progress of an import job (JSON) """
+    job = get_object_or_404(ImportJob, pk=pk)
+    return HttpResponse(json.dumps(job.as_dict()), content_type="application/json")
+
+
+def pdf_pages_text(pdf_path):
+    """
+    Return the list of the text content of each page of a PDF file, extracted
+    with a single pdftotext call.
+    """
+    output = run(['pdftotext', pdf_path, '-'], stdout=PIPE, stderr=PIPE, check=True).stdout
+    # pdftotext ends each page with a form feed character
+    pages = output.decode('utf-8').split('\f')
+    return pages[:-1] if pages and pages[-1] == '' else pages
 
 
 class ImportReportsView(FormView):
@@ -521,44 +847,48 @@ class ImportReportsView(FormView):
 
     def import_reports(self, pdf_path, semester):
         path = os.path.abspath(pdf_path)
+        file_base = os.path.basename(path)[:-4]
         student_regex = r'[E|É]lève\s*:\s*([^\n]*)'
         # Directory automatically deleted when the variable is deleted
         _temp_dir = tempfile.TemporaryDirectory()
         temp_dir = _temp_dir.name
 
-        os.system("pdfseparate %s %s/%s_%%d.pdf" % (path, temp_dir, os.path.basename(path)[:-4]))
+        pages_text = pdf_pages_text(path)
+        run(['pdfseparate', path, os.path.join(temp_dir, '%s_%%d.pdf' % file_base)], check=True)
+
+        # Index of class students by normalized "last_name first_name"
+        students = {
+            normalize_name(str(student)): student
+            for student in self.klass.student_set.exclude(archived=True)
+        }
 
-        # Look for student names in each separated PDF and rename PDF with student name
-        pdf_count = 0
+        # Look for student names in each page and attach the page PDF to the student
         pdf_field = 'report_sem' + semester
-        for filename in os.listdir(temp_dir):
-            p = Popen(['pdftotext', os.path.join(temp_dir, filename), '-'],
-                      shell=False, stdout=PIPE, stderr=PIPE)
-            output, errs = p.communicate()
-            m = re.search(student_regex, output.decode('utf-8'))
+        imported = []
+        for page_num, text in enumerate(pages_text, start=1):
+            filename = '%s_%d.pdf' % (file_base, page_num)
+            m = re.search(student_regex, text)
             if not m:
                 print("Unable to find student name in %s" % filename)
                 continue
-            student_name = m.groups()[0]
-            # Find a student with the found student_name
-            try:
-                student = self.klass.student_set.exclude(archived=True
-                    ).annotate(fullname=Concat('last_name', Value(' '), 'first_name')).get(fullname=student_name)
-            except Student.DoesNotExist:
+            student_name = m.groups()[0].strip()
+            student = students.get(normalize_name(student_name))
+            if student is None:
                 messages.warning(
                     self.request,
                     "Impossible de trouver l'étudiant {} dans la classe {}".format(student_name, self.klass.name)
                 )
                 continue
             with open(os.path.join(temp_dir, filename), 'rb') as pdf:
-                getattr(student, pdf_field).save(filename, File(pdf), save=True)
-            student.save()
-            pdf_count += 1
+                getattr(student, pdf_field).save(filename, File(pdf), save=False)
+            imported.append(student)
+        if imported:
+            Student.objects.bulk_update(imported, [pdf_field])
+            bump_data_version(Student)
 
         messages.success(
             self.request,
             '{0} bulletins PDF ont été importés pour la classe {1} (sur {2} élèves)'.format(
-                pdf_count, self.klass.name,
-                self.klass.student_set.exclude(archived=True).count()
+                len(imported), self.klass.name, len(students)
             )
         )